@@ -0,0 +1,235 @@
+"""
+Request metrics, always on.
+
+MetricsMiddleware records, for every request, its latency, the number of
+SQL queries it made and the time they took, into histograms kept in the
+process by URL name (game-play, game-wait...). They can be seen at the
+stats view (for staff only), and are logged to the evolve.metrics logger
+every METRICS_LOG_INTERVAL seconds.
+
+Queries are counted with QueryCounters, which wrap the cursors of the
+database connection of their thread, and only count while in use. That
+doesn't need DEBUG (or keep the SQL of each query). Other code can use
+them too; turn profiles do (see evolve.game.profiling).
+"""
+import bisect
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.urlresolvers import resolve, Resolver404
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends import util
+
+logger = logging.getLogger('evolve.metrics')
+
+# Upper bounds of the histogram buckets; the last bucket has the rest
+MILLISECONDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+QUERIES = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+LOG_INTERVAL = 300 # Seconds, unless settings.METRICS_LOG_INTERVAL says otherwise
+
+class Histogram(object):
+    """Counts of values by bucket, and their total"""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def mean(self):
+        return float(self.total) / self.count if self.count else 0
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket with the given fraction of the values, or
+        None if it's the last one (which has no bound)
+        """
+        needed = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= needed:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'buckets': zip(list(self.bounds) + [None], self.counts),
+        }
+
+
+class ViewStats(object):
+    """Histograms for the requests to a view"""
+
+    def __init__(self):
+        self.latency = Histogram(MILLISECONDS)
+        self.queries = Histogram(QUERIES)
+        self.sql_time = Histogram(MILLISECONDS)
+
+    def add(self, latency, queries, sql_time):
+        self.latency.add(latency)
+        self.queries.add(queries)
+        self.sql_time.add(sql_time)
+
+    def as_dict(self):
+        return {
+            'latency_ms': self.latency.as_dict(),
+            'queries': self.queries.as_dict(),
+            'sql_ms': self.sql_time.as_dict(),
+        }
+
+
+_lock = threading.Lock()
+_stats = {} # ViewStats by URL name
+_last_log = time.time() # Guarded by _lock, like _stats
+_local = threading.local() # QueryCounters in use by each thread
+
+def record(name, latency, queries, sql_time):
+    """Add a request to name, with times in milliseconds"""
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = ViewStats()
+        stats.add(latency, queries, sql_time)
+
+def stats():
+    """Current stats, as a dict by URL name"""
+    with _lock:
+        return dict((name, s.as_dict()) for name, s in _stats.items())
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+def log_stats():
+    """Log a line with the requests, p95 latency and mean queries of each view"""
+    with _lock:
+        parts = [
+            "%s n=%d p95=%sms queries=%.1f sql=%.1fms" % (
+                name, s.latency.count, s.latency.percentile(0.95) or '>%d' % MILLISECONDS[-1],
+                s.queries.mean(), s.sql_time.mean(),
+            )
+            for name, s in sorted(_stats.items())
+        ]
+    if parts:
+        logger.info("; ".join(parts))
+
+
+def _counters():
+    """The QueryCounters in use by the current thread"""
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    return counters
+
+class QueryCounter(object):
+    """
+    Counts the queries made by the current thread, and the time they take
+    (in seconds), while used as a context manager
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+
+    def __enter__(self):
+        count_queries(connections[DEFAULT_DB_ALIAS]) # Each thread has its own
+        _counters().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        counters = _counters()
+        if self in counters:
+            counters.remove(self)
+        return False
+
+    def add(self, seconds):
+        self.queries += 1
+        self.sql_time += seconds
+
+
+class TimedCursor(util.CursorWrapper):
+    """Adds the queries run, and their time, to the counters of the thread"""
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            elapsed = time.time() - start
+            for counter in _counters():
+                counter.add(elapsed)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            elapsed = time.time() - start
+            for counter in _counters():
+                counter.add(elapsed)
+
+def count_queries(connection):
+    """
+    Make the cursors of connection (a database wrapper) TimedCursors while
+    the current thread has QueryCounters. Does nothing if already done
+    """
+    if 'cursor' in connection.__dict__:
+        return
+    original = connection.cursor
+    def cursor():
+        result = original()
+        if _counters():
+            result = TimedCursor(result, connection)
+        return result
+    connection.cursor = cursor
+
+
+class MetricsMiddleware(object):
+    """
+    Records every request in the stats of its URL name. Should go first, so
+    the time of other middleware is counted too
+    """
+
+    def __init__(self):
+        self.log_interval = getattr(settings, 'METRICS_LOG_INTERVAL', LOG_INTERVAL)
+
+    def process_request(self, request):
+        # Counters left by requests that never got a response are dropped
+        counter = request._metrics_counter = QueryCounter()
+        _local.counters = []
+        counter.__enter__()
+        request._metrics_start = time.time()
+
+    def process_response(self, request, response):
+        global _last_log
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response # Answered by an earlier middleware
+        now = time.time()
+        counter = request._metrics_counter
+        counter.__exit__(None, None, None)
+        queries, sql_time = counter.queries, counter.sql_time
+        try:
+            name = resolve(request.path_info).url_name or 'unnamed'
+        except Resolver404:
+            name = 'not-found'
+        record(name, (now - start) * 1000, queries, sql_time * 1000)
+        with _lock:
+            due = now - _last_log >= self.log_interval
+            if due:
+                _last_log = now
+        if due:
+            log_stats()
+        return response
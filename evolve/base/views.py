@@ -1,9 +1,14 @@
+from django.http import HttpResponse
 from django.shortcuts import redirect
+from django.utils import simplejson
 
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import authenticate, login, logout as auth_logout
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.generic.edit import CreateView
 
+from evolve.base import metrics
+
 def home(request):
     if request.user.is_authenticated():
         return redirect('games')
@@ -31,3 +36,8 @@ class RegisterView(CreateView):
 
 register = RegisterView.as_view()
 
+
+@staff_member_required
+def stats(request):
+    """Request metrics of this process, by URL name"""
+    return HttpResponse(simplejson.dumps(metrics.stats()), mimetype='application/json')
@@ -0,0 +1,27 @@
+from django.contrib import admin
+
+from evolve.game.models import Game
+
+class GameAdmin(admin.ModelAdmin):
+    """
+    Only profiled can be changed: games move on while the page is open, so
+    saving anything else would roll them back
+    """
+    list_display = ('id', 'age', 'turn', 'started', 'finished', 'profiled')
+    list_filter = ('started', 'finished', 'profiled')
+    list_editable = ('profiled',)
+
+    def get_readonly_fields(self, request, obj=None):
+        return [f.name for f in self.model._meta.fields + self.model._meta.many_to_many if f.name != 'profiled']
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            Game.objects.filter(pk=obj.pk).update(profiled=obj.profiled)
+        else:
+            obj.save()
+
+    def save_related(self, request, form, formsets, change):
+        if not change:
+            super(GameAdmin, self).save_related(request, form, formsets, change)
+
+admin.site.register(Game, GameAdmin)
@@ -0,0 +1,185 @@
+"""
+Benchmarks for the hot paths of the game, with query counts.
+
+Each benchmark times something on synthetic data, and counts the queries
+it makes: payments and science scores on layouts of different sizes, and
+scores, turns and pages on games with every number of players, played
+with bots into the second age. Run them with
+
+    python manage.py benchmark
+
+which creates a throwaway database (like the tests do) and fails when a
+benchmark makes more queries than in the baseline stored at BASELINE, or
+takes more than TOLERANCE times as long. Times depend on the machine the
+baseline was taken on; run with --save to take a new one.
+"""
+import os
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core import signals
+from django.db import connection, reset_queries
+from django.test.client import Client
+from django.utils import simplejson
+
+from evolve.rules import constants, economy, science, synthetic, catalog, benchmarks
+from evolve.rules.models import Variant
+from evolve.game.models import Game, Player
+from evolve.game import engine, views
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'benchmarks.json')
+TOLERANCE = 2.0
+MINIMUM_SLOWDOWN = 0.002 # Seconds; smaller differences are just noise
+PLAYER_COUNTS = range(constants.MINIMUM_PLAYERS, synthetic.MAXIMUM_PLAYERS+1)
+PASSWORD = 'benchmark'
+
+def measure(function, setup=None, repeat=3, number=1):
+    """
+    Best time (in seconds) of a call to function, and the number of queries
+    it makes. When setup is given, function is called with what it returns,
+    which isn't measured
+    """
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True # As in TestCase.assertNumQueries
+    # Requests would reset the query log
+    signals.request_started.disconnect(reset_queries)
+    try:
+        best, queries = None, 0
+        for _ in range(repeat):
+            args = setup() if setup is not None else ()
+            before = len(connection.queries)
+            start = time.time()
+            for _ in range(number):
+                function(*args)
+            elapsed = (time.time() - start) / number
+            best = elapsed if best is None else min(best, elapsed)
+            queries = max(queries, (len(connection.queries) - before) // number)
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+        signals.request_started.connect(reset_queries)
+    return best, queries
+
+def create_game(players, seed=0, turns=constants.TURN_COUNT+2):
+    """
+    A game with players, played by random bots for the given turns (by
+    default, into the second age). Users can log in with PASSWORD
+    """
+    random.seed(seed) # Cities and hands
+    game = Game.objects.create()
+    game.allowed_variants.add(*Variant.objects.all())
+    for n in range(players):
+        user = User(username='bench%d-%d' % (game.id, n))
+        user.set_password(PASSWORD)
+        user.save()
+        game.join(user)
+    game.start()
+    state = game.snapshot()
+    policy = engine.random_policy(random.Random(seed))
+    for _ in range(turns):
+        for p in state.players:
+            p.play(*policy(p))
+    game.save_snapshot(state)
+    return Game.objects.get(pk=game.pk)
+
+def pick_actions(game, seed=0):
+    """Have every player in game pick an action, without ending the turn"""
+    state = game.snapshot()
+    policy = engine.random_policy(random.Random(seed))
+    for p in state.players:
+        action, option, left, right = policy(p)
+        Player.objects.filter(pk=p.id).update(action=action, option_picked=option, trade_left=left, trade_right=right)
+    return Game.objects.get(pk=game.pk)
+
+def clear_cache():
+    """Setup for measuring pages uncached (the play page is cached by game version)"""
+    views.cache.clear()
+    return ()
+
+def bench_get_payments():
+    """economy.get_payments, by number of local and neighbor producers"""
+    for producers in (2, 6, 10):
+        for neighbor_producers in (2, 6, 10):
+            problem = benchmarks.late_age_layout(producers=producers, neighbor_producers=neighbor_producers)
+            yield 'get_payments/producers=%d/neighbors=%d' % (producers, neighbor_producers), measure(
+                lambda: economy.get_payments(*problem), number=10
+            )
+
+def bench_science():
+    """science.science_score, by number of science effects"""
+    rng = random.Random(0)
+    for effects in (3, 6, 9, 12):
+        choices = [rng.sample(synthetic.SCIENCES, rng.choice([1, 1, 2, 3])) for _ in range(effects)]
+        yield 'science_score/effects=%d' % effects, measure(
+            lambda: science.science_score(choices, synthetic.SCIENCES), number=10
+        )
+
+def bench_players(games):
+    """Player.science_score and Player.score, for a fresh player of each game"""
+    for players, game in games:
+        pk = game.player_set.all()[0].pk
+        setup = lambda: (Player.objects.get(pk=pk),)
+        yield 'Player.science_score/players=%d' % players, measure(Player.science_score, setup)
+        yield 'Player.score/players=%d' % players, measure(Player.score, setup)
+
+def bench_end_of_turn(player_counts):
+    """Game.end_of_turn, once every player has picked an action"""
+    for players in player_counts:
+        yield 'Game.end_of_turn/players=%d' % players, measure(
+            Game.end_of_turn, lambda: (pick_actions(create_game(players)),)
+        )
+
+def bench_views(games):
+    """The play and score pages, as seen by the first player of each game"""
+    client = Client()
+    for players, game in games:
+        player = game.player_set.select_related('user').all()[0]
+        client.login(username=player.user.username, password=PASSWORD)
+        for name in ('game-play', 'game-score'):
+            url = reverse(name, kwargs={'pk': game.pk})
+            def get():
+                response = client.get(url)
+                assert response.status_code == 200, (url, response.status_code)
+            yield 'view %s/players=%d' % (name, players), measure(get, clear_cache)
+        client.logout()
+
+def run(player_counts=PLAYER_COUNTS):
+    """
+    Run every benchmark, yielding (name, (seconds, queries)). Needs rules
+    in the database, as made by synthetic.create_rules
+    """
+    catalog.get() # Loading the rules isn't measured
+    games = [(players, create_game(players)) for players in player_counts]
+    for results in (
+        bench_get_payments(),
+        bench_science(),
+        bench_players(games),
+        bench_end_of_turn(player_counts),
+        bench_views(games),
+    ):
+        for result in results:
+            yield result
+
+def load_baseline(path=BASELINE):
+    """Stored results, as a dict {name: (seconds, queries)}"""
+    with open(path) as f:
+        return dict((name, tuple(result)) for name, result in simplejson.load(f).items())
+
+def save_baseline(results, path=BASELINE):
+    """Store results (as yielded by run) as the baseline"""
+    with open(path, 'w') as f:
+        results = dict((name, (round(seconds, 6), queries)) for name, (seconds, queries) in results)
+        simplejson.dump(results, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+    """Messages for the results that are worse than in baseline"""
+    for name, (seconds, queries) in results:
+        if name not in baseline:
+            continue
+        old_seconds, old_queries = baseline[name]
+        if queries > old_queries:
+            yield "%s: %d queries, %d in the baseline" % (name, queries, old_queries)
+        if seconds > old_seconds * tolerance and seconds - old_seconds > MINIMUM_SLOWDOWN:
+            yield "%s: %.4fs, %.4fs in the baseline" % (name, seconds, old_seconds)
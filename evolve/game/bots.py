@@ -0,0 +1,66 @@
+"""
+Bots, to play games on the engine without people (see engine.play_game).
+
+A bot is a function taking a random.Random and returning a policy: a
+function that, given an engine.PlayerState that has to play, returns the
+arguments for its play method, (action, option, trade_left, trade_right).
+Bots must only use the random generator given, so games can be repeated.
+"""
+from django.utils.importlib import import_module
+
+from evolve.game import engine
+
+def random_bot(rng):
+    """Picks an option at random, builds it with the cheapest payment if possible, sells it otherwise"""
+    return engine.random_policy(rng)
+
+def seller(rng):
+    """Always sells a random option. A baseline for the others"""
+    def policy(player):
+        return engine.SELL_ACTION, rng.choice(player.hand), 0, 0
+    return policy
+
+def cheapest(rng):
+    """Builds whatever needs the least money for trade; sells if nothing can be built"""
+    def policy(player):
+        rules = player.game.rules
+        best, choice = None, (engine.SELL_ACTION, rng.choice(player.hand), 0, 0)
+        for option in player.hand:
+            payments = player.payment_options(rules.option(option).building)
+            if payments:
+                left, right = payments[0].trade_costs()
+                # Ties are broken at random
+                key = (left+right, rng.random())
+                if best is None or key < best:
+                    best, choice = key, (engine.BUILD_ACTION, option, left, right)
+        return choice
+    return policy
+
+def specials(rng):
+    """Builds the next special whenever possible; otherwise, like cheapest"""
+    fallback = cheapest(rng)
+    def policy(player):
+        special = player.next_special()
+        if special is not None:
+            payments = player.payment_options(special)
+            if payments:
+                left, right = payments[0].trade_costs()
+                return engine.SPECIAL_ACTION, rng.choice(player.hand), left, right
+        return fallback(player)
+    return policy
+
+BOTS = {
+    'random': random_bot,
+    'seller': seller,
+    'cheapest': cheapest,
+    'specials': specials,
+}
+
+def get_bot(name):
+    """The bot called name in BOTS, or a function given by its dotted path"""
+    if name in BOTS:
+        return BOTS[name]
+    module, _, function = name.rpartition('.')
+    if not module:
+        raise ValueError("Unknown bot %r" % name)
+    return getattr(import_module(module), function)
@@ -0,0 +1,829 @@
+"""
+Game engine: the rules of the game, on in-memory state.
+
+A GameState holds a game and all its players; it can be played from start
+to end without a database, which is what simulations do (see new_game and
+play_game), and it is also how the game models resolve turns: Game.snapshot
+loads a GameState with a fixed number of queries, the turn is resolved on it
+and Game.save_snapshot writes the changes back with a fixed number of
+statements.
+
+Rules are read from a rules snapshot, a catalog.Catalog given when creating
+the GameState (the current one by default). The rules for players are in
+PlayerRules, shared by the Player model and PlayerState, so both compute
+things the same way.
+"""
+import random
+import collections
+
+from evolve.rules.models import Score, BuildOption, TRADEABLE, KINDS, KIND_INDEX
+from evolve.rules import constants, economy, science, catalog
+from evolve.game import profiling
+
+BUILD_ACTION = 'build'
+FREE_ACTION = 'free'
+SELL_ACTION = 'sell'
+SPECIAL_ACTION = 'spec'
+
+
+class PlayerRules(object):
+    """
+    Game rules for a player. Subclasses have city_id, variant_id, money and
+    specials_built attributes, and define:
+     - built_buildings(): the buildings built, as catalog BuildingInfos
+     - left_player(), right_player(): the neighbors
+     - count(kind) and defeats(), as used by effects
+     - effects(): an ActiveEffects with active_effects(); it may be kept
+       until the player builds something
+     - battle_results(): objects with a score() method
+     - free_building_used(): True if the free building ability was already
+       used in the current age
+     - game_started()
+     - rules(): the catalog.Catalog in use
+    """
+    __slots__ = ()
+
+    def built_specials(self):
+        """Specials built by this player, as catalog CitySpecialInfos"""
+        return self.rules().built_specials(self.city_id, self.variant_id, self.specials_built)
+
+    def all_specials(self):
+        """The complete list of specials for our city+variant"""
+        return self.rules().specials(self.city_id, self.variant_id)
+
+    def next_special(self):
+        """
+        Next special to build (a catalog CitySpecialInfo), None if all built
+        """
+        return self.rules().next_special(self.city_id, self.variant_id, self.specials_built)
+
+    def specials(self):
+        """Number of specials built"""
+        return self.specials_built
+
+    def built_building_ids(self):
+        """Ids of the buildings built"""
+        return set(b.id for b in self.built_buildings())
+
+    def active_effects(self):
+        """The list of effects which apply to this player, as catalog EffectInfos"""
+        # City specials
+        effects = [s.effect for s in self.built_specials()]
+        # Building effects
+        effects.extend(b.effect for b in self.built_buildings())
+        return effects
+
+    def effects(self):
+        """ActiveEffects for this player"""
+        return ActiveEffects(self.active_effects())
+
+    def tradeable_resources(self):
+        """
+        List of resources that can be bought by neighbors; note that not
+        every resource available is tradeable.
+
+        This a [[(amount, resource)]]. Inner list are alternative resources
+        """
+        # Basic city resource is tradeable
+        result = [[(1, self.rules().city(self.city_id).resource)]]
+        # Add in production of resources by tradeable kinds of buildings
+        for b in self.built_buildings():
+            if b.kind in TRADEABLE and b.effect.production:
+                result.append(b.effect.production.to_list())
+        return result
+
+    def trade_costs(self, direction):
+        """
+        Costs of trading with player in given direction ('l' or 'r')
+
+        dict of resource_name -> money
+        """
+        assert direction in ('l', 'r')
+        return self.effects().trade_costs(direction)
+
+    def local_production(self):
+        """
+        List of resources produced by every local effect (not counting trade)
+
+        This a [[(amount, resource)]]. Inner list are alternative resources
+        """
+        # Basic city resource is local production
+        result = [[(1, self.rules().city(self.city_id).resource)]]
+        result.extend(self.effects().production)
+        return result
+
+    def local_producers(self):
+        """
+        Same as local_production, as alternatives of RESOURCES ids (see
+        economy.ResourceIndex.production), without producers of just money
+        """
+        return (self.rules().city(self.city_id).production,) + self.effects().producers
+
+    def tradeable_producers(self):
+        """Same as tradeable_resources, as alternatives of RESOURCES ids"""
+        result = [self.rules().city(self.city_id).production]
+        for b in self.built_buildings():
+            if b.kind in TRADEABLE and b.effect.production:
+                result.append(b.effect.production.alternatives)
+        return result
+
+    def can_build_free(self):
+        """
+        True if player can use the 'free building' effect. Needs to have the
+        effect available, and not already used in this age.
+        """
+        # This only makes sense on started games
+        if not self.game_started(): return False
+        # Check that the player has the free build ability
+        if not self.effects().free_building: return False
+        # Check that the effect hasn't been already used
+        if self.free_building_used(): return False
+        # Otherwise, the effect can be used
+        return True
+
+    def can_build_special(self):
+        """
+        True if player can use the 'build special' action. Needs to have an
+        available special, and resources to pay for it
+        """
+        # This only makes sense on started games
+        if not self.game_started(): return False
+        # Check that there is a next special to build
+        special = self.next_special()
+        if special is None: return False
+        # Check that the player can pay for the special
+        return bool(self.payment_options(special))
+
+    def military(self):
+        """Military power"""
+        return self.effects().military
+
+    def science_score(self):
+        """Amount of science points"""
+        return science.science_score(self.effects().sciences, self.rules().sciences)
+
+    def score(self):
+        """Score for this player"""
+        treasury_score = self.money // 3
+
+        military_score = sum(b.score(self.rules()) for b in self.battle_results())
+
+        left, right = self.left_player(), self.right_player()
+        special_score = sum(s.effect.get_score(self, left, right) for s in self.built_specials())
+
+        # Accumulate building effects
+        result = Score.new()._replace(
+            treasury=treasury_score,
+            military=military_score,
+            special=special_score,
+            science=self.science_score()
+        )
+        for b in self.built_buildings():
+            result = result + b.score(self, left, right)
+
+        return result
+
+    def payment_options(self, item, stats=None):
+        """
+        List of ways of paying for item.cost. Empty if unpayable
+
+        item is a catalog BuildingInfo or CitySpecialInfo. stats is passed on
+        to economy.get_payments_by_id
+        """
+        # Only buildings can be already built, or made free by others
+        if hasattr(item, 'free_having'):
+            built = self.built_building_ids()
+            # Can't be bought if we already have it
+            if item.id in built:
+                return []
+            # Check if we have a dependency of this item that makes it free:
+            if not item.free_having.isdisjoint(built):
+                # You can get it for free. No more options needed
+                return [economy.PaymentOption()]
+        effects = self.effects()
+        return economy.get_payments_by_id(
+            item.cost.money,
+            item.cost.requirements,
+            self.money,
+            self.local_producers(),
+            self.left_player().tradeable_producers(),
+            effects.trade_table('l'),
+            self.right_player().tradeable_producers(),
+            effects.trade_table('r'),
+            stats=stats,
+        )
+
+
+class ActiveEffects(object):
+    """
+    The effects which apply to a player (catalog EffectInfos), with what
+    the rules need from them added up: military power, trade costs by
+    direction (dicts of resource name -> money, only for the discounted
+    resources), production alternatives (also as RESOURCES ids, in
+    producers) and science choices
+    """
+    __slots__ = ('effects', 'military', 'left_trade', 'right_trade', 'production', 'producers', 'sciences', 'free_building', 'tables')
+
+    def __init__(self, effects):
+        self.effects = ()
+        self.military = 0 # Just the sum of the military powers of each effect
+        self.left_trade, self.right_trade = {}, {}
+        self.production = self.producers = ()
+        # Sciences available at each effect; effects without any are ignored
+        self.sciences = ()
+        self.free_building = False
+        self.tables = {} # Compiled trade costs by direction; see trade_table
+        for e in effects:
+            self.add(e)
+
+    def plus(self, effect):
+        """
+        A copy with one more effect, as when building something. Compiled
+        trade costs are kept for the directions where they don't change
+        """
+        result = ActiveEffects(())
+        for name in self.__slots__:
+            setattr(result, name, getattr(self, name))
+        result.left_trade, result.right_trade, result.tables = dict(self.left_trade), dict(self.right_trade), dict(self.tables)
+        result.add(effect)
+        return result
+
+    def add(self, effect):
+        """Add one more effect"""
+        self.effects += (effect,)
+        self.military += effect.military
+        for direction, costs, applies in (('l', self.left_trade, effect.left_trade), ('r', self.right_trade, effect.right_trade)):
+            if applies:
+                for _, resource in effect.trade.to_list():
+                    # Pick the better value for each resource
+                    costs[resource] = min(costs.get(resource, constants.DEFAULT_TRADE_COST), effect.trade.money)
+                self.tables.pop(direction, None)
+        if effect.production:
+            self.production += (effect.production.to_list(),)
+            if effect.production.alternatives:
+                self.producers += (effect.production.alternatives,)
+        self.sciences += (effect.sciences,)
+        self.free_building = self.free_building or effect.free_building
+
+    def trade_costs(self, direction):
+        """Same as PlayerRules.trade_costs"""
+        costs = self.left_trade if direction == 'l' else self.right_trade
+        return collections.defaultdict(lambda: constants.DEFAULT_TRADE_COST, costs)
+
+    def trade_table(self, direction):
+        """
+        Trade costs in direction ('l' or 'r') as an array indexed by
+        resource id, as used by the payment solver. Compiled on first use,
+        and again only if more resources got ids since
+        """
+        table = self.tables.get(direction)
+        if table is None or len(table) != len(economy.RESOURCES):
+            table = self.tables[direction] = economy.RESOURCES.unit_costs(self.trade_costs(direction))
+        return table
+
+    def keep_tables(self, previous):
+        """
+        Take the compiled trade costs of previous, ActiveEffects of the same
+        player, for the directions where trade costs are the same
+        """
+        for direction, table in previous.tables.items():
+            if direction == 'l' and self.left_trade == previous.left_trade:
+                self.tables[direction] = table
+            elif direction == 'r' and self.right_trade == previous.right_trade:
+                self.tables[direction] = table
+
+
+class SeatRing(object):
+    """
+    Players of a game in seat order, with the seats of the neighbors of
+    each one precomputed, so neighbors are found without going through the
+    database. players can be any objects with an id
+    """
+
+    def __init__(self, players):
+        self.players = list(players)
+        n = len(self.players)
+        self.seats = dict((p.id, i) for i, p in enumerate(self.players))
+        self.lefts = [(i-1) % n for i in range(n)]
+        self.rights = [(i+1) % n for i in range(n)]
+
+    def __len__(self):
+        return len(self.players)
+
+    def __iter__(self):
+        return iter(self.players)
+
+    def left(self, player):
+        return self.players[self.lefts[self.seats[player.id]]]
+
+    def right(self, player):
+        return self.players[self.rights[self.seats[player.id]]]
+
+    def all_right(self, player):
+        """
+        Every player except player and its left neighbor, starting at its
+        right and going around to the right
+        """
+        seat, n = self.seats[player.id], len(self.players)
+        return [self.players[(seat+i) % n] for i in range(1, n-1)]
+
+
+class BattleResultRules(object):
+    """Rules for battle results. Subclasses have age_id and result attributes"""
+    __slots__ = ()
+
+    def score(self, rules=None):
+        age = (rules or catalog.get()).age(self.age_id)
+        if self.result == 'v':
+            return age.victory_score
+        else:
+            return age.defeat_score
+
+
+class BattleResultState(BattleResultRules):
+    __slots__ = ('age_id', 'direction', 'result')
+
+    def __init__(self, age_id, direction, result):
+        self.age_id = age_id
+        self.direction = direction
+        self.result = result
+
+
+class PlayerState(PlayerRules):
+    """
+    A player, as part of a GameState. Buildings, hand and free ages are ids;
+    changes that need to be written back are also kept in the new_* lists
+    """
+
+    def __init__(self, game, id, city_id, variant_id,
+                 money=constants.INITIAL_MONEY, specials_built=0,
+                 action='', option_picked=None, trade_left=0, trade_right=0,
+                 buildings=(), hand=(), free_ages=(), battle_results=(), score=None):
+        self.game = game
+        self.id = id
+        self.city_id = city_id
+        self.variant_id = variant_id
+        self.money = money
+        self.specials_built = specials_built
+        # Decisions for this turn; option_picked is a BuildOption id
+        self.action = action
+        self.option_picked = option_picked
+        self.trade_left = trade_left
+        self.trade_right = trade_right
+        self.buildings = list(buildings) # Building ids
+        self.hand = list(hand) # BuildOption ids
+        self.free_ages = set(free_ages) # Age ids
+        self.results = list(battle_results) # BattleResultStates
+        # Buildings of each kind, by KIND_INDEX, and defeats; kept up to
+        # date by build and add_battle_result so effects can count cheaply
+        self.kind_counts = [0] * len(KINDS)
+        for b in self.built_buildings():
+            self.kind_counts[KIND_INDEX[b.kind]] += 1
+        self.defeat_count = sum(1 for r in self.results if r.result == 'd')
+        # Score without treasury, None when it needs to be computed again;
+        # see score and scores_changed
+        self.running_score = score
+        self.left = self.right = self # Set by GameState.add_player
+        self.payments = {} # payment_options results, by item; see forget_payments
+        self.active = None # ActiveEffects, None until needed; see forget_effects
+        self.stale = None # The ActiveEffects forgotten, to keep its trade tables
+        self.tradeable = None # tradeable_producers, None until needed; see build
+        # Changes since the snapshot was taken
+        self.new_buildings = []
+        self.new_free_ages = []
+        self.new_results = []
+
+    def __repr__(self):
+        return "<PlayerState %s>" % self.id
+
+    def rules(self):
+        return self.game.rules
+
+    def built_buildings(self):
+        rules = self.game.rules
+        return [rules.building(id) for id in self.buildings]
+
+    def built_building_ids(self):
+        return self.buildings
+
+    def left_player(self):
+        return self.left
+
+    def right_player(self):
+        return self.right
+
+    def count(self, kind):
+        """Number of buildings of a given kind (a BuildingKind or its name)"""
+        return self.kind_counts[KIND_INDEX[getattr(kind, 'name', kind)]]
+
+    def defeats(self):
+        """Number of defeats suffered"""
+        return self.defeat_count
+
+    def battle_results(self):
+        return self.results
+
+    def free_building_used(self):
+        return self.game.age_id in self.free_ages
+
+    def game_started(self):
+        return self.game.started
+
+    def score(self):
+        """
+        Same as PlayerRules.score. Only computed again after something it
+        depends on changes; treasury, which is just money, is always
+        computed
+        """
+        if self.running_score is None:
+            self.running_score = PlayerRules.score(self)._replace(treasury=0)
+        return self.running_score._replace(treasury=self.money // 3)
+
+    def scores_changed(self):
+        """
+        Forget the running scores of this player and its neighbors; needed
+        whenever buildings, specials or defeats of this player change
+        """
+        self.running_score = self.left.running_score = self.right.running_score = None
+
+    def payment_options(self, item):
+        """
+        Same as PlayerRules.payment_options, remembered until something it
+        depends on changes. The same payments are usually needed to choose
+        what to play, to check the choice and to pay at the end of turn
+        """
+        result = self.payments.get(item)
+        if result is None:
+            profile = self.game.profile
+            if profile is profiling.NO_PROFILE:
+                # Most payments take about as long as entering the profile
+                result = PlayerRules.payment_options(self, item)
+            else:
+                with profile.call('payment_options', player=self.id) as stats:
+                    result = PlayerRules.payment_options(self, item, stats)
+            self.payments[item] = result
+        return result
+
+    def effects(self):
+        """
+        Same as PlayerRules.effects, kept up to date when building, and
+        until a special is built
+        """
+        if self.active is None:
+            self.active = PlayerRules.effects(self)
+            if self.stale is not None:
+                self.active.keep_tables(self.stale)
+                self.stale = None
+        return self.active
+
+    def forget_effects(self):
+        """
+        Discard the ActiveEffects kept; needed when building specials.
+        Compiled trade costs are kept if they don't change
+        """
+        if self.active is not None:
+            self.stale = self.active
+        self.active = None
+
+    def tradeable_producers(self):
+        """
+        Same as PlayerRules.tradeable_producers, kept until something is
+        built. Neighbors need it for every payment
+        """
+        if self.tradeable is None:
+            self.tradeable = PlayerRules.tradeable_producers(self)
+        return self.tradeable
+
+    def forget_payments(self):
+        """
+        Discard the payments remembered; needed whenever money, buildings
+        or specials of this player, or tradeable buildings of its neighbors,
+        change
+        """
+        self.payments.clear()
+
+    def build(self, building_id):
+        building = self.game.rules.building(building_id)
+        self.buildings.append(building_id)
+        self.new_buildings.append(building_id)
+        # Building effects go after the others, where the new one belongs
+        if self.active is not None:
+            self.active = self.active.plus(building.effect)
+        self.forget_payments()
+        kind = building.kind
+        self.kind_counts[KIND_INDEX[kind]] += 1
+        self.scores_changed()
+        if kind in TRADEABLE:
+            self.tradeable = None
+            self.left.forget_payments()
+            self.right.forget_payments()
+
+    def add_battle_result(self, direction, result):
+        battle_result = BattleResultState(self.game.age_id, direction, result)
+        self.results.append(battle_result)
+        self.new_results.append(battle_result)
+        if result == 'd':
+            self.defeat_count += 1
+        self.scores_changed()
+
+    def pay_trade(self):
+        """Pay neighbors for the trade used this turn"""
+        self.left.money += self.trade_left
+        self.right.money += self.trade_right
+        self.money -= self.trade_left + self.trade_right
+
+    def play(self, action, option, trade_left=0, trade_right=0):
+        """
+        Choose the action to play with option (a BuildOption id) this turn.
+        Same preconditions as Player.play; the turn ends once everyone has
+        played
+        """
+        assert not self.action and not self.game.finished
+        assert action in (BUILD_ACTION, FREE_ACTION, SELL_ACTION, SPECIAL_ACTION)
+        assert option in self.hand
+        self.action = action
+        self.option_picked = option
+        self.trade_left = trade_left
+        self.trade_right = trade_right
+        self.game.turn_check()
+
+    def pre_apply_action(self):
+        """
+        Pre-apply action played
+        (actions are applied in two phases)
+        """
+        assert self.action
+        rules = self.game.rules
+        if self.action in (BUILD_ACTION, SPECIAL_ACTION):
+            if self.action == BUILD_ACTION:
+                item = rules.building(rules.option(self.option_picked).building.id)
+            else:
+                item = self.next_special()
+            # Check payment. This needs to be done before building, so raising
+            # a commercial building does not affect its own price, and building
+            # a resource does not allow to pay for itself.
+            # Anyway, build options should try to avoid that happening
+            payment = economy.can_pay(
+                self.payment_options(item),
+                self.trade_left,
+                self.trade_right
+            )
+            assert payment is not None
+            # Pay local money. Trade is handled later
+            self.money -= payment.money
+            self.forget_payments()
+        # Buildings need to be added first, so applied effects related to
+        # existing buildings count other buildings built in the same turn
+        if self.action in (BUILD_ACTION, FREE_ACTION):
+            self.build(rules.option(self.option_picked).building.id)
+
+    def apply_action(self):
+        """Apply action played"""
+        assert self.action
+        rules = self.game.rules
+        if self.action == SELL_ACTION:
+            # Sell: discard the option
+            self.game.discard(self.option_picked)
+            # Get money
+            self.money += constants.SELL_VALUE
+        elif self.action == BUILD_ACTION:
+            # Pay!
+            self.pay_trade()
+            # Earn money if building produces money
+            self.money += rules.option(self.option_picked).building.effect.money(self, self.left, self.right)
+        elif self.action == FREE_ACTION:
+            assert self.game.age_id not in self.free_ages
+            # "Pay" with one use of the ability. No actual costs, but ability is disabled for this age
+            self.free_ages.add(self.game.age_id)
+            self.new_free_ages.append(self.game.age_id)
+            # Earn money if building produces money
+            self.money += rules.option(self.option_picked).building.effect.money(self, self.left, self.right)
+        elif self.action == SPECIAL_ACTION:
+            special = self.next_special()
+            # Pay!
+            self.pay_trade()
+            # Earn money if building produces money
+            self.money += special.effect.money(self, self.left, self.right)
+            # "Build"
+            self.specials_built = special.order + 1
+            self.forget_effects()
+            self.scores_changed()
+        else:
+            raise AssertionError
+        # Option no longer available
+        self.hand.remove(self.option_picked)
+        self.game.hands_changed = True
+
+    def reset_action(self):
+        self.action = ''
+        self.option_picked = None
+        self.trade_left = 0
+        self.trade_right = 0
+
+
+def deal_seed(seed, age):
+    """Seed for dealing age (id) in a game with the given seed"""
+    return seed * 1000003 + age
+
+
+class GameState(object):
+    """
+    A game and all its players, in seat order. discards and hands_changed
+    keep track of the changes that need to be written back
+    """
+
+    def __init__(self, id, age_id, turn=1, started=False, finished=False, rules=None, rng=random, seed=None):
+        self.id = id
+        self.rules = rules or catalog.get()
+        self.rng = rng # Used for shuffling; random.Random or the random module
+        self.seed = seed # If given, shuffling uses it instead; see deal_rng
+        self.age_id = age_id
+        self.turn = turn
+        self.started = started
+        self.finished = finished
+        self.players = []
+        self.discards = [] # BuildOption ids discarded since the snapshot
+        self.hands_changed = False
+        self.final_scores = None # Scores by player id, set when the game finishes
+        self.profile = profiling.NO_PROFILE # Set to a TurnProfile to profile the next turn
+
+    def add_player(self, **kwargs):
+        """Add a PlayerState at the next seat; kwargs as for PlayerState"""
+        player = PlayerState(self, **kwargs)
+        self.players.append(player)
+        # Seats are a ring
+        for i, p in enumerate(self.players):
+            p.left = self.players[i-1]
+            p.right = self.players[(i+1) % len(self.players)]
+        return player
+
+    def missing_players(self):
+        """Players who haven't played yet"""
+        return [p for p in self.players if not p.action]
+
+    def turn_check(self):
+        """Checks if we need to do end of turn"""
+        if not self.missing_players():
+            self.end_of_turn()
+
+    def player(self, id):
+        for p in self.players:
+            if p.id == id:
+                return p
+        raise KeyError(id)
+
+    def age(self):
+        return self.rules.age(self.age_id)
+
+    def scoreboard(self):
+        """List of (player id, Score) for every player, in seat order"""
+        return [(p.id, p.score()) for p in self.players]
+
+    def discard(self, option):
+        """Discard one option (id)"""
+        self.discards.append(option)
+
+    def deal_rng(self):
+        """
+        Random generator for dealing the current age. With a seed it's
+        seeded from it and the age, so any deal can be reproduced
+        """
+        if self.seed is None:
+            return self.rng
+        return random.Random(deal_seed(self.seed, self.age_id))
+
+    def shuffle(self):
+        """Assign to each player the build options"""
+        assert self.started
+        assert not self.finished
+
+        n = len(self.players)
+        required_options = n * constants.INITIAL_OPTIONS
+
+        rng = self.deal_rng()
+        options, personalities = map(list, self.rules.deal(self.age_id, n))
+        rng.shuffle(options)
+        rng.shuffle(personalities)
+
+        # Check that there are enough options for everyone
+        if len(options)+len(personalities) < required_options:
+            raise BuildOption.DoesNotExist
+
+        # Figure out how many personalities to use
+        required_personalities = required_options - len(options)
+        recommended_personalities = 2+n
+        #   actual = Clip recommended in range [required..available]
+        actual_personalities = min(max(recommended_personalities, required_personalities), len(personalities))
+
+        # Remove unused personalities
+        del personalities[actual_personalities:]
+        # Remove unused options, replace by personalities
+        options[required_options-len(personalities):] = personalities
+        # Reshuffle, to mix personalities and the rest of the options
+        rng.shuffle(options)
+
+        # Now the set of options is built. Assign
+        assert len(options) == required_options
+        for p in self.players:
+            assert not p.hand # No options when shuffling
+            p.hand = options[:constants.INITIAL_OPTIONS]
+            del options[:constants.INITIAL_OPTIONS]
+        self.hands_changed = True
+
+    def end_of_age(self):
+        # discard cards for all players
+        for p in self.players:
+            self.discards.extend(p.hand)
+            p.hand = []
+        self.hands_changed = True
+        # Battles
+        for p in self.players:
+            local = p.military()
+            for neighbor, d in zip((p.left, p.right), 'lr'):
+                foreign = neighbor.military()
+                if local != foreign: # There was a winner
+                    p.add_battle_result(d, 'v' if local > foreign else 'd')
+        next_age = self.age().next
+        if next_age is None:
+            self.finished = True
+            self.final_scores = dict(self.scoreboard())
+        else:
+            # Increase age
+            self.age_id = next_age.id
+            self.turn = 1
+            # new cards
+            self.shuffle()
+
+    def end_of_turn(self):
+        # Apply all player actions, in two stages
+        profile = self.profile
+        for p in self.players:
+            with profile.call('pre_apply_action', player=p.id, action=p.action):
+                p.pre_apply_action()
+        for p in self.players:
+            with profile.call('apply_action', player=p.id, action=p.action):
+                p.apply_action()
+        # Money changed for everyone
+        for p in self.players:
+            p.forget_payments()
+        # Rotate available options
+        hands = [p.hand for p in self.players]
+        direction = self.age().direction
+        if direction=='l':
+            hands = hands[1:]+hands[:1]
+        else:
+            assert direction=='r'
+            hands = hands[-1:]+hands[:-1]
+        for p, hand in zip(self.players, hands):
+            p.hand = hand
+        self.hands_changed = True
+        # increase turn counter
+        self.turn += 1
+        if self.turn > constants.TURN_COUNT:
+            self.end_of_age()
+        # Reset players so they can play again
+        for p in self.players:
+            p.reset_action()
+
+
+def new_game(seats, rules=None, rng=random):
+    """
+    A started GameState, with a player on each of seats, a list of
+    (city id, variant id). Players get ids 1, 2... by seat. Nothing is
+    stored anywhere; the game has no id
+    """
+    game = GameState(None, (rules or catalog.get()).first_age.id, started=True, rules=rules, rng=rng)
+    for n, (city, variant) in enumerate(seats):
+        game.add_player(id=n+1, city_id=city, variant_id=variant)
+    game.shuffle()
+    return game
+
+def random_seats(players, rules=None, rng=random):
+    """Seats for new_game: different cities at random, with random variants"""
+    rules = rules or catalog.get()
+    cities = rng.sample(sorted(rules.cities), players)
+    return [(city, rng.choice(rules.variants)) for city in cities]
+
+def play_game(game, policy):
+    """
+    Play game until it finishes; policy(player) gives the arguments for
+    player.play (action, option, trade_left, trade_right). Returns game
+    """
+    while not game.finished:
+        for player in game.missing_players():
+            player.play(*policy(player))
+    return game
+
+def random_policy(rng=random):
+    """
+    A policy for play_game: pick an option at random, and build it with the
+    cheapest payment if possible; sell it otherwise
+    """
+    def policy(player):
+        option = rng.choice(player.hand)
+        payments = player.payment_options(player.game.rules.option(option).building)
+        if payments:
+            left, right = payments[0].trade_costs()
+            return BUILD_ACTION, option, left, right
+        return SELL_ACTION, option, 0, 0
+    return policy
@@ -1,6 +1,6 @@
 from django import forms
 
-from evolve.rules.models import Variant, BuildOption
+from evolve.rules.models import Variant
 from evolve.game.models import Game, Player
 
 class NewGameForm(forms.ModelForm):
@@ -26,25 +26,21 @@ def _payment_coerce(value):
     return id,l,r
 
 
-class OptionField(forms.ModelChoiceField):
-
-    def label_from_instance(self, obj):
-        return "%s" % obj.building
-
 class PlayForm(forms.Form):
 
-    option = OptionField(
-        queryset=BuildOption.objects.none(),
-        empty_label=None,
+    # Choices are set by the view: (BuildOption id, building name)
+    option = forms.TypedChoiceField(
+        choices=(),
+        coerce=int,
         widget = forms.RadioSelect)
     action = forms.ChoiceField(Player.ACTIONS)
-    payment = forms.TypedChoiceField(choices=(), coerce=_payment_coerce, required=False)
+    payment = forms.TypedChoiceField(choices=(), coerce=_payment_coerce, required=False, empty_value=(0,0,0))
 
     def clean(self):
         payment = self.cleaned_data.get('payment')
         option = self.cleaned_data.get('option')
         action = self.cleaned_data.get('action')
         if payment and option and action:
-            if (payment[0] == -1 and action != Player.SPECIAL_ACTION) or (option.id != payment[0] and action==Player.BUILD_ACTION):
+            if (payment[0] == -1 and action != Player.SPECIAL_ACTION) or (option != payment[0] and action==Player.BUILD_ACTION):
                 raise forms.ValidationError("That is not a valid payment for the selected option")
         return self.cleaned_data
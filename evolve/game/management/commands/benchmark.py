@@ -0,0 +1,39 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from evolve.rules import synthetic
+from evolve.game import benchmarks
+
+class Command(BaseCommand):
+    help = "Time the game hot paths on a throwaway database, and compare them with a baseline"
+    option_list = BaseCommand.option_list + (
+        make_option('--baseline', default=benchmarks.BASELINE, help="Baseline file"),
+        make_option('--save', action='store_true', default=False, help="Store the results as the new baseline"),
+        make_option('--tolerance', type='float', default=benchmarks.TOLERANCE,
+            help="Fail when a benchmark takes more than this many times its baseline time"),
+    )
+
+    def handle(self, **options):
+        settings.DEBUG = False # As when testing; the debug toolbar would be measured too
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            synthetic.create_rules()
+            results = []
+            for name, (seconds, queries) in benchmarks.run():
+                self.stdout.write("%-48s %9.2fms %4d queries\n" % (name, seconds*1000, queries))
+                results.append((name, (seconds, queries)))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['save']:
+            benchmarks.save_baseline(results, options['baseline'])
+            self.stdout.write("Baseline saved to %s\n" % options['baseline'])
+            return
+        failures = list(benchmarks.regressions(results, benchmarks.load_baseline(options['baseline']), options['tolerance']))
+        if failures:
+            raise CommandError("Regressions against the baseline:\n    " + "\n    ".join(failures))
+        self.stdout.write("No regressions\n")
@@ -0,0 +1,48 @@
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from evolve.rules import constants
+from evolve.game import simulation, bots
+
+class Command(BaseCommand):
+    help = "Play games between bots with the current rules, and store the results for balancing"
+    option_list = BaseCommand.option_list + (
+        make_option('--games', type='int', default=100, help="Number of games to play"),
+        make_option('--players', type='int', default=constants.MINIMUM_PLAYERS, help="Players per game"),
+        make_option('--workers', type='int', default=multiprocessing.cpu_count(), help="Worker processes"),
+        make_option('--seed', type='int', default=0, help="Seed for the run; the same seed plays the same games"),
+        make_option('--bots', default='random',
+            help="Comma separated bots, assigned to seats in turn. One of %s, or the dotted path of a function" % ', '.join(sorted(bots.BOTS))),
+        make_option('--output', default='simulation.dat', help="Results file"),
+    )
+
+    def handle(self, **options):
+        bot_names = options['bots'].split(',')
+        if options['players'] < constants.MINIMUM_PLAYERS:
+            raise CommandError("At least %d players are needed" % constants.MINIMUM_PLAYERS)
+        try:
+            for name in bot_names:
+                bots.get_bot(name)
+        except (ValueError, ImportError, AttributeError), e:
+            raise CommandError(e)
+
+        start = time.time()
+        with open(options['output'], 'wb') as output:
+            rows = simulation.run(
+                output, options['games'], options['players'], bot_names,
+                seed=options['seed'], workers=options['workers'],
+            )
+        elapsed = time.time() - start
+        self.stdout.write("%d games (%d rows) in %.1fs, %.1f games/s. Results in %s\n" % (
+            options['games'], rows, elapsed, options['games'] / elapsed, options['output']
+        ))
+        # Average totals by bot
+        with open(options['output'], 'rb') as input:
+            header, columns = simulation.read_results(input)
+        for n, name in enumerate(bot_names):
+            totals = [t for b, t in zip(columns['bot'], columns['total']) if b == n]
+            if totals:
+                self.stdout.write("    %-12s average score %.1f\n" % (name, float(sum(totals)) / len(totals)))
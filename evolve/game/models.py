@@ -1,26 +1,29 @@
 import random
 import collections
 
-from django.db import models
+from django.db import models, transaction, connection
 from django.contrib.auth.models import User
 
-from evolve.rules.models import (
-    Score,
-    City, CitySpecial, Variant, Age, Building, BuildOption, Effect, Science,
-    PERSONALITY, TRADEABLE
-)
-from evolve.rules import constants, economy
+from evolve.rules.models import Score, City, Variant, Age, Building, BuildOption, KINDS, KIND_INDEX
+from evolve.rules import constants, economy, catalog
+from evolve.game import engine, notify, profiling, turns
 
 
 # Game models where state is kept
 
 class Game(models.Model):
     """A single match of the game, including all global game status"""
+    OPEN, PLAYING, FINISHED = 'o', 'p', 'f'
+    STATUSES = (
+        (OPEN, 'Waiting for players'),
+        (PLAYING, 'Playing'),
+        (FINISHED, 'Finished'),
+    )
     # game settings
     allowed_variants = models.ManyToManyField(Variant)
 
     # game state
-    age = models.ForeignKey(Age, default=Age.first)
+    age = models.ForeignKey(Age, default=catalog.first_age_id)
     turn = models.PositiveIntegerField(default=1)
     discards = models.ManyToManyField(BuildOption, blank=True, null=True)
     
@@ -29,12 +32,43 @@ class Game(models.Model):
     finished = models.BooleanField(default=False)
 
     special_use_discards_turn = models.BooleanField(default=False) # set when a player is picking from the discard pile
+    # Deals are shuffled with this, set when starting; see engine.deal_rng.
+    # Games started without one are dealt with the random module
+    seed = models.PositiveIntegerField(null=True, blank=True)
+
+    # Same as started and finished (see status_for), and the number of
+    # players, kept so the lobby needs no joins or counts. See sql/game.sql
+    # for their indexes. Game logic checks started and finished
+    status = models.CharField(max_length=1, choices=STATUSES, default=OPEN)
+    player_count = models.PositiveIntegerField(default=0)
+
+    # Increased on every change players can see; see notify. Only changed
+    # with UPDATE ... SET version = version + 1, so nothing is lost when
+    # several requests change the game at the same time
+    version = models.PositiveIntegerField(default=0)
+
+    # Log a profile of each turn; see profiling
+    profiled = models.BooleanField(default=False)
+
+    _seats = None # Cached by seats()
+
+    @staticmethod
+    def status_for(started, finished):
+        """The status of a game with the given started and finished flags"""
+        if finished:
+            return Game.FINISHED
+        return Game.PLAYING if started else Game.OPEN
+
+    def save(self, *args, **kwargs):
+        self.status = Game.status_for(self.started, self.finished)
+        super(Game, self).save(*args, **kwargs)
 
     def is_joinable(self, user=None):
         """True if the game has still room for more players and user, is specified, isn't already playing"""
-        available_cities = City.objects.exclude(player__game=self)
+        # Each player gets a different city
+        has_room = self.player_count < len(catalog.get().cities)
         user_not_playing = user is None or not self.get_player(user)
-        return not self.started and bool(available_cities) and bool(user_not_playing)
+        return not self.started and has_room and bool(user_not_playing)
 
     def join(self, user):
         """Make the given user join to this game"""
@@ -53,129 +87,318 @@ class Game(models.Model):
             city=random.choice(available_cities),
         )
         player.save()
+        self._seats = None
+        self.player_count += 1
+        self.changed(player_count=models.F('player_count')+1)
         # TODO: if all cities assigned, game should auto-start?
         
     def is_startable(self):
         """True if game can be started"""
-        return not self.started and self.player_set.count() >= constants.MINIMUM_PLAYERS
+        return not self.started and self.player_count >= constants.MINIMUM_PLAYERS
 
     def start(self):
         """Put the game in its initial state, and ready to play"""
         assert self.is_startable()
         assert not self.finished
-        assert self.age == Age.first()
+        assert self.age_id == catalog.first_age_id()
         assert self.discards.count() == 0
         assert self.turn == 1
         # Start!
         self.started = True
-        self.save()
+        self.status = Game.status_for(self.started, self.finished)
+        self.seed = random.getrandbits(31)
+        Game.objects.filter(pk=self.pk).update(started=True, status=self.status, seed=self.seed)
         # Shuffle build options for this age
         self.shuffle()
     start.alters_data = True
 
     def shuffle(self):
         """Assign to each player the build options"""
-        assert self.started
-        assert not self.finished
-
-        n = self.player_set.count()
-        required_options = n * constants.INITIAL_OPTIONS
-
-        options = list(BuildOption.objects.filter(
-            age=self.age,
-            players_needed__lte=n
-        ).exclude(
-            building__kind__name=PERSONALITY
-        ).order_by('?'))
-        personalities = list(BuildOption.objects.filter(
-            age=self.age,
-            players_needed__lte=n,
-            building__kind__name=PERSONALITY
-        ).order_by('?'))
-
-        # Check that there are enough options for everyone
-        if len(options)+len(personalities) < required_options:
-            raise BuildOption.DoesNotExist
-
-        # Figure out how many personalities to use
-        required_personalities = required_options - len(options)
-        recommended_personalities = 2+n
-        #   actual = Clip recommended in range [required..available]
-        actual_personalities = min(max(recommended_personalities, required_personalities), len(personalities))
-
-        # Remove unused personalities
-        del personalities[actual_personalities:]
-        # Remove unused options, replace by personalities
-        options[required_options-len(personalities):] = personalities
-        # Reshuffle, to mix personalities and the rest of the options
-        random.shuffle(options)
-        
-        # Now the set of options is built. Assign
-        assert len(options) == required_options
-        for p in self.player_set.all():
-            assert not p.current_options.all() # No options when shuffling
-            p.current_options.add(*options[:constants.INITIAL_OPTIONS])
-            del options[:constants.INITIAL_OPTIONS]
+        with transaction.commit_on_success():
+            snapshot = self.snapshot()
+            snapshot.shuffle()
+            self.save_snapshot(snapshot)
+        notify.changed(self.id)
     shuffle.alters_data = True
 
+    def changed(self, **fields):
+        """
+        Increase the version of this game, and wake up requests waiting for
+        it to change. fields are updated in the same statement
+        """
+        Game.objects.filter(pk=self.pk).update(version=models.F('version')+1, **fields)
+        notify.changed(self.pk)
+    changed.alters_data = True
+
+    def seats(self):
+        """
+        engine.SeatRing with the players of this game. It's loaded once and
+        kept until the game changes; its players share this Game instance,
+        so their neighbors are found without any further queries
+        """
+        if self._seats is None:
+            players = list(self.player_set.select_related('user', 'city', 'variant'))
+            for p in players:
+                p.game = self
+            self._seats = engine.SeatRing(players)
+        return self._seats
+
+    def players(self):
+        """Players of this game, in seat order. For template use"""
+        return self.seats().players
+
     def get_player(self, user):
         """Return player for user, or None if user not part of this game"""
-        try:
-            return self.player_set.get(user=user)
-        except Player.DoesNotExist:
-            return None
+        for p in self.seats():
+            if p.user_id == user.id:
+                return p
+        return None
 
-    def end_of_age(self):
-        # discard cards for all players
-        for p in self.player_set.all():
-            self.discards.add(*p.current_options.all())
-            p.current_options.clear()
-        # Battles
+    def snapshot(self):
+        """
+        A engine.GameState with this game and all its players, loaded with a
+        fixed number of queries
+        """
+        result = engine.GameState(self.id, self.age_id, self.turn, self.started, self.finished, seed=self.seed)
+        def by_player(model, field):
+            grouped = collections.defaultdict(list)
+            rows = model.objects.filter(player__game=self).order_by('id').values_list('player', field)
+            for player, value in rows:
+                grouped[player].append(value)
+            return grouped
+        buildings = by_player(Player.buildings.through, 'building')
+        hands = by_player(Player.current_options.through, 'buildoption')
+        free_ages = by_player(Player.special_free_building_ages_used.through, 'age')
+        battle_results = collections.defaultdict(list)
+        rows = BattleResult.objects.filter(owner__game=self).order_by('id').values_list('owner', 'age', 'direction', 'result')
+        for owner, age, direction, outcome in rows:
+            battle_results[owner].append(engine.BattleResultState(age, direction, outcome))
         for p in self.player_set.all():
-            for neighbor, d in zip((p.left_player(), p.right_player()),'lr'):
-                local = p.military()
-                foreign = neighbor.military()
-                if local != foreign: # There was a winner
-                    result = 'v' if local > foreign else 'd'
-                    BattleResult.objects.create(owner=p, direction=d, age=self.age, result=result)
-        next_age = self.age.next()
-        if next_age is None:
-            self.finished = True
-            self.save()
-        else:
-            # Increase age
-            self.age = next_age
-            self.turn = 1
-            # new cards
-            self.save()
-            self.shuffle()
+            result.add_player(
+                id=p.id,
+                city_id=p.city_id,
+                variant_id=p.variant_id,
+                money=p.money,
+                specials_built=p.specials_built,
+                action=p.action,
+                option_picked=p.option_picked_id,
+                trade_left=p.trade_left,
+                trade_right=p.trade_right,
+                buildings=buildings[p.id],
+                hand=hands[p.id],
+                free_ages=free_ages[p.id],
+                battle_results=battle_results[p.id],
+                score=p.stored_score(),
+            )
+        # Who holds each option, as stored; see save_hands
+        result.stored_hands = dict((o, p) for p, hand in hands.items() for o in hand)
+        return result
+
+    def save_snapshot(self, snapshot):
+        """
+        Write back the changes made to snapshot (taken from this game). This
+        takes a fixed number of statements, whatever the number of players
+        and however much changed
+        """
+        players = snapshot.players
+        self.save_players(snapshot)
+        Built = Player.buildings.through
+        Built.objects.bulk_create([Built(player_id=p.id, building_id=b) for p in players for b in p.new_buildings])
+        FreeAge = Player.special_free_building_ages_used.through
+        FreeAge.objects.bulk_create([FreeAge(player_id=p.id, age_id=a) for p in players for a in p.new_free_ages])
+        BattleResult.objects.bulk_create([
+            BattleResult(owner_id=p.id, age_id=r.age_id, direction=r.direction, result=r.result)
+            for p in players for r in p.new_results
+        ])
+        Discard = Game.discards.through
+        Discard.objects.bulk_create([Discard(game_id=self.id, buildoption_id=o) for o in snapshot.discards])
+        if snapshot.hands_changed:
+            self.save_hands(snapshot)
+        for p in players:
+            del p.new_buildings[:], p.new_free_ages[:], p.new_results[:]
+        if snapshot.final_scores is not None:
+            FinalScore.objects.bulk_create([
+                FinalScore(player_id=player, **score._asdict())
+                for player, score in snapshot.final_scores.items()
+            ])
+            snapshot.final_scores = None
+        del snapshot.discards[:]
+        snapshot.hands_changed = False
+        # The game itself
+        self._seats = None # Its players are out of date
+        if snapshot.age_id != self.age_id:
+            self.age = Age.objects.get(pk=snapshot.age_id)
+        self.turn = snapshot.turn
+        self.finished = snapshot.finished
+        self.status = Game.status_for(self.started, self.finished)
+        Game.objects.filter(pk=self.pk).update(
+            age=self.age_id,
+            turn=self.turn,
+            finished=self.finished,
+            status=self.status,
+            version=models.F('version')+1,
+        )
+    save_snapshot.alters_data = True
+
+    def save_players(self, snapshot):
+        """
+        Write back the fields of every player of snapshot in one UPDATE,
+        with a CASE on the player id for each field. Part of save_snapshot
+        """
+        values = [(p.id, (
+            p.money,
+            p.specials_built,
+            p.action,
+            p.option_picked,
+            p.trade_left,
+            p.trade_right,
+            ','.join(map(str, p.kind_counts)),
+            p.defeat_count,
+            ','.join(map(str, p.score()._replace(treasury=0))),
+        )) for p in snapshot.players]
+        if not values:
+            return
+        fields = (
+            'money', 'specials_built', 'action', 'option_picked', 'trade_left',
+            'trade_right', 'kind_counts', 'defeat_count', 'running_score',
+        )
+        qn = connection.ops.quote_name
+        id_column = qn(Player._meta.pk.column)
+        cases = ' '.join(['WHEN %s THEN %s'] * len(values))
+        assignments = ', '.join(
+            "%s = CASE %s %s END" % (qn(Player._meta.get_field(name).column), id_column, cases)
+            for name in fields
+        )
+        params = [value for i in range(len(fields)) for id, row in values for value in (id, row[i])]
+        ids = [id for id, row in values]
+        connection.cursor().execute(
+            "UPDATE %s SET %s WHERE %s IN (%s)" % (
+                qn(Player._meta.db_table), assignments, id_column, ', '.join(['%s'] * len(ids)),
+            ),
+            params + ids
+        )
+        transaction.commit_unless_managed()
+    save_players.alters_data = True
+
+    def save_hands(self, snapshot):
+        """
+        Write back the hands of snapshot with a statement for each kind of
+        change, whatever the number of players: one deleting the options
+        no longer in any hand, one moving options to the player now holding
+        them (which is all that rotating hands takes) and one adding new
+        options. Part of save_snapshot
+        """
+        Hand = Player.current_options.through
+        qn = connection.ops.quote_name
+        table = qn(Hand._meta.db_table)
+        player_column = qn(Hand._meta.get_field('player').column)
+        option_column = qn(Hand._meta.get_field('buildoption').column)
+        players = [p.id for p in snapshot.players]
+        def where(options):
+            # Options are shared by all games, so players are always checked
+            return "%s IN (%s) AND %s IN (%s)" % (
+                player_column, ', '.join(['%s'] * len(players)),
+                option_column, ', '.join(['%s'] * len(options)),
+            )
+
+        stored = snapshot.stored_hands
+        current = dict((o, p.id) for p in snapshot.players for o in p.hand)
+        cursor = connection.cursor()
+        gone = [o for o in stored if o not in current]
+        if gone:
+            cursor.execute("DELETE FROM %s WHERE %s" % (table, where(gone)), players + gone)
+        moved = [(o, p) for o, p in current.items() if o in stored and stored[o] != p]
+        if moved:
+            cases = ' '.join(['WHEN %s THEN %s'] * len(moved))
+            cursor.execute(
+                "UPDATE %s SET %s = CASE %s %s END WHERE %s" % (table, player_column, option_column, cases, where(moved)),
+                [value for pair in moved for value in pair] + players + [o for o, p in moved]
+            )
+        transaction.commit_unless_managed()
+        Hand.objects.bulk_create([
+            Hand(player_id=p.id, buildoption_id=o) for p in snapshot.players for o in p.hand if o not in stored
+        ])
+        snapshot.stored_hands = current
+    save_hands.alters_data = True
+
+    def scoreboard(self):
+        """
+        List of (player, Score) for every player, in seat order. Finished
+        games read the scores stored when they finished; otherwise the
+        running scores stored with the players are used. Games without
+        them (older ones, or just started) fall back to computing the
+        scores together on a snapshot
+        """
+        players = self.players()
+        if self.finished:
+            stored = dict((s.player_id, s.score()) for s in FinalScore.objects.filter(player__game=self))
+            if len(stored) == len(players):
+                return [(p, stored[p.id]) for p in players]
+        scores = [(p, p.current_score()) for p in players]
+        if all(score is not None for p, score in scores):
+            return scores
+        scores = dict(self.snapshot().scoreboard())
+        return [(p, scores[p.id]) for p in players]
+
+    def end_of_age(self):
+        with transaction.commit_on_success():
+            snapshot = self.snapshot()
+            snapshot.end_of_age()
+            self.save_snapshot(snapshot)
+        notify.changed(self.id)
     end_of_age.alters_data = True
 
+    def claim_turn(self):
+        """
+        Take the current turn of this game for resolving it. Must be called
+        within a transaction, which keeps the claim until it ends.
+
+        This is a compare-and-swap on the stored turn: of several requests
+        claiming the same turn at once, the first one gets it, and the rest
+        wait until it commits (or rolls back) and then get False if the
+        turn changed. Age and turn are brought up to date from the database
+        if this game is out of date
+        """
+        def claim(age_id, turn):
+            # Writing the row takes the lock
+            return Game.objects.filter(pk=self.pk, age=age_id, turn=turn, finished=False).update(turn=turn)
+        if claim(self.age_id, self.turn):
+            return True
+        age_id, turn, finished = Game.objects.filter(pk=self.pk).values_list('age', 'turn', 'finished').get()
+        if finished or (age_id, turn) == (self.age_id, self.turn) or not claim(age_id, turn):
+            return False
+        if age_id != self.age_id:
+            self.age = Age.objects.get(pk=age_id)
+        self.turn = turn
+        return True
+    claim_turn.alters_data = True
+
     def end_of_turn(self):
-        # Apply all player actions, in two stages
-        for p in self.player_set.all():
-            p.pre_apply_action()
-        for p in self.player_set.all():
-            p.apply_action()
-        # Rotate available options
-        opts = [list(p.current_options.all()) for p in self.player_set.all()]
-        if self.age.direction=='l':
-            opts = opts[1:]+opts[:1]
-        else:
-            assert self.age.direction=='r'
-            opts = opts[-1:]+opts[:-1]
-        for p, os in zip(self.player_set.all(), opts):
-            p.current_options.clear()
-            p.current_options.add(*os)
-        # increase turn counter
-        self.turn += 1
-        if self.turn > constants.TURN_COUNT:
-            self.end_of_age()
-        else:
-            self.save()
-        # Reset players so they can play again
-        for p in self.player_set.all():
-            p.reset_action()
+        """
+        Apply the actions played by every player, and move on to the next
+        turn. The whole turn is resolved on a snapshot of the game, in a
+        transaction, and only once even if called by several requests at
+        the same time (see claim_turn). Returns True if this call resolved
+        the turn, False if someone hasn't played yet or it was resolved by
+        someone else
+        """
+        profile = profiling.for_game(self)
+        with profile, transaction.commit_on_success():
+            if not self.claim_turn():
+                return False
+            with profile.call('snapshot'):
+                snapshot = self.snapshot()
+            if snapshot.missing_players():
+                return False
+            # Age and turn as claimed, which may be newer than when called
+            profile.resolving(self.age_id, self.turn)
+            snapshot.profile = profile
+            snapshot.end_of_turn()
+            with profile.call('save_snapshot'):
+                self.save_snapshot(snapshot)
+        # Once committed, so waiting requests see the new turn
+        notify.changed(self.id)
+        return True
     end_of_turn.alters_data = True
 
     def missing_players(self):
@@ -187,9 +410,14 @@ class Game(models.Model):
         return self.player_set.exclude(action='')
 
     def turn_check(self):
-        """Checks if we need to do end of turn"""
+        """
+        Checks if we need to do end of turn, and schedules it (see turns).
+        Safe to call from several requests at once; see end_of_turn. Views
+        that players poll call it too, so turns whose job was lost are
+        scheduled again
+        """
         if not self.missing_players():
-            self.end_of_turn()
+            turns.schedule(self)
     turn_check.alters_data = True
 
     def discard(self, option):
@@ -201,13 +429,13 @@ class Game(models.Model):
         return ('game-detail', [], {'pk': self.id})
 
 
-class Player(models.Model):
+class Player(engine.PlayerRules, models.Model):
     """Single player information for given game"""
 
-    BUILD_ACTION= 'build'
-    FREE_ACTION = 'free'
-    SELL_ACTION = 'sell'
-    SPECIAL_ACTION = 'spec'
+    BUILD_ACTION = engine.BUILD_ACTION
+    FREE_ACTION = engine.FREE_ACTION
+    SELL_ACTION = engine.SELL_ACTION
+    SPECIAL_ACTION = engine.SPECIAL_ACTION
     ACTIONS = (
         (BUILD_ACTION, 'Build'),
         (FREE_ACTION, 'Build(free, use special)'),
@@ -230,6 +458,13 @@ class Player(models.Model):
     buildings = models.ManyToManyField(Building, blank=True, null=True)
     # Ages where the special_free_bulding ability has been used already
     special_free_building_ages_used = models.ManyToManyField(Age, blank=True, null=True)
+    # Buildings of each kind (in KINDS order) and defeats, so effects can
+    # count them without queries. Written by Game.save_snapshot
+    kind_counts = models.CommaSeparatedIntegerField(max_length=50, default=','.join(['0'] * len(KINDS)))
+    defeat_count = models.PositiveIntegerField(default=0)
+    # Score fields, without treasury, as of the last save_snapshot; see
+    # current_score. Empty if unknown, until the next save_snapshot
+    running_score = models.CommaSeparatedIntegerField(max_length=100, blank=True, default='')
 
     # Private information, player decisions
     current_options = models.ManyToManyField(BuildOption, blank=True, null=True)
@@ -238,17 +473,20 @@ class Player(models.Model):
     trade_left = models.PositiveIntegerField(default=0) # Money used in trade with left player
     trade_right = models.PositiveIntegerField(default=0) # Money used in trade with right player
 
+    _effects = None # Cached by effects()
+
     def building_list(self):
         """Building list, sorted by kind. For template use"""
+        city = catalog.get().city(self.city_id)
         result = [dict(
-            kind='bas' if self.city.resource.is_basic else 'cpx', # FIXME: hardocded constant
+            kind='bas' if city.resource_is_basic else 'cpx', # FIXME: hardocded constant
             label='City',
             building=None,
-            effect=self.city.resource.name
+            effect=city.resource
         )]
-        for b in self.buildings.all():
+        for b in self.built_buildings():
             result.append(dict(
-                kind=b.kind.pk,
+                kind=b.kind,
                 label=b.name,
                 building=b,
                 effect=b.effect
@@ -257,102 +495,36 @@ class Player(models.Model):
         result.sort(key=lambda b:ORDERING.index(b['kind']))
         return result
 
-    def active_effects(self):
-        """The set of effects which apply to this player"""
-        # City specials
-        city_effects = Effect.objects.filter(cityspecial__city=self.city, cityspecial__variant=self.variant, cityspecial__order__lt=self.specials_built)
-        # Building effects
-        effects = city_effects | Effect.objects.filter(building__player=self)
-        return effects
+    def effects(self):
+        """
+        Same as PlayerRules.effects, loaded once per instance. Players only
+        build through Game.save_snapshot, which is done on other instances
+        """
+        if self._effects is None:
+            self._effects = engine.PlayerRules.effects(self)
+        return self._effects
+
+    def built_buildings(self):
+        """Buildings built by this player, as catalog BuildingInfos"""
+        rules = catalog.get()
+        return [rules.building(id) for id in self.buildings.values_list('id', flat=True)]
 
     def left_player(self):
-        try:
-            return self.get_previous_in_order()
-        except:
-            return self.game.player_set.order_by('-_order')[0]
+        return self.game.seats().left(self)
 
     def right_player(self):
-        try:
-            return self.get_next_in_order()
-        except:
-            return self.game.player_set.order_by('_order')[0]
-    
+        return self.game.seats().right(self)
+
     def all_right_players(self):
         """
         A list of every player except self and player at the left, starting
         by the player at the right and going around to the right
         """
-        p = self.right_player()
-        result = []
-        for _ in range(self.game.player_set.count()-2):
-            result.append(p)
-            p = p.right_player()
-        assert p == self.left_player()
-        return result
-    
-    def tradeable_resources(self):
-        """
-        List of resources that can be bought by neighbors; note that not
-        every resource available is tradeable.
-        
-        This a [[(amount, resource)]]. Inner list are alternative resources
-        """
-        # Basic city resource is tradeable
-        result = [[(1, self.city.resource.name)]]
-        # Add in production of resources by tradeable kinds of buildings
-        for b in self.buildings.filter(kind__in=TRADEABLE):
-            if b.effect.production:
-                result.append(b.effect.production.to_list())
-        return result
+        return self.game.seats().all_right(self)
 
-    def trade_costs(self, direction):
-        """
-        Costs of trading with player in given direction ('l' or 'r')
-        
-        dict of resource_name -> money
-        """
-        assert direction in ('l', 'r')
-        result = collections.defaultdict(lambda: constants.DEFAULT_TRADE_COST)
-        for e in self.active_effects():
-            if (direction=='l' and e.left_trade) or (direction=='r' and e.right_trade):
-                cost = e.trade.money
-                for _, resource in e.trade.to_list():
-                    # Pick the better value for each resource
-                    result[resource] = min(result[resource], cost)
-        return result
-        
-
-    def local_production(self):
-        """
-        List of resources produced by every local effect (not counting trade)
-        
-        This a [[(amount, resource)]]. Inner list are alternative resources
-        """
-        # Basic city resource is local production
-        result = [[(1, self.city.resource.name)]]
-        # Add in production of resources by tradeable kinds of buildings
-        for e in self.active_effects():
-            if e.production:
-                result.append(e.production.to_list())
-        return result
-    
     def can_play(self):
         return self.game.started and not self.game.finished and self.action == ''
 
-    def can_build_free(self):
-        """
-        True if player can use the 'free building' effect. Needs to have the
-        effect available, and not already used in this age.
-        """
-        # This only makes sense on started games
-        if not self.game.started: return False
-        # Check that the player has the free build ability
-        if not self.active_effects().filter(free_building=True): return False
-        # Check that the effect hasn't been already used
-        if special_free_building_ages_used.filter(game=self.game): return False
-        # Otherwise, the effect can be used
-        return True
-
     def play(self, action, option, trade_left, trade_right):
         """
         Choose to play the given action with the given build option.
@@ -371,223 +543,53 @@ class Player(models.Model):
         assert option in self.current_options.all()
         assert option != self.FREE_ACTION or self.can_build_free()
         assert option != self.SPECIAL_ACTION or self.can_build_special()
-        assert option != self.BUILD_ACTION or economy.can_pay(self.payment_options(option.building), trade_left, trade_right)
+        assert option != self.BUILD_ACTION or economy.can_pay(self.payment_options(catalog.get().building(option.building_id)), trade_left, trade_right)
         
         self.action = action
         self.option_picked = option
         self.trade_left = trade_left
         self.trade_right = trade_right
         self.save()
-        
-        self.game.turn_check()
+        self.game.changed()
 
-    def reset_action(self):
-        self.action = ''
-        self.option_picked = None
-        self.trade_left = 0
-        self.trade_right = 0
-        self.save()
-    reset_action.alters_data = True
+        self.game.turn_check()
 
-    def pre_apply_action(self):
-        """
-        Pre-apply action played
-        (actions are applied in two phases)
-        """
-        assert self.action
-        # Buildings need to be added first, so applied effects related to
-        # existing buildings count other buildings built in the same turn
-        if self.action in (self.BUILD_ACTION, self.FREE_ACTION):
-            if self.action==self.BUILD_ACTION:
-                item = self.option_picked.building
-            else:
-                item = self.next_special() 
-            # Check payment. This needs to be done before building, so raising
-            # a commercial building does not affect its own price, and building
-            # a resource does not allow to pay for itself.
-            # Anyway, build options should try to avoid that happening
-            payment = economy.can_pay(
-                self.payment_options(item), 
-                self.trade_left,
-                self.trade_right
-            )
-            assert payment is not None
-            # Pay local money. Trade is handled later
-            self.money -= payment.money
-            self.buildings.add(self.option_picked.building)
-        
-    def apply_action(self):
-        """Apply action played"""
-        assert self.action
-        if self.action == self.SELL_ACTION:
-            # Sell: discard the option
-            self.game.discard(self.option_picked)
-            # Get money
-            self.money += constants.SELL_VALUE
-
-            self.save()
-
-        elif self.action == self.BUILD_ACTION:
-            # Pay!
-            if self.trade_left:
-                self.left_player().money += self.trade_left
-                self.money -= self.trade_left
-                self.left_player().save()
-            if self.trade_right:
-                self.right_player().money += self.trade_right
-                self.money -= self.trade_right
-                self.right_player().save()
-            # Earn money if building produces money
-            self.money += self.option_picked.building.effect.money(
-                self,
-                self.left_player(),
-                self.right_player()
-            )
-            self.save()
-        elif self.action == self.FREE_ACTION:
-            assert self.can_build_free()
-            # "Pay" with one use of the ability. No actual costs, but ability is disabled for this age
-            special_free_building_ages_used.add(self.game.age)
-            # Earn money if building produces money
-            self.money += self.option_picked.building.effect.money(
-                self,
-                self.left_player(),
-                self.right_player()
-            )
-            self.save()
-            # Build
-        elif self.action == self.SPECIAL_ACTION:
-            assert self.can_build_special()
-            special = self.next_special()
-            # Pay!
-            if self.trade_left:
-                self.left_player().money += self.trade_left
-                self.money -= self.trade_left
-                self.left_player().save()
-            if self.trade_right:
-                self.right_player().money += self.trade_right
-                self.money -= self.trade_right
-                self.right_player().save()
-            # Earn money if building produces money
-            self.money += special.effect.money(
-                self,
-                self.left_player(),
-                self.right_player()
-            )
-            # "Build"
-            self.specials_built = special.order + 1
-            self.save()
-        else:
-            raise AssertionError
-        # Option no longer available
-        self.current_options.remove(self.option_picked)
-    apply_action.alters_data = True
-
-    def next_special(self):
-        """
-        Next special to build, None if all built
-        """
-        specials = CitySpecial.objects.filter(city=self.city, variant=self.variant, order__gte=self.specials_built).order_by('order')
-        if specials:
-            return specials[0]
+    def stored_score(self):
+        """The running score as stored, without treasury. None if unknown"""
+        if not self.running_score:
+            return None
+        return Score(*map(int, self.running_score.split(',')))
 
-    def can_build_special(self):
+    def current_score(self):
         """
-        True if player can use the 'build special' action. Needs to have an
-        available special, and resources to pay for it
+        Same as score(), but read from what was stored at the end of the
+        last turn instead of computing it. None if it isn't stored
         """
-        # This only makes sense on started games
-        if not self.game.started: return False
-        # Check that there is a next special to build
-        special = self.next_special()
-        if special is None: return False
-        # Check that the player can pay for the special
-        return bool(self.payment_options(special))
+        score = self.stored_score()
+        if score is None:
+            return None
+        return score._replace(treasury=self.money // 3)
 
     def count(self, kind):
-        """Number of buildings of a given kind"""
-        return self.buildings.filter(kind=kind).count()
-    
-    def specials(self):
-        """Number of specials built"""
-        return self.specials_built
+        """Number of buildings of a given kind (a BuildingKind or its name)"""
+        kind = getattr(kind, 'name', kind)
+        return int(self.kind_counts.split(',')[KIND_INDEX[kind]])
 
     def defeats(self):
         """Number of defeats suffered"""
-        return self.battleresult_set.filter(result='d').count() # FIXME: hardcoded constant
-
-    def all_specials(self):
-        """The complete list of specials for our city+variant"""
-        return CitySpecial.objects.filter(city=self.city, variant=self.variant).order_by('order')
-
-    def military(self):
-        """Military power"""
-        # Just the sum of the military powers of each effect
-        return self.active_effects().aggregate(models.Sum('military'))
-
-    def science_score(self):
-        """Amount of science points"""
-        ### Science score
-        # Build auxiliar science class
-        sciences = Science.objects.values_list('name', flat=True)
-        ScienceScore = collections.namedtuple('ScienceScore', ' '.join(sciences))
-        # compute list of science producing effects
-        options = [e.sciences.all() for e in self.active_effects() if e.sciences.count()]
-        
-        combinations = oldcombinations = set([ScienceScore(*[0]*len(sciences))]) # Science score for a player with no science effects
-        for o in options:
-            combinations = set()
-            for science in o:
-                for b in oldcombinations:
-                    combinations.add(b._replace(**{science.name: getattr(b, science.name)+1}))
-            oldcombinations = combinations
-
-        result = 0
-        for s in combinations:
-            value = min(s)*constants.SCIENCE_SCORE_PER_GROUP + sum(amount**2 for amount in s)
-            result = max(result, value)
-        return result
-    
-    def score(self):
-        """Score for this player"""
-        treasury_score = self.money // 3
+        return self.defeat_count
 
-        military_score = sum(b.score() for b in self.battleresult_set.all())
+    def battle_results(self):
+        return self.battleresult_set.all()
 
-        specials_built = Effect.objects.filter(cityspecial__city=self.city, cityspecial__variant=self.variant, cityspecial__order__lt=self.specials_built)    
-        special_score = sum(s.get_score(self, self.left_player(), self.right_player()) for s in specials_built)
-        
-        # Accumulate building effects
-        result = Score.new()._replace(
-            treasury=treasury_score,
-            military=military_score,
-            special=special_score,
-            science=self.science_score()
-        )
-        for b in self.buildings.all():
-            result = result + b.score(self, self.left_player(), self.right_player())
+    def free_building_used(self):
+        return self.special_free_building_ages_used.filter(pk=self.game.age_id).exists()
 
-        return result
+    def game_started(self):
+        return self.game.started
 
-    def payment_options(self, item):
-        """List of ways of paying for item.cost. Empty if unpayable"""
-        # Can't be bought if we already have it
-        if item in self.buildings.all():
-            return []
-        # Check if we have a dependency of this item that makes it free:
-        if hasattr(item, 'free_having'):
-            if item.free_having in self.buildings.all():
-                # You can get it for free. No more options needed
-                return [economy.PaymentOption()]
-        return economy.get_payments(
-            item.cost.to_dict(),
-            self.money,
-            self.local_production(),
-            self.left_player().tradeable_resources(),
-            self.trade_costs('l'),
-            self.right_player().tradeable_resources(),
-            self.trade_costs('r'),
-        )            
+    def rules(self):
+        return catalog.get()
 
     class Meta:
         unique_together = (
@@ -599,7 +601,7 @@ class Player(models.Model):
     def __unicode__(self):
         return unicode(self.user)
 
-class BattleResult(models.Model):
+class BattleResult(engine.BattleResultRules, models.Model):
     """
     Result of a battle where a player fought.
     If there was no victory nor a defeat, no battle tokens are given.
@@ -609,11 +611,20 @@ class BattleResult(models.Model):
     direction = models.CharField(max_length=1, choices=constants.DIRECTIONS)
     result = models.CharField(max_length=1, choices=(('v', 'Victory'),('d','Defeat')))
 
-    def score(self):
-        if self.result == 'v':
-            return self.age.victory_score
-        else: 
-            return self.age.defeat_score
-        
     class Meta:
         ordering = ('age',)
+
+
+class FinalScore(models.Model):
+    """Score of a player, stored when the game finishes"""
+    player = models.OneToOneField(Player, related_name='final_score')
+    treasury = models.IntegerField()
+    military = models.IntegerField()
+    special = models.IntegerField()
+    civilian = models.IntegerField()
+    economy = models.IntegerField()
+    science = models.IntegerField()
+    personality = models.IntegerField()
+
+    def score(self):
+        return Score(*[getattr(self, name) for name in Score._fields])
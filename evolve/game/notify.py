@@ -0,0 +1,49 @@
+"""
+Notifications of game changes, for long polling.
+
+Every game has a version number, increased whenever something players
+see changes (see Game.changed and Game.save_snapshot). Requests waiting for
+a game to change block here until changed() is called for it. That only
+reaches requests served by the same process, so waiters also read the
+version stored in the database every POLL_INTERVAL seconds, which is enough
+for servers running several processes on the same box.
+"""
+import threading
+import time
+
+TIMEOUT = 25 # Seconds a request waits before answering with no changes
+POLL_INTERVAL = 5 # Seconds between database checks while waiting
+
+_condition = threading.Condition()
+_changes = {} # Number of changed() calls, by game id
+
+def changed(game_id):
+    """Wake up the requests waiting for game_id to change"""
+    with _condition:
+        _changes[game_id] = _changes.get(game_id, 0) + 1
+        _condition.notify_all()
+
+def wait(game_id, since, current, timeout=TIMEOUT, poll_interval=POLL_INTERVAL):
+    """
+    Wait until the version of game_id is greater than since, or timeout
+    seconds pass, and return the current version. current is a function
+    reading the version from the database
+    """
+    deadline = time.time() + timeout
+    while True:
+        # Taken before reading the version, so changes made in between
+        # aren't missed
+        with _condition:
+            seen = _changes.get(game_id, 0)
+        version = current()
+        remaining = deadline - time.time()
+        if version > since or remaining <= 0:
+            return version
+        with _condition:
+            started = time.time()
+            # Wake-ups for other games don't need a database check
+            while _changes.get(game_id, 0) == seen:
+                waited = time.time() - started
+                if waited >= min(remaining, poll_interval):
+                    break
+                _condition.wait(min(remaining, poll_interval) - waited)
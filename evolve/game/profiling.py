@@ -0,0 +1,118 @@
+"""
+Opt-in profiling of turn resolution.
+
+Games with the profiled flag set (it can be changed from the admin while
+the game goes on) get a TurnProfile for each end of turn. It records the
+time of every call to the steps of the turn, PlayerState.pre_apply_action
+and apply_action and payment_options (with the size of the search done
+by the payment solver, see economy.PaymentSolver.stats), and the queries
+made for the whole turn. When the turn is over it is logged as JSON to
+the evolve.profile logger, unless it turned out there was no turn to
+resolve (see TurnProfile.resolving).
+
+Other games use NO_PROFILE, which records nothing.
+"""
+import logging
+import time
+
+from django.utils import simplejson
+
+from evolve.base import metrics
+
+logger = logging.getLogger('evolve.profile')
+
+class _NullCall(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+class NullProfile(object):
+    """A profile that records nothing"""
+    _call = _NullCall()
+
+    def call(self, name, **info):
+        return self._call
+
+    def resolving(self, age_id, turn):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NO_PROFILE = NullProfile()
+
+
+class _Call(object):
+    def __init__(self, calls, info):
+        self.calls = calls
+        self.info = info
+
+    def __enter__(self):
+        self.start = time.time()
+        return self.info
+
+    def __exit__(self, *exc_info):
+        self.info['ms'] = (time.time() - self.start) * 1000
+        self.calls.append(self.info)
+        return False
+
+class TurnProfile(object):
+    """
+    Records the calls made during a turn of a game. Use it as a context
+    manager around the whole turn, and call() around each step
+    """
+
+    def __init__(self, game):
+        self.game_id = game.id
+        self.age_id = self.turn = None # Set by resolving
+        self.calls = []
+        self.queries = None
+        self.ms = None
+
+    def call(self, name, **info):
+        """
+        Context manager timing a call to name; info is logged with it. It
+        gives a dict where more information about the call can be stored
+        """
+        info['call'] = name
+        return _Call(self.calls, info)
+
+    def resolving(self, age_id, turn):
+        """
+        Record that the turn (of the age with id age_id) is being resolved.
+        Profiles where this isn't called aren't logged
+        """
+        self.age_id = age_id
+        self.turn = turn
+
+    def __enter__(self):
+        self.counter = metrics.QueryCounter().__enter__()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.ms = (time.time() - self.start) * 1000
+        self.counter.__exit__(*exc_info)
+        self.queries = self.counter.queries
+        if self.turn is not None:
+            logger.info(simplejson.dumps(self.as_dict()))
+        return False
+
+    def as_dict(self):
+        return {
+            'game': self.game_id,
+            'age': self.age_id,
+            'turn': self.turn,
+            'ms': self.ms,
+            'queries': self.queries,
+            'calls': self.calls,
+        }
+
+def for_game(game):
+    """The profile to use for the next turn of game"""
+    return TurnProfile(game) if game.profiled else NO_PROFILE
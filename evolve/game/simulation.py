@@ -0,0 +1,164 @@
+"""
+Self-play simulations, for rules balancing.
+
+run() plays games with bots on the engine, spread over a pool of worker
+processes, and writes a row per player and game to a results file: the
+seat, bot, city and variant, every Score field and the buildings taken.
+
+Runs are reproducible: game number n of a run gets its own random
+generator, seeded from the run seed and n, and results are written in
+game order whatever the number of workers.
+
+Results files are columnar: after a header line (JSON, with the run
+parameters and the names of cities and buildings) come blocks
+of rows. Each block is a JSON line giving its row count and its columns,
+as (name, array typecode, size in bytes), followed by the data of each
+column as a machine array. read_results loads them back.
+"""
+import array
+import itertools
+import multiprocessing
+import random
+
+from django.utils import simplejson
+
+from evolve.rules.models import Score
+from evolve.rules import catalog
+from evolve.game import engine, bots
+
+FORMAT = 'evolve-simulation-1'
+CHUNK_GAMES = 20 # Games per task sent to a worker
+# Columns with one value per row, and their array typecodes
+COLUMNS = (
+    ('game', 'i'), ('seat', 'b'), ('players', 'b'), ('bot', 'b'),
+    ('city', 'i'), ('variant', 'i'),
+) + tuple((name, 'i') for name in Score._fields) + (
+    ('total', 'i'),
+    ('built', 'b'), # Number of buildings of the row in the buildings column
+)
+
+def game_seed(seed, game):
+    """Seed for game number game of a run with the given seed"""
+    return seed * 1000003 + game
+
+def play(game, seed, players, bot_names, rules):
+    """
+    Play game number game of a run with rules (a catalog.Catalog); bot_names
+    has the bot of each seat, repeated as needed. Returns its rows, as
+    (values for COLUMNS, buildings)
+    """
+    rng = random.Random(game_seed(seed, game))
+    state = engine.new_game(engine.random_seats(players, rules, rng), rules, rng)
+    seat_bots = [i % len(bot_names) for i in range(players)]
+    policies = [bots.get_bot(bot_names[b])(rng) for b in seat_bots]
+    engine.play_game(state, lambda player: policies[player.id-1](player))
+    rows = []
+    for seat, p in enumerate(state.players):
+        score = state.final_scores[p.id]
+        values = (game, seat, players, seat_bots[seat], p.city_id, p.variant_id) + tuple(score) + (score.total(), len(p.buildings))
+        rows.append((values, p.buildings))
+    return rows
+
+# The rules of the run, set by run() (and in every worker by _init_worker),
+# so the whole run uses the same rules even if they change meanwhile
+_rules = None
+
+def _init_worker(rules):
+    global _rules
+    _rules = rules
+
+def _play_games(task):
+    start, stop, seed, players, bot_names = task
+    rows = []
+    for game in range(start, stop):
+        rows.extend(play(game, seed, players, bot_names, _rules))
+    return rows
+
+
+class ResultWriter(object):
+    """Writes rows to a results file, a block every block_rows rows"""
+
+    def __init__(self, output, metadata, block_rows=4096):
+        self.output = output
+        self.block_rows = block_rows
+        self.pending = []
+        self.rows = 0
+        header = dict(metadata, format=FORMAT, columns=[name for name, typecode in COLUMNS])
+        output.write(simplejson.dumps(header) + '\n')
+
+    def add(self, rows):
+        self.pending.extend(rows)
+        if len(self.pending) >= self.block_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        columns = [
+            (name, array.array(typecode, [values[i] for values, buildings in self.pending]))
+            for i, (name, typecode) in enumerate(COLUMNS)
+        ]
+        columns.append(('buildings', array.array('i', [b for values, buildings in self.pending for b in buildings])))
+        data = [(name, values.typecode, values.tostring()) for name, values in columns]
+        block = {'rows': len(self.pending), 'columns': [(name, typecode, len(raw)) for name, typecode, raw in data]}
+        self.output.write(simplejson.dumps(block) + '\n')
+        for name, typecode, raw in data:
+            self.output.write(raw)
+        self.rows += len(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.output.flush()
+
+
+def read_results(input):
+    """
+    Load a results file. Returns (header, columns), where columns maps each
+    column name to an array with the values of every row. buildings has
+    the buildings of every row, one after the other; built says how many
+    belong to each row
+    """
+    header = simplejson.loads(input.readline())
+    if header.get('format') != FORMAT:
+        raise ValueError("Not a simulation results file")
+    columns = {}
+    for line in iter(input.readline, ''):
+        block = simplejson.loads(line)
+        for name, typecode, size in block['columns']:
+            values = columns.setdefault(name, array.array(typecode))
+            values.fromstring(input.read(size))
+    return header, columns
+
+def run(output, games, players, bot_names=('random',), seed=0, workers=1):
+    """
+    Play games with players each and write the results to output (a file
+    opened for writing in binary mode). Returns the number of rows written
+    """
+    rules = catalog.get() # Loaded before starting the workers, which share it
+    _init_worker(rules)
+    for name in bot_names:
+        bots.get_bot(name) # Fail early on unknown bots
+    writer = ResultWriter(output, {
+        'games': games, 'players': players, 'seed': seed, 'bots': list(bot_names),
+        'city_names': dict((c.id, c.name) for c in rules.cities.values()),
+        'building_names': dict((b.id, b.name) for b in rules.buildings.values()),
+    })
+    tasks = [
+        (start, min(start+CHUNK_GAMES, games), seed, players, tuple(bot_names))
+        for start in range(0, games, CHUNK_GAMES)
+    ]
+    if workers > 1:
+        # Workers are forked, so they get rules without pickling it
+        pool = multiprocessing.Pool(workers, _init_worker, (rules,))
+        try:
+            for rows in pool.imap(_play_games, tasks):
+                writer.add(rows)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for rows in itertools.imap(_play_games, tasks):
+            writer.add(rows)
+    writer.close()
+    return writer.rows
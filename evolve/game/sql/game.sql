@@ -0,0 +1,2 @@
+-- Lobby listings, by status and then in creation order
+CREATE INDEX game_game_status_id ON game_game (status, id);
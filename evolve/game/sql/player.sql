@@ -0,0 +1,2 @@
+-- The games of a user, and whether a user plays a game
+CREATE INDEX game_player_user_id_game_id ON game_player (user_id, game_id);
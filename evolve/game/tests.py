@@ -1,16 +1,867 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+Tests for the game app: game flow and snapshots on the models, the engine
+against them, pages and notifications, simulations, benchmarks, metrics and
+profiling, and turns resolved concurrently or in the background.
 
-Replace this with more appropriate tests for your application.
+Rules come from evolve.rules.synthetic; run with "manage.py test game".
 """
+import collections
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from StringIO import StringIO
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.contrib import admin as django_admin
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
 
+import mock
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+from evolve.base import metrics
+from evolve.rules import catalog, constants, economy, synthetic
+from evolve.rules.models import Variant, BuildOption, BuildingKind, KINDS
+from evolve.game.models import Game, Player, FinalScore
+from evolve.game import admin, engine, notify, views, bots, simulation, benchmarks, profiling, turns
+
+
+def create_game(players):
+    """A started game with the given number of players"""
+    game = Game.objects.create()
+    game.allowed_variants.add(*Variant.objects.all())
+    for n in range(players):
+        game.join(User.objects.create(username='game%d-player%d' % (game.id, n)))
+    game.start()
+    return Game.objects.get(pk=game.pk)
+
+def play_turn(game, rng):
+    """
+    Every player who hasn't played yet picks an option at random, builds it
+    if possible and sells it otherwise
+    """
+    rules = catalog.get()
+    for player in game.missing_players():
+        option = rng.choice(list(player.current_options.all()))
+        payments = player.payment_options(rules.building(option.building_id))
+        if payments:
+            left, right = payments[0].trade_costs()
+            player.play(Player.BUILD_ACTION, option, left, right)
+        else:
+            player.play(Player.SELL_ACTION, option, 0, 0)
+    return Game.objects.get(pk=game.pk)
+
+
+class GameFlowTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.rng = random.Random(42)
+
+    def play_game(self, players):
+        game = create_game(players)
+        for _ in range(len(catalog.get().ages) * constants.TURN_COUNT):
+            self.assertFalse(game.finished)
+            game = play_turn(game, self.rng)
+        self.assertTrue(game.finished)
+        return game
+
+    def test_start(self):
+        game = create_game(3)
+        for p in game.player_set.all():
+            self.assertEqual(p.current_options.count(), constants.INITIAL_OPTIONS)
+
+    def test_end_of_turn(self):
+        game = play_turn(create_game(3), self.rng)
+        self.assertEqual(game.turn, 2)
+        self.assertFalse(game.waiting_players())
+        for p in game.player_set.all():
+            self.assertEqual(p.current_options.count(), constants.INITIAL_OPTIONS-1)
+
+    def test_full_game(self):
+        game = self.play_game(3)
+        for p in game.player_set.all():
+            self.assertTrue(p.score().total() > 0)
+
+    def test_full_game_7_players(self):
+        self.play_game(7)
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.rng = random.Random(7)
+
+    def sell_all(self, game):
+        """Every player sells their first option"""
+        for p in game.player_set.all():
+            p.action = Player.SELL_ACTION
+            p.option_picked = p.current_options.all()[0]
+            p.save()
+
+    def test_end_of_turn_queries(self):
+        # Claiming the turn takes a query, loading 5, saving one for the
+        # players plus discards, hands (2: sold options and rotation) and
+        # the game, however many players there are
+        for players in (3, synthetic.MAXIMUM_PLAYERS):
+            game = create_game(players)
+            self.sell_all(game)
+            with self.assertNumQueries(11):
+                game.end_of_turn()
+
+    def test_rotate_hands(self):
+        game, other = create_game(4), create_game(3)
+        Hand = Player.current_options.through
+        def hands(game):
+            return sorted(Hand.objects.filter(player__game=game).values_list('id', 'player', 'buildoption'))
+        before, other_before = hands(game), hands(other)
+        self.sell_all(game)
+        sold = set(Player.objects.filter(game=game).values_list('option_picked', flat=True))
+        game.end_of_turn()
+        # Rows are kept, only moving to the next player
+        snapshot = Game.objects.get(pk=game.pk).snapshot()
+        holders = dict((o, p.id) for p in snapshot.players for o in p.hand)
+        self.assertEqual(
+            hands(game),
+            [(id, holders[option], option) for id, player, option in before if option not in sold]
+        )
+        # Whole hands move to a neighbor
+        new_holders = collections.defaultdict(set)
+        for id, player, option in before:
+            if option not in sold:
+                new_holders[player].add(holders[option])
+        for player, new in new_holders.items():
+            [holder] = new
+            self.assertTrue(player in (snapshot.player(holder).left.id, snapshot.player(holder).right.id))
+        # Other games holding the same options are left alone
+        self.assertEqual(hands(other), other_before)
+
+    def test_matches_players(self):
+        game = create_game(4)
+        for _ in range(constants.TURN_COUNT + 2):
+            game = play_turn(game, self.rng)
+        snapshot = game.snapshot()
+        for p in game.player_set.all():
+            s = snapshot.player(p.id)
+            self.assertEqual(s.left.id, p.left_player().id)
+            self.assertEqual(s.right.id, p.right_player().id)
+            self.assertEqual(sorted(s.hand), sorted(p.current_options.values_list('id', flat=True)))
+            self.assertEqual(s.defeats(), p.defeats())
+            for kind in ('bas', 'cpx', 'civ', 'mil', 'sci', 'eco'):
+                self.assertEqual(s.count(kind), p.count(kind))
+            self.assertEqual(s.military(), p.military())
+            self.assertEqual(s.score(), p.score())
+
+    def test_counters(self):
+        game = create_game(3)
+        for _ in range(constants.TURN_COUNT):
+            game = play_turn(game, self.rng)
+        for p in game.player_set.all():
+            with self.assertNumQueries(0):
+                counts = [p.count(kind) for kind, label in KINDS]
+                defeats = p.defeats()
+            self.assertEqual(counts, [p.buildings.filter(kind=kind).count() for kind, label in KINDS])
+            self.assertEqual(defeats, p.battleresult_set.filter(result='d').count())
+            for kind in BuildingKind.objects.all():
+                self.assertEqual(p.count(kind), p.count(kind.name))
+
+    def test_reproducible_deal(self):
+        game = create_game(4)
+        self.assertTrue(game.seed is not None)
+        dealt = dict((p.id, sorted(p.hand)) for p in game.snapshot().players)
+        # Dealing again with the same seed gives the same hands
+        snapshot = game.snapshot()
+        for p in snapshot.players:
+            p.hand = []
+        snapshot.shuffle()
+        self.assertEqual(dict((p.id, sorted(p.hand)) for p in snapshot.players), dealt)
+
+    def test_save_snapshot(self):
+        game = create_game(3)
+        snapshot = game.snapshot()
+        first, second = snapshot.players[:2]
+        first.trade_right = 2
+        first.pay_trade()
+        building = catalog.get().option(first.hand[0]).building.id
+        first.build(building)
+        game.save_snapshot(snapshot)
+        self.assertEqual(Player.objects.get(pk=first.id).money, constants.INITIAL_MONEY-2)
+        self.assertEqual(Player.objects.get(pk=second.id).money, constants.INITIAL_MONEY+2)
+        self.assertEqual(list(Player.objects.get(pk=first.id).buildings.values_list('id', flat=True)), [building])
+        # Nothing is written twice
+        game.save_snapshot(snapshot)
+        self.assertEqual(Player.objects.get(pk=first.id).buildings.count(), 1)
+
+class SeatRingTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+
+    def test_neighbors(self):
+        game = create_game(5)
+        players = list(game.player_set.select_related('user'))
+        game = Game.objects.get(pk=game.pk)
+        with self.assertNumQueries(1):
+            player = game.get_player(players[0].user)
+            self.assertEqual(player.left_player().id, players[-1].id)
+            self.assertEqual(player.right_player().id, players[1].id)
+            self.assertEqual([p.id for p in player.all_right_players()], [p.id for p in players[1:-1]])
+            self.assertEqual(player.right_player().right_player().left_player().id, players[1].id)
+            self.assertEqual(unicode(player.left_player()), unicode(players[-1].user))
+
+    def test_join_resets(self):
+        game = create_game(3)
+        game.started = False
+        game.join(User.objects.create(username='late'))
+        self.assertEqual(len(game.seats()), 4)
+        self.assertEqual(game.players()[0].left_player().user.username, 'late')
+
+class ScoreboardTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.rng = random.Random(3)
+
+    def test_running_game(self):
+        game = play_turn(create_game(4), self.rng)
+        scoreboard = game.scoreboard()
+        self.assertEqual([p.id for p, score in scoreboard], [p.id for p in game.players()])
+        for p, score in scoreboard:
+            self.assertEqual(score, p.score())
+        self.assertFalse(FinalScore.objects.exists())
+
+    def test_running_score(self):
+        game = create_game(4)
+        # Past the end of the first age, so battles are scored too
+        for _ in range(constants.TURN_COUNT + 2):
+            game = play_turn(game, self.rng)
+            snapshot = game.snapshot()
+            for p in game.players():
+                self.assertEqual(p.current_score(), p.score())
+                self.assertEqual(snapshot.player(p.id).score(), p.score())
+        # Only the seats next to a change are scored again
+        snapshot = game.snapshot()
+        first = snapshot.players[0]
+        first.build(catalog.get().option(first.hand[0]).building.id)
+        self.assertEqual([p.running_score is None for p in snapshot.players], [True, True, False, True])
+
+    def test_unknown_running_score(self):
+        game = play_turn(create_game(4), self.rng)
+        expected = [(p.id, p.score()) for p in game.players()]
+        # As in games from before running scores were stored
+        Player.objects.filter(game=game).update(running_score='')
+        game = Game.objects.get(pk=game.pk)
+        self.assertEqual([(p.id, score) for p, score in game.scoreboard()], expected)
+        snapshot = game.snapshot()
+        self.assertEqual([(p.id, p.score()) for p in snapshot.players], expected)
+
+    def test_running_queries(self):
+        game = play_turn(create_game(4), self.rng)
+        # Loading the players
+        with self.assertNumQueries(1):
+            game.scoreboard()
+
+    def test_finished_game(self):
+        game = create_game(3)
+        while not game.finished:
+            game = play_turn(game, self.rng)
+        self.assertEqual(FinalScore.objects.filter(player__game=game).count(), 3)
+        game = Game.objects.get(pk=game.pk)
+        with self.assertNumQueries(2):
+            scoreboard = game.scoreboard()
+        for p, score in scoreboard:
+            self.assertEqual(score, p.score())
+            self.assertTrue(score.total() > 0)
+
+
+class NotifyTest(TestCase):
+
+    def setUp(self):
+        self.version = 0
+
+    def change_later(self, game_id, delay=0.05):
+        def change():
+            time.sleep(delay)
+            self.version += 1
+            notify.changed(game_id)
+        thread = threading.Thread(target=change)
+        thread.start()
+        return thread
+
+    def test_changed_before(self):
+        self.assertEqual(notify.wait(1, -1, lambda: self.version), 0)
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertEqual(notify.wait(1, 0, lambda: self.version, timeout=0.05), 0)
+        self.assertTrue(time.time() - start >= 0.05)
+
+    def test_wake_up(self):
+        start = time.time()
+        thread = self.change_later(1)
+        self.assertEqual(notify.wait(1, 0, lambda: self.version, timeout=5, poll_interval=5), 1)
+        self.assertTrue(time.time() - start < 1)
+        thread.join()
+
+    def test_other_games(self):
+        reads = []
+        def current():
+            reads.append(self.version)
+            return 0
+        thread = self.change_later(2)
+        self.assertEqual(notify.wait(1, 0, current, timeout=0.2, poll_interval=5), 0)
+        thread.join()
+        # Checked at the start and at the timeout only
+        self.assertEqual(len(reads), 2)
+
+
+class VersionTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.rng = random.Random(5)
+
+    def version(self, game):
+        return Game.objects.get(pk=game.pk).version
+
+    def test_bumped(self):
+        game = create_game(3)
+        version = self.version(game)
+        player = game.player_set.all()[0]
+        player.play(Player.SELL_ACTION, player.current_options.all()[0], 0, 0)
+        self.assertEqual(self.version(game), version+1)
+        version += 1
+        play_turn(game, self.rng)
+        # Two more plays and the end of turn
+        self.assertEqual(self.version(game), version+3)
+
+    def test_wait_view(self):
+        game = create_game(3)
+        player = game.player_set.all()[0]
+        player.play(Player.SELL_ACTION, player.current_options.all()[0], 0, 0)
+        url = reverse('game-ajax-wait', kwargs={'pk': game.pk})
+        response = self.client.get(url, {'version': 0})
+        data = simplejson.loads(response.content)
+        self.assertEqual(data, {'version': self.version(game), 'waiting': [player.id]})
+        self.assertEqual(self.client.get(url, {'version': 'x'}).status_code, 400)
+
+
+class ConditionalTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.game = create_game(3)
+
+    def assertNotModified(self, url, **extra):
+        response = self.client.get(url, **extra)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag, **extra)
+        self.assertEqual(response.status_code, 304)
+        return etag
+
+    def test_watch(self):
+        url = reverse('game-watch', kwargs={'pk': self.game.pk})
+        etag = self.assertNotModified(url)
+        player = self.game.player_set.all()[0]
+        player.play(Player.SELL_ACTION, player.current_options.all()[0], 0, 0)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_waiting_players(self):
+        self.assertNotModified(reverse('game-ajax-waiting-players', kwargs={'pk': self.game.pk}))
+
+
+class PlayPageTest(TestCase):
+
+    def setUp(self):
+        views.cache.clear() # Ids are reused between tests
+        synthetic.create_rules()
+        self.game = play_turn(create_game(3), random.Random(11))
+        self.player = self.game.player_set.all()[0]
+        self.player.user.set_password('secret')
+        self.player.user.save()
+        self.client.login(username=self.player.user.username, password='secret')
+        self.url = reverse('game-play', kwargs={'pk': self.game.pk})
+
+    def test_payload(self):
+        page = views.play_page(self.player)
+        rules = catalog.get()
+        payments = [((0,0,0), '---')]
+        for o in self.player.current_options.all():
+            building = rules.building(o.building_id)
+            for po in self.player.payment_options(building):
+                payments.append(((o.id, po.left_trade.cost(), po.right_trade.cost()), u"%s %s" % (building, po)))
+        if self.player.can_build_special():
+            for po in self.player.payment_options(self.player.next_special()):
+                payments.append(((-1, po.left_trade.cost(), po.right_trade.cost()), u"Special %s" % po))
+        self.assertEqual(sorted(page['payments']), sorted(payments))
+        self.assertEqual(
+            [o['id'] for o in page['options']],
+            list(self.player.current_options.values_list('id', flat=True))
+        )
+        actions = [value for value, label in page['actions']]
+        self.assertEqual(Player.FREE_ACTION in actions, self.player.can_build_free())
+        self.assertEqual(Player.SPECIAL_ACTION in actions, self.player.can_build_special())
+
+    def test_cached(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['form'].page, views.play_page(self.player))
+        key = 'play-page-%d-%d' % (self.player.id, Game.objects.get(pk=self.game.pk).version)
+        self.assertEqual(views.cache.get(key), response.context['form'].page)
+
+    def test_play(self):
+        page = views.play_page(self.player)
+        option = page['options'][0]['id']
+        response = self.client.post(self.url, {'option': option, 'action': Player.SELL_ACTION, 'payment': ''})
+        self.assertEqual(response.status_code, 302)
+        player = Player.objects.get(pk=self.player.pk)
+        self.assertEqual((player.action, player.option_picked_id), (Player.SELL_ACTION, option))
+
+
+class EngineTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.rules = catalog.get()
+
+    def play(self, players, seed):
+        rng = random.Random(seed)
+        game = engine.new_game(engine.random_seats(players, self.rules, rng), self.rules, rng)
+        return engine.play_game(game, engine.random_policy(rng))
+
+    def test_new_game(self):
+        game = engine.new_game(engine.random_seats(4, self.rules), self.rules)
+        self.assertEqual([p.id for p in game.players], [1, 2, 3, 4])
+        self.assertEqual(len(set(p.city_id for p in game.players)), 4)
+        hands = [p.hand for p in game.players]
+        self.assertTrue(all(len(hand) == constants.INITIAL_OPTIONS for hand in hands))
+        self.assertEqual(len(set(sum(hands, []))), 4*constants.INITIAL_OPTIONS)
+
+    def test_play_game(self):
+        for players in (constants.MINIMUM_PLAYERS, synthetic.MAXIMUM_PLAYERS):
+            game = self.play(players, 1)
+            self.assertTrue(game.finished)
+            self.assertEqual(sorted(game.final_scores), [p.id for p in game.players])
+            built = sum(len(p.buildings) for p in game.players)
+            self.assertTrue(built > 0)
+            # Every card is built, sold or discarded at the end of an age
+            cards = len(self.rules.ages) * players * constants.INITIAL_OPTIONS
+            self.assertEqual(built + len(game.discards), cards)
+
+    def test_active_effects(self):
+        game = self.play(4, 4)
+        for p in game.players:
+            effects = p.active_effects()
+            self.assertEqual(p.military(), sum(e.military for e in effects))
+            self.assertEqual(len(p.local_production()), 1 + sum(1 for e in effects if e.production))
+            for direction in ('l', 'r'):
+                for e in effects:
+                    if (direction == 'l' and e.left_trade) or (direction == 'r' and e.right_trade):
+                        for _, resource in e.trade.to_list():
+                            self.assertTrue(p.trade_costs(direction)[resource] <= e.trade.money)
+        # Kept until something is built
+        player = game.players[0]
+        self.assertIs(player.effects(), player.effects())
+        before = player.effects()
+        military = max(self.rules.buildings.values(), key=lambda b: b.effect.military)
+        player.build(military.id)
+        self.assertEqual(player.military(), before.military + military.effect.military)
+
+    def test_trade_tables(self):
+        game = engine.new_game(engine.random_seats(3, self.rules), self.rules)
+        player = game.players[0]
+        table = player.effects().trade_table('l')
+        self.assertEqual(list(table), list(economy.RESOURCES.unit_costs(player.trade_costs('l'))))
+        # Kept while trade costs don't change
+        plain = [b for b in self.rules.buildings.values() if not b.effect.trade]
+        player.build(plain[0].id)
+        self.assertIs(player.effects().trade_table('l'), table)
+        trading = [b for b in self.rules.buildings.values() if b.effect.trade and b.effect.left_trade]
+        if trading:
+            player.build(trading[0].id)
+            self.assertFalse(player.effects().trade_table('l') is table)
+
+    def test_deterministic(self):
+        self.assertEqual(self.play(5, 2).scoreboard(), self.play(5, 2).scoreboard())
+
+    def test_matches_models(self):
+        game = create_game(4)
+        state = game.snapshot()
+        policy = engine.random_policy(random.Random(3))
+        # Turns before the end of the age, as both shuffle differently
+        for _ in range(constants.TURN_COUNT-1):
+            for p in state.players:
+                action, option, left, right = policy(p)
+                player = Player.objects.get(pk=p.id)
+                player.play(action, BuildOption.objects.get(pk=option), left, right)
+                p.play(action, option, left, right)
+        stored = Game.objects.get(pk=game.pk).snapshot()
+        self.assertEqual(stored.turn, state.turn)
+        for p in state.players:
+            s = stored.player(p.id)
+            self.assertEqual((s.money, s.buildings, sorted(s.hand)), (p.money, p.buildings, sorted(p.hand)))
+            self.assertEqual(s.score(), p.score())
+
+
+class SimulationTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+
+    def simulate(self, **kwargs):
+        output = StringIO()
+        rows = simulation.run(output, **kwargs)
+        return rows, output.getvalue()
+
+    def test_results(self):
+        rows, data = self.simulate(games=3, players=4, bot_names=['cheapest', 'specials'])
+        self.assertEqual(rows, 12)
+        header, columns = simulation.read_results(StringIO(data))
+        self.assertEqual(header['bots'], ['cheapest', 'specials'])
+        self.assertEqual(list(columns['game']), [g for g in range(3) for _ in range(4)])
+        self.assertEqual(list(columns['bot']), [0, 1, 0, 1] * 3)
+        self.assertEqual(sum(columns['built']), len(columns['buildings']))
+        self.assertTrue(all(str(b) in header['building_names'] for b in columns['buildings']))
+
+    def test_deterministic(self):
+        kwargs = dict(games=simulation.CHUNK_GAMES+5, players=3, bot_names=['random'], seed=7)
+        rows, data = self.simulate(workers=1, **kwargs)
+        self.assertEqual(self.simulate(workers=2, **kwargs), (rows, data))
+        self.assertNotEqual(self.simulate(workers=1, **dict(kwargs, seed=8))[1], data)
+
+    def test_rules_loaded_once(self):
+        # Games use the rules loaded when the run started
+        with mock.patch.object(catalog, 'get', side_effect=[catalog.get()]):
+            rows, data = self.simulate(games=2, players=3)
+        self.assertEqual(rows, 6)
+
+    def test_get_bot(self):
+        self.assertEqual(bots.get_bot('seller'), bots.seller)
+        self.assertEqual(bots.get_bot('evolve.game.bots.cheapest'), bots.cheapest)
+        self.assertRaises(ValueError, bots.get_bot, 'nobody')
+
+    def test_command(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'results.dat')
+            call_command('simulate', games=2, players=3, workers=1, bots='seller,random', output=path, stdout=StringIO())
+            with open(path, 'rb') as input:
+                header, columns = simulation.read_results(input)
+            self.assertEqual(len(columns['total']), 6)
+        finally:
+            shutil.rmtree(directory)
+
+
+class BenchmarkTest(TestCase):
+
+    def test_measure(self):
+        seconds, queries = benchmarks.measure(lambda: list(Game.objects.all()), number=2)
+        self.assertEqual(queries, 1)
+        self.assertTrue(seconds >= 0)
+
+    def test_regressions(self):
+        baseline = {'a': (0.1, 5), 'b': (0.1, 5)}
+        results = [('a', (0.15, 5)), ('b', (0.3, 6)), ('new', (1, 100))]
+        failures = list(benchmarks.regressions(results, baseline))
+        self.assertEqual(len(failures), 2)
+        self.assertTrue(all(f.startswith('b: ') for f in failures))
+
+    def test_run(self):
+        synthetic.create_rules()
+        results = dict(benchmarks.run([3]))
+        baseline = benchmarks.load_baseline()
+        self.assertTrue(set(results) <= set(baseline))
+        # Query counts don't depend on the machine
+        for name, (seconds, queries) in results.items():
+            self.assertTrue(queries <= baseline[name][1], name)
+
+
+class MetricsTest(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_histogram(self):
+        histogram = metrics.Histogram((1, 10, 100))
+        for value in (0.5, 3, 4, 50, 1000):
+            histogram.add(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual(histogram.percentile(0.5), 10)
+        self.assertEqual(histogram.percentile(0.95), None)
+        self.assertEqual(histogram.mean(), 211.5)
+
+    def test_middleware(self):
+        synthetic.create_rules()
+        game = create_game(3)
+        url = reverse('game-ajax-waiting-players', kwargs={'pk': game.pk})
+        seconds, queries = benchmarks.measure(lambda: self.client.get(url), repeat=2)
+        stats = metrics.stats()['game-ajax-waiting-players']
+        self.assertEqual(stats['latency_ms']['count'], 2)
+        self.assertEqual(stats['queries']['mean'], queries)
+        self.assertTrue(queries > 0)
+        # Cursors are only timed while serving requests
+        self.assertFalse(isinstance(connection.cursor(), metrics.TimedCursor))
+
+    def test_log(self):
+        metrics.record('game-play', 12, 3, 2)
+        with mock.patch.object(metrics.logger, 'info') as info:
+            metrics.log_stats()
+        message = info.call_args[0][0]
+        self.assertTrue(message.startswith('game-play n=1 p95=20ms queries=3.0'), message)
+
+    def test_stats_view(self):
+        user = User.objects.create(username='staff', is_staff=True)
+        user.set_password('secret')
+        user.save()
+        self.client.login(username='staff', password='secret')
+        self.client.get(reverse('games'))
+        response = self.client.get(reverse('stats'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(simplejson.loads(response.content)['games']['latency_ms']['count'], 1)
+
+
+class ProfilingTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.game = create_game(3)
+
+    def end_turn(self):
+        with mock.patch.object(profiling.logger, 'info') as info:
+            play_turn(self.game, random.Random(5))
+        return [simplejson.loads(args[0]) for args, kwargs in info.call_args_list]
+
+    def test_not_profiled(self):
+        self.assertEqual(self.end_turn(), [])
+
+    def test_nothing_to_resolve(self):
+        Game.objects.filter(pk=self.game.pk).update(profiled=True)
+        game = Game.objects.get(pk=self.game.pk)
+        with mock.patch.object(profiling.logger, 'info') as info:
+            self.assertFalse(game.end_of_turn()) # Nobody played yet
+        self.assertFalse(info.called)
+
+    def test_profiled(self):
+        Game.objects.filter(pk=self.game.pk).update(profiled=True)
+        logged = len(connection.queries)
+        [profile] = self.end_turn()
+        # Counted without keeping the SQL of each query
+        self.assertEqual(len(connection.queries), logged)
+        self.assertEqual((profile['game'], profile['turn']), (self.game.pk, 1))
+        self.assertTrue(profile['queries'] > 0)
+        calls = [c['call'] for c in profile['calls']]
+        self.assertEqual(calls.count('pre_apply_action'), 3)
+        self.assertEqual(calls.count('apply_action'), 3)
+        self.assertEqual(calls[0], 'snapshot')
+        self.assertEqual(calls[-1], 'save_snapshot')
+        for c in profile['calls']:
+            self.assertTrue(c['ms'] >= 0)
+            if c['call'] == 'payment_options' and 'depth' in c:
+                self.assertTrue(c['states'] >= c['dead_states'])
+
+
+    def test_admin_only_saves_profiled(self):
+        stale = Game.objects.get(pk=self.game.pk)
+        game = play_turn(self.game, random.Random(5))
+        stale.profiled = True
+        model_admin = admin.GameAdmin(Game, django_admin.site)
+        model_admin.save_model(None, stale, None, True)
+        stored = Game.objects.get(pk=game.pk)
+        self.assertTrue(stored.profiled)
+        self.assertEqual((stored.turn, stored.version), (game.turn, game.version))
+        self.assertTrue('profiled' not in model_admin.get_readonly_fields(None, stored))
+        self.assertTrue('turn' in model_admin.get_readonly_fields(None, stored))
+
+
+class ConcurrentPlayTest(TransactionTestCase):
+    """Players playing at the same moment, each from its own thread"""
+
+    def setUp(self):
+        synthetic.create_rules()
+
+    def play_at_once(self, game, rng):
+        """Every player plays at the same time; returns the errors raised"""
+        rules = catalog.get()
+        start = threading.Event()
+        errors = []
+        def play(player, option):
+            try:
+                start.wait()
+                payments = player.payment_options(rules.building(option.building_id))
+                if payments:
+                    left, right = payments[0].trade_costs()
+                    player.play(Player.BUILD_ACTION, option, left, right)
+                else:
+                    player.play(Player.SELL_ACTION, option, 0, 0)
+            except Exception, e:
+                errors.append(e)
+            finally:
+                connection.close()
+        threads = [
+            threading.Thread(target=play, args=(p, rng.choice(list(p.current_options.all()))))
+            for p in game.player_set.all()
+        ]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        turns.join()
+        return errors
+
+    def test_turn_resolved_once(self):
+        rng = random.Random(3)
+        game = create_game(synthetic.MAXIMUM_PLAYERS)
+        for turn in range(2, constants.TURN_COUNT + 1):
+            self.assertEqual(self.play_at_once(game, rng), [])
+            game = Game.objects.get(pk=game.pk)
+            self.assertEqual(game.turn, turn)
+            self.assertEqual(list(game.waiting_players()), [])
+            hands = [p.current_options.count() for p in game.player_set.all()]
+            self.assertEqual(hands, [constants.INITIAL_OPTIONS - turn + 1] * synthetic.MAXIMUM_PLAYERS)
+
+
+class BackgroundTurnTest(TransactionTestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.game = create_game(3)
+
+    def test_play_returns_before_resolving(self):
+        resolving, release = threading.Event(), threading.Event()
+        end_of_turn = Game.end_of_turn
+        def slow_end_of_turn(game):
+            resolving.set()
+            release.wait()
+            return end_of_turn(game)
+        with mock.patch.object(Game, 'end_of_turn', slow_end_of_turn):
+            play_turn(self.game, random.Random(2))
+            self.assertTrue(resolving.wait(5))
+            game = Game.objects.get(pk=self.game.pk)
+            self.assertEqual(game.turn, 1)
+            self.assertEqual(len(game.waiting_players()), 3)
+            release.set()
+            turns.join()
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(game.turn, 2)
+        self.assertEqual(len(game.missing_players()), 3)
+        self.assertTrue(game.version > self.game.version)
+
+    def test_inline_in_transactions(self):
+        with transaction.commit_on_success():
+            game = play_turn(self.game, random.Random(2))
+            self.assertEqual(game.turn, 2)
+
+    def test_errors_logged(self):
+        with mock.patch.object(Game, 'end_of_turn', side_effect=ValueError):
+            with mock.patch.object(turns.logger, 'exception') as exception:
+                play_turn(self.game, random.Random(2))
+                turns.join()
+        self.assertTrue(exception.called)
+
+    def test_lost_job(self):
+        # As if the process died before getting to it
+        with mock.patch.object(turns, 'schedule'):
+            play_turn(self.game, random.Random(2))
+        self.assertEqual(Game.objects.get(pk=self.game.pk).turn, 1)
+        # Waiting players pick it up again
+        url = reverse('game-ajax-wait', kwargs={'pk': self.game.pk})
+        self.client.get(url, {'version': 0})
+        turns.join()
+        self.assertEqual(Game.objects.get(pk=self.game.pk).turn, 2)
+
+    def test_failed_job(self):
+        with mock.patch.object(Game, 'end_of_turn', side_effect=ValueError):
+            with mock.patch.object(turns.logger, 'exception'):
+                play_turn(self.game, random.Random(2))
+                turns.join()
+        self.assertEqual(Game.objects.get(pk=self.game.pk).turn, 1)
+        player = self.game.player_set.select_related('user').all()[0]
+        player.user.set_password('secret')
+        player.user.save()
+        self.client.login(username=player.user.username, password='secret')
+        self.client.get(reverse('game-detail', kwargs={'pk': self.game.pk}))
+        turns.join()
+        self.assertEqual(Game.objects.get(pk=self.game.pk).turn, 2)
+
+
+class LobbyTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.user = User.objects.create(username='lobby')
+        self.user.set_password('secret')
+        self.user.save()
+
+    def create_games(self):
+        """An open and a finished game with the user, and a started one without"""
+        open_game = Game.objects.create()
+        open_game.allowed_variants.add(*Variant.objects.all())
+        open_game.join(self.user)
+        create_game(3)
+        finished = create_game(4)
+        Player.objects.filter(pk=finished.player_set.all()[0].pk).update(user=self.user)
+        Game.objects.filter(pk=finished.pk).update(finished=True, status=Game.FINISHED)
+
+    def test_status(self):
+        game = Game.objects.create()
+        game.allowed_variants.add(*Variant.objects.all())
+        for n in range(3):
+            self.assertTrue(game.is_joinable())
+            game.join(User.objects.create(username='status-%d' % n))
+        stored = Game.objects.get(pk=game.pk)
+        self.assertEqual((stored.status, stored.player_count), (Game.OPEN, 3))
+        self.assertTrue(stored.is_startable())
+        stored.start()
+        self.assertEqual(Game.objects.get(pk=game.pk).status, Game.PLAYING)
+        self.assertFalse(stored.is_joinable())
+        snapshot = stored.snapshot()
+        snapshot.finished = True
+        stored.save_snapshot(snapshot)
+        self.assertEqual(Game.objects.get(pk=game.pk).status, Game.FINISHED)
+
+    def test_status_follows_flags(self):
+        game = create_game(3)
+        # Game logic goes by the flags, and saving brings status in line
+        game.started = False
+        self.assertTrue(game.is_joinable())
+        game.save()
+        self.assertEqual(Game.objects.get(pk=game.pk).status, Game.OPEN)
+        game.finished = True
+        game.save()
+        self.assertEqual(Game.objects.get(pk=game.pk).status, Game.FINISHED)
+
+    def test_full(self):
+        game = create_game(synthetic.MAXIMUM_PLAYERS)
+        Game.objects.filter(pk=game.pk).update(started=False, status=Game.OPEN)
+        self.assertFalse(Game.objects.get(pk=game.pk).is_joinable())
+
+    def test_lists(self):
+        self.create_games()
+        self.client.login(username='lobby', password='secret')
+        response = self.client.get(reverse('games'))
+        lengths = [len(response.context[name]) for name in ('my_games', 'open_games', 'started_games', 'finished_games')]
+        self.assertEqual(lengths, [1, 0, 1, 1])
+        self.client.logout()
+        response = self.client.get(reverse('games'))
+        lengths = [len(response.context[name]) for name in ('my_games', 'open_games', 'started_games', 'finished_games')]
+        self.assertEqual(lengths, [0, 1, 1, 0])
+
+    def test_constant_queries(self):
+        self.client.login(username='lobby', password='secret')
+        def queries():
+            return benchmarks.measure(lambda: self.client.get(reverse('games')), repeat=1)[1]
+        self.create_games()
+        few = queries()
+        self.create_games()
+        self.create_games()
+        self.assertEqual(queries(), few)
@@ -0,0 +1,75 @@
+"""
+Background resolution of turns.
+
+Resolving a turn (applying every action, and at the end of an age the
+battles and a new shuffle) used to happen in the request of whoever played
+last. Game.turn_check now hands it to a pool of TURN_WORKERS threads in
+the server process, and that request returns right away. Players learn
+about the new turn as usual, through the game version (see notify).
+
+Turns are resolved inline when there are no workers, or when the caller is
+in a transaction that isn't committed yet (as in a TestCase): workers use
+their own database connections, so they wouldn't see the actions played.
+Scheduling a turn twice is harmless, see Game.end_of_turn, and a game
+already waiting in the queue of this process isn't queued again.
+
+The queue only lives in memory, so a job can be lost: the process may be
+restarted before getting to it, or resolving may fail. Nothing is lost for
+good, though: a game where every player has played is itself the pending
+job, and the views players and watchers keep polling call
+Game.turn_check, which schedules it again.
+"""
+import logging
+import Queue
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger('evolve.turns')
+
+WORKERS = 2 # Unless settings.TURN_WORKERS says otherwise
+
+_queue = Queue.Queue()
+_pending = set() # (model, pk) in the queue or being resolved
+_workers = []
+_lock = threading.Lock()
+
+def _work():
+    while True:
+        model, pk = _queue.get()
+        try:
+            model.objects.get(pk=pk).end_of_turn()
+        except Exception:
+            logger.exception("Error resolving the turn of game %s", pk)
+        finally:
+            with _lock:
+                _pending.discard((model, pk))
+            connection.close()
+            _queue.task_done()
+
+def _start(count):
+    with _lock:
+        while len(_workers) < count:
+            worker = threading.Thread(target=_work, name='turn-worker-%d' % len(_workers))
+            worker.daemon = True
+            worker.start()
+            _workers.append(worker)
+
+def schedule(game):
+    """Resolve the current turn of game, in the background if possible"""
+    count = getattr(settings, 'TURN_WORKERS', WORKERS)
+    if count <= 0 or transaction.is_managed():
+        game.end_of_turn()
+        return
+    _start(count)
+    job = (type(game), game.pk)
+    with _lock:
+        if job in _pending:
+            return
+        _pending.add(job)
+    _queue.put(job)
+
+def join():
+    """Wait until every turn scheduled has been resolved"""
+    _queue.join()
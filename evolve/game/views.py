@@ -1,27 +1,61 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, Http404
 from django.template.response import TemplateResponse
 from django.views.generic.edit import CreateView, FormView
 from django.views.generic.detail import SingleObjectMixin, DetailView
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import condition
 from django.shortcuts import get_object_or_404, redirect
 from django.utils import simplejson
+from django.core.cache import cache
+from django.db.models import Q
 
+from evolve.rules import catalog
+from evolve.rules.models import BuildOption
 from evolve.game.models import Game, Player
+from evolve.game import notify
 from evolve.game.forms import NewGameForm, JoinForm, StartForm, PlayForm
 
 
+def game_etag(request, pk):
+    """
+    ETag for views depending only on the state of the game, which is given
+    by its version. None if there's no such game, so views answer with 404
+    """
+    versions = Game.objects.filter(pk=pk).values_list('version', flat=True)
+    if versions:
+        return 'game-%s-%d' % (pk, versions[0])
+
+def game_page_etag(request, pk):
+    """ETag for pages, which also depend on the current user"""
+    etag = game_etag(request, pk)
+    if etag is not None:
+        return '%s-user-%s' % (etag, request.user.id)
+
+def lobby_games(user):
+    """
+    Games for the lobby: those not finished, and the finished ones user
+    played, with their players and variants. Takes a fixed number of
+    queries however many games there are
+    """
+    games = Q(status__in=(Game.OPEN, Game.PLAYING))
+    if user.is_authenticated():
+        games |= Q(status=Game.FINISHED, player__user=user)
+    return list(Game.objects.filter(games).distinct().order_by('id')
+        .select_related('age')
+        .prefetch_related('player_set__user', 'allowed_variants'))
+
 def game_list(request):
-    games = Game.objects.filter(finished=False) # Only non finished games   
-    if request.user.is_authenticated():
-        my_games = games.filter(player__user=request.user)
-        open_games = games.exclude(player__user=request.user).filter(started=False)
-        started_games = games.exclude(player__user=request.user).filter(started=True)
-        finished_games = Game.objects.filter(player__user=request.user, finished=True)
-    else:
-        my_games = games.none()
-        open_games = games.filter(started=False)
-        started_games = games.filter(started=True)
-        finished_games = games.none()
+    my_games, open_games, started_games, finished_games = [], [], [], []
+    for game in lobby_games(request.user):
+        mine = any(p.user_id == request.user.id for p in game.player_set.all())
+        if game.finished:
+            finished_games.append(game)
+        elif mine:
+            my_games.append(game)
+        elif not game.started:
+            open_games.append(game)
+        else:
+            started_games.append(game)
     return TemplateResponse(request, 'game/list.html', {
         'my_games': my_games,
         'open_games': open_games,
@@ -45,6 +79,8 @@ new_game = login_required(NewGameView.as_view())
 @login_required
 def game_detail(request, pk):
     game = get_object_or_404(Game, id=pk)
+    if game.started and not game.finished:
+        game.turn_check() # In case its job was lost; see turns
     player = game.get_player(request.user)
     if game.finished:
         return redirect('game-score', pk=pk)
@@ -106,6 +142,51 @@ class GameStartView(GameActionView):
 
 game_start = login_required(GameStartView.as_view())
 
+def play_page(player):
+    """
+    What the play page shows about the options of player, and what the play
+    form offers, as plain data that can be cached. Everything comes from a
+    single snapshot of the game
+    """
+    rules = catalog.get()
+    me = player.game.snapshot().player(player.id)
+    options = sorted((rules.option(id) for id in me.hand), key=lambda o: o.building.name)
+    result = dict(options=[], actions=[], payments=[((0,0,0), '---')])
+    for o in options:
+        building = o.building
+        result['options'].append(dict(
+            id=o.id,
+            name=building.name,
+            kind=building.kind,
+            cost=building.cost.label,
+            effect=building.effect.label,
+            free_having=sorted(rules.building(id).name for id in building.free_having),
+            allows_free=sorted(rules.building(id).name for id in building.allows_free),
+        ))
+        for po in me.payment_options(building):
+            result['payments'].append(((o.id, po.left_trade.cost(), po.right_trade.cost()), u"%s %s" % (building, po)))
+    # Same as me.can_build_special(), keeping the payments
+    special = me.next_special() if me.game_started() else None
+    special_payments = me.payment_options(special) if special is not None else []
+    for po in special_payments:
+        result['payments'].append(((-1, po.left_trade.cost(), po.right_trade.cost()), u"%s %s" % ("Special", po)))
+    for value, label in Player.ACTIONS:
+        if value == Player.FREE_ACTION and not me.can_build_free():
+            continue
+        if value == Player.SPECIAL_ACTION and not special_payments:
+            continue
+        result['actions'].append((value, label))
+    return result
+
+def cached_play_page(player, version):
+    """play_page(player), computed once for each version of the game"""
+    key = 'play-page-%d-%d' % (player.id, version)
+    result = cache.get(key)
+    if result is None:
+        result = play_page(player)
+        cache.set(key, result)
+    return result
+
 class GamePlayView(GameActionView):
     form_class = PlayForm
     template_name = 'game/play.html'
@@ -113,29 +194,15 @@ class GamePlayView(GameActionView):
     def get_form(self, form_class):
         form = super(GamePlayView, self).get_form(form_class)
         player = self.object.get_player(self.request.user)
+        page = cached_play_page(player, self.object.version)
         # Set build options for the current player
-        form.fields['option'].queryset = player.current_options.all()
-        # Remove the free build option if not available
-        actions = Player.ACTIONS
-        if not player.can_build_free():
-            actions = [(value, label) for (value, label) in actions if value != Player.FREE_ACTION]
-        # remove the build special option if not available
-        if not player.can_build_special():
-            actions = [(value, label) for (value, label) in actions if value != Player.SPECIAL_ACTION]
-        form.fields['action'].choices = actions
-        # Compute payments
-        payment = [((0,0,0), '---')]
-        for o in player.current_options.all():
-            pay_options = player.payment_options(o.building)
-            for po in pay_options:
-                payment.append(((o.id, po.left_trade.cost(), po.right_trade.cost()),u"%s %s" % (o.building, po)))
-        if player.can_build_special():
-            pay_options = player.payment_options(player.next_special())
-            for po in pay_options:
-                payment.append(((-1, po.left_trade.cost(), po.right_trade.cost()),u"%s %s" % ("Special", po)))
-        form.fields['payment'].choices = payment                
+        form.fields['option'].choices = [(o['id'], o['name']) for o in page['options']]
+        # Only the actions available
+        form.fields['action'].choices = page['actions']
+        form.fields['payment'].choices = page['payments']
         # Add metadata:
         form.player = player
+        form.page = page
         return form
 
     def form_valid(self, form):
@@ -143,7 +210,7 @@ class GamePlayView(GameActionView):
         player = game.get_player(self.request.user)
         if player.can_play():
             payment = form.cleaned_data.get('payment')
-            option = form.cleaned_data.get('option')
+            option = BuildOption.objects.get(pk=form.cleaned_data.get('option'))
             action = form.cleaned_data.get('action')
             player.play(action, option, payment[1], payment[2])
             return redirect(game.get_absolute_url())
@@ -159,24 +226,61 @@ class GameWaitView(DetailView):
     def get_context_data(self, **kwargs):
         result = super(GameWaitView, self).get_context_data(**kwargs)
         result['player_in_game'] = self.object.get_player(self.request.user)
+        if self.object.started and not self.object.finished:
+            self.object.turn_check() # In case its job was lost; see turns
         return result
 
-game_wait = login_required(GameWaitView.as_view())
+game_wait = login_required(condition(etag_func=game_page_etag)(GameWaitView.as_view()))
 
 class GameScoreView(DetailView):
     model = Game
     template_name = 'game/score.html'
 
-game_score = GameScoreView.as_view()
+    def get_context_data(self, **kwargs):
+        result = super(GameScoreView, self).get_context_data(**kwargs)
+        result['scoreboard'] = self.object.scoreboard()
+        return result
+
+game_score = condition(etag_func=game_page_etag)(GameScoreView.as_view())
 
 class GameWatchView(DetailView):
     model = Game
     template_name = 'game/watch.html'
 
-game_watch = GameWatchView.as_view()
+    def get_context_data(self, **kwargs):
+        result = super(GameWatchView, self).get_context_data(**kwargs)
+        result['scoreboard'] = self.object.scoreboard()
+        return result
 
+game_watch = condition(etag_func=game_page_etag)(GameWatchView.as_view())
+
+@condition(etag_func=game_etag)
 def game_ajax_waiting_players(request, pk):
     game = get_object_or_404(Game, id=pk)
     result = [player.id for player in game.waiting_players()]
     return HttpResponse(simplejson.dumps(result), mimetype="application/json")
-        
+
+def game_ajax_wait(request, pk):
+    """
+    Long poll for changes. Answers as soon as the game version is greater
+    than the version parameter, or after notify.TIMEOUT seconds, with the
+    current version and the ids of the players who already played
+    """
+    try:
+        since = int(request.GET.get('version', 0))
+    except ValueError:
+        return HttpResponseBadRequest()
+    def current():
+        versions = Game.objects.filter(pk=pk).values_list('version', flat=True)
+        if not versions:
+            raise Http404
+        return versions[0]
+    version = notify.wait(int(pk), since, current)
+    actions = Player.objects.filter(game=pk).values_list('id', 'action')
+    waiting = [id for id, action in actions if action]
+    if actions and len(waiting) == len(actions):
+        # Everyone played but the turn is still there: its job may have
+        # been lost; see turns
+        Game.objects.get(pk=pk).turn_check()
+    result = {'version': version, 'waiting': waiting}
+    return HttpResponse(simplejson.dumps(result), mimetype="application/json")
@@ -0,0 +1,89 @@
+"""
+Micro-benchmarks for the economy helpers.
+
+These don't need a database: they work on synthetic resource layouts
+similar to what players have late in an age. Run them with
+
+    python -m evolve.rules.benchmarks
+"""
+import collections
+import copy
+import random
+import timeit
+
+from evolve.rules import constants, economy
+
+BASIC_RESOURCES = ('Clay', 'Ore', 'Stone', 'Wood')
+COMPLEX_RESOURCES = ('Cloth', 'Glass', 'Papyrus')
+
+def late_age_layout(seed=0, producers=6, neighbor_producers=None):
+    """
+    Arguments for economy.get_payments for an expensive building when the
+    player and both neighbors have several (multi-resource) producers each.
+    Neighbors have as many producers as the player unless neighbor_producers
+    is given
+    """
+    rng = random.Random(seed)
+    if neighbor_producers is None:
+        neighbor_producers = producers
+    def production(producers):
+        result = [[(1, rng.choice(BASIC_RESOURCES))]] # The city resource
+        for _ in range(producers):
+            if rng.random() < 0.5:
+                result.append([(1, r) for r in rng.sample(BASIC_RESOURCES, 2)])
+            else:
+                result.append([(rng.randint(1, 2), rng.choice(BASIC_RESOURCES + COMPLEX_RESOURCES))])
+        return result
+    def trade_costs():
+        result = collections.defaultdict(lambda: constants.DEFAULT_TRADE_COST)
+        for r in rng.sample(BASIC_RESOURCES, 2):
+            result[r] = 1
+        return result
+    cost = collections.defaultdict(lambda: 0)
+    cost.update({'Stone': 3, 'Ore': 2, 'Wood': 2, 'Glass': 1, 'Papyrus': 1})
+    return (cost, 12, production(producers), production(neighbor_producers), trade_costs(), production(neighbor_producers), trade_costs())
+
+def quadratic_undominated(options):
+    """The filter get_payments used before ParetoFront, to compare against"""
+    options = sorted(options, key=lambda o: (o.left_trade.cost()+o.right_trade.cost(), o.left_trade.cost()))
+    result = []
+    for o in options:
+        for c in result:
+            if c.better_than(o): break
+        else:
+            result.append(o)
+    return result
+
+def best_time(function, repeat=3, number=1):
+    """Best time (in seconds) of a single call to function"""
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+def bench_undominated(seed=0):
+    """Time filtering raw payment options with ParetoFront and the old quadratic scan"""
+    problem = late_age_layout(seed)
+    raw = economy.get_payments_base(copy.copy(problem[0]), *problem[1:])
+    assert len(quadratic_undominated(raw)) == len(economy.undominated_options(raw))
+    return [
+        ('raw options', len(raw)),
+        ('quadratic filter (s)', best_time(lambda: quadratic_undominated(raw))),
+        ('pareto front (s)', best_time(lambda: economy.undominated_options(raw))),
+    ]
+
+def bench_get_payments(seed=0):
+    """Time get_payments against the exhaustive reference"""
+    problem = late_age_layout(seed)
+    return [
+        ('reference (s)', best_time(lambda: economy.get_payments_reference(*problem), repeat=1)),
+        ('get_payments (s)', best_time(lambda: economy.get_payments(*problem), number=10)),
+    ]
+
+BENCHMARKS = (bench_undominated, bench_get_payments)
+
+def main():
+    for benchmark in BENCHMARKS:
+        print benchmark.__name__
+        for label, value in benchmark():
+            print "    %-24s %s" % (label, value)
+
+if __name__ == '__main__':
+    main()
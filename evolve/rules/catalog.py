@@ -0,0 +1,391 @@
+"""
+Read only, in-memory copy of the rules.
+
+Rules models are loaded from fixtures and don't change during play, so the
+game logic reads them from here instead of querying the database on every
+call. The whole rule set is loaded the first time it's needed and kept for
+the life of the process. Saving or deleting any rules model in this process
+(for example, from the rules admin site) discards it, and it is loaded again
+on next use.
+
+Other processes learn about the change through a generation number kept in
+the Django cache, which they check every CHECK_INTERVAL seconds. That needs
+a cache shared by every process, like the database one in settings; with a
+per process cache, like the local memory one, other processes keep the old
+rules until they are restarted.
+
+Objects here mirror the rules models, with related objects resolved: the
+production of an EffectInfo is a CostInfo, the effect of a BuildingInfo is
+an EffectInfo and so on. Building kinds, resources and sciences are referred
+to by name.
+"""
+import collections
+import time
+
+from django.core.cache import cache
+from django.db.models import signals
+
+from evolve.rules import models, economy
+
+class Frozen(object):
+    """
+    Base for catalog objects. Every attribute is given at creation, as a
+    keyword argument, and can't be changed afterwards
+    """
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs.pop(name))
+        assert not kwargs, "Unknown attributes: %s" % ', '.join(kwargs)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s objects are read only" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s objects are read only" % type(self).__name__)
+
+    def __unicode__(self):
+        return self.label
+
+    def __repr__(self):
+        return "<%s %d: %s>" % (type(self).__name__, self.id, unicode(self).encode('utf-8'))
+
+
+class CostInfo(Frozen):
+    """
+    Besides the lines, it has them translated to RESOURCES ids for the
+    payment solver (see economy.get_payments_by_id): as requirements when
+    it's a cost, and as alternatives when it's a production
+    """
+    __slots__ = ('id', 'money', 'lines', 'label', 'requirements', 'alternatives')
+
+    @classmethod
+    def from_model(cls, cost):
+        lines = tuple(cost.to_list())
+        return cls(
+            id=cost.id,
+            money=cost.money,
+            lines=lines,
+            label=unicode(cost),
+            requirements=economy.RESOURCES.requirements(dict((r, amount) for amount, r in lines)),
+            alternatives=economy.RESOURCES.production(lines),
+        )
+
+    def to_dict(self):
+        """Same as Cost.to_dict"""
+        result = collections.defaultdict(lambda:0)
+        result['$'] = self.money
+        for amount, resource in self.lines:
+            result[resource] = amount
+        return result
+
+    def to_list(self):
+        """Same as Cost.to_list"""
+        return list(self.lines)
+
+
+class EffectInfo(Frozen, models.EffectRules):
+    __slots__ = (
+        'id', 'label',
+        'production', 'score', 'military', 'sciences',
+        'trade', 'left_trade', 'right_trade',
+        'kind_payed', 'money_per_neighbor_building', 'money_per_local_building',
+        'kinds_scored', 'score_per_neighbor_building', 'score_per_local_building',
+        'money_per_local_special', 'score_per_local_special',
+        'money_per_neighbor_special', 'score_per_neighbor_special',
+        'score_per_neighbor_defeat',
+        'free_building', 'extra_turn', 'use_discards', 'copy_personality',
+    )
+    # Fields copied as they are from the model
+    FIELDS = (
+        'id', 'score', 'military', 'left_trade', 'right_trade',
+        'money_per_neighbor_building', 'money_per_local_building',
+        'score_per_neighbor_building', 'score_per_local_building',
+        'money_per_local_special', 'score_per_local_special',
+        'money_per_neighbor_special', 'score_per_neighbor_special',
+        'score_per_neighbor_defeat',
+        'free_building', 'extra_turn', 'use_discards', 'copy_personality',
+    )
+
+    @classmethod
+    def from_model(cls, effect, costs):
+        fields = dict((name, getattr(effect, name)) for name in cls.FIELDS)
+        return cls(
+            label=unicode(effect),
+            production=costs.get(effect.production_id),
+            sciences=tuple(s.name for s in effect.sciences.all()),
+            trade=costs.get(effect.trade_id),
+            kind_payed=effect.kind_payed_id,
+            kinds_scored=tuple(k.name for k in effect.kinds_scored.all()),
+            **fields
+        )
+
+    def scored_kinds(self):
+        return self.kinds_scored
+
+
+class BuildingInfo(Frozen, models.BuildingRules):
+    __slots__ = ('id', 'name', 'kind', 'effect', 'cost', 'free_having', 'allows_free')
+
+    @classmethod
+    def from_model(cls, building, effects, costs, free_having, allows_free):
+        return cls(
+            id=building.id,
+            name=building.name,
+            kind=building.kind_id,
+            effect=effects[building.effect_id],
+            cost=costs[building.cost_id],
+            free_having=frozenset(free_having), # Building ids
+            allows_free=tuple(allows_free), # Building ids
+        )
+
+    def kind_name(self):
+        return self.kind
+
+    def __unicode__(self):
+        return self.name
+
+
+class CitySpecialInfo(Frozen):
+    __slots__ = ('id', 'city', 'variant', 'order', 'cost', 'effect', 'label')
+
+    @classmethod
+    def from_model(cls, special, effects, costs):
+        return cls(
+            id=special.id,
+            city=special.city_id,
+            variant=special.variant_id,
+            order=special.order,
+            cost=costs[special.cost_id],
+            effect=effects[special.effect_id],
+            label=unicode(special),
+        )
+
+
+class BuildOptionInfo(Frozen):
+    __slots__ = ('id', 'players_needed', 'building', 'age', 'label')
+
+    @classmethod
+    def from_model(cls, option, buildings):
+        building = buildings[option.building_id]
+        return cls(
+            id=option.id,
+            players_needed=option.players_needed,
+            building=building,
+            age=option.age_id,
+            label=u"%s (+%d)" % (building, option.players_needed),
+        )
+
+
+class AgeInfo(Frozen):
+    __slots__ = ('id', 'name', 'order', 'direction', 'victory_score', 'defeat_score', 'next')
+
+    @classmethod
+    def from_model(cls, age, next):
+        return cls(
+            id=age.id,
+            name=age.name,
+            order=age.order,
+            direction=age.direction,
+            victory_score=age.victory_score,
+            defeat_score=age.defeat_score,
+            next=next, # next AgeInfo, None for the last one
+        )
+
+    def __unicode__(self):
+        return self.name
+
+
+class CityInfo(Frozen):
+    __slots__ = ('id', 'name', 'resource', 'resource_is_basic', 'production')
+
+    @classmethod
+    def from_model(cls, city):
+        return cls(
+            id=city.id,
+            name=city.name,
+            resource=city.resource.name,
+            resource_is_basic=city.resource.is_basic,
+            # One of the resource, as alternatives of RESOURCES ids
+            production=economy.RESOURCES.production([(1, city.resource.name)]),
+        )
+
+    def __unicode__(self):
+        return self.name
+
+
+class Catalog(object):
+    """
+    The whole rule set, with indexes for the lookups used by the game.
+    Loading it takes a fixed number of queries, regardless of its size
+    """
+
+    def __init__(self):
+        # Taken first, so changes made while loading aren't missed
+        self.shared_generation = shared_generation()
+        self.sciences = tuple(models.Science.objects.values_list('name', flat=True))
+        self.variants = tuple(models.Variant.objects.values_list('id', flat=True))
+
+        costs = models.Cost.objects.prefetch_related('costline_set__resource')
+        self.costs = dict((c.id, CostInfo.from_model(c)) for c in costs)
+
+        effects = models.Effect.objects.select_related('kind_payed').prefetch_related(
+            'sciences', 'kinds_scored',
+            'production__costline_set__resource', 'trade__costline_set__resource',
+        )
+        self.effects = dict((e.id, EffectInfo.from_model(e, self.costs)) for e in effects)
+
+        free_having = collections.defaultdict(list)
+        allows_free = collections.defaultdict(list)
+        pairs = models.Building.free_having.through.objects.values_list('from_building_id', 'to_building_id')
+        for building, dependency in pairs:
+            free_having[building].append(dependency)
+            allows_free[dependency].append(building)
+        self.buildings = dict(
+            (b.id, BuildingInfo.from_model(b, self.effects, self.costs, free_having[b.id], allows_free[b.id]))
+            for b in models.Building.objects.all()
+        )
+
+        # Costs and cities give every resource its id, so arrays indexed by
+        # resource id made during play (see economy.ResourceIndex) cover all
+        self.cities = dict((c.id, CityInfo.from_model(c)) for c in models.City.objects.select_related('resource'))
+
+        # Specials by (city, variant), sorted by order
+        self.city_specials = collections.defaultdict(tuple)
+        for s in models.CitySpecial.objects.select_related('city', 'variant').order_by('order'):
+            special = CitySpecialInfo.from_model(s, self.effects, self.costs)
+            self.city_specials[s.city_id, s.variant_id] += (special,)
+
+        self.options = {}
+        # Build options by (age, players_needed)
+        self.decks = collections.defaultdict(tuple)
+        for o in models.BuildOption.objects.all():
+            option = self.options[o.id] = BuildOptionInfo.from_model(o, self.buildings)
+            self.decks[o.age_id, o.players_needed] += (option,)
+        # Option ids to deal by (age, players), as (others, personalities).
+        # Decks stop growing past the largest players_needed
+        self.max_players_needed = max([needed for age, needed in self.decks] or [0])
+        self.deals = {}
+        for age in set(age for age, needed in self.decks):
+            for players in range(self.max_players_needed+1):
+                deck = self.deck(age, players)
+                self.deals[age, players] = (
+                    tuple(o.id for o in deck if o.building.kind != models.PERSONALITY),
+                    tuple(o.id for o in deck if o.building.kind == models.PERSONALITY),
+                )
+
+        self.ages = {}
+        next = None
+        for a in reversed(models.Age.objects.order_by('order')):
+            next = self.ages[a.id] = AgeInfo.from_model(a, next)
+        self.first_age = next
+
+    def age(self, id):
+        return self.ages[id]
+
+    def building(self, id):
+        return self.buildings[id]
+
+    def city(self, id):
+        return self.cities[id]
+
+    def option(self, id):
+        return self.options[id]
+
+    def specials(self, city, variant):
+        """Every special for a city and variant (ids), sorted by order"""
+        return self.city_specials[city, variant]
+
+    def special(self, city, variant, order):
+        """Special with the given order, None if there's no such special"""
+        for s in self.specials(city, variant):
+            if s.order == order:
+                return s
+
+    def next_special(self, city, variant, built):
+        """
+        Next special to build for city and variant (ids), when specials
+        with order lower than built are already built. None if all built
+        """
+        for s in self.specials(city, variant):
+            if s.order >= built:
+                return s
+
+    def built_specials(self, city, variant, built):
+        """Specials for city and variant (ids) with order lower than built"""
+        return [s for s in self.specials(city, variant) if s.order < built]
+
+    def deck(self, age, players):
+        """Every build option for the age (id) usable with players players"""
+        result = []
+        for needed in range(players+1):
+            result.extend(self.decks[age, needed])
+        return result
+
+    def deal(self, age, players):
+        """
+        Ids of the options in deck(age, players), as a tuple of those which
+        aren't personalities and a tuple of personalities
+        """
+        return self.deals.get((age, min(players, self.max_players_needed)), ((), ()))
+
+
+SHARED_GENERATION_KEY = 'evolve-rules-catalog-generation'
+CHECK_INTERVAL = 5 # Seconds between checks of the shared generation
+# Seconds the shared generation is kept. When it expires every process loads
+# the rules again, so it's much longer than the cache default
+GENERATION_TIMEOUT = 365 * 24 * 60 * 60
+
+_catalog = None
+_generation = 0 # Increased on every invalidation
+_checked = 0 # When the shared generation was last checked
+
+def shared_generation():
+    """Generation of the rules shared by every process; see invalidate"""
+    return cache.get(SHARED_GENERATION_KEY, 0)
+
+def get():
+    """The current Catalog, loading it if needed"""
+    global _catalog, _checked
+    catalog = _catalog
+    now = time.time()
+    if catalog is not None and now - _checked >= CHECK_INTERVAL:
+        # Rules may have changed in another process
+        _checked = now
+        if shared_generation() != catalog.shared_generation:
+            catalog = None
+    if catalog is None:
+        generation = _generation
+        catalog = Catalog()
+        # Don't keep it if rules changed while loading
+        if generation == _generation:
+            _catalog = catalog
+            _checked = now
+    return catalog
+
+def invalidate(**kwargs):
+    """
+    Discard the current catalog, here and (see shared_generation) in every
+    other process. Works as a signal receiver
+    """
+    global _catalog, _generation
+    _generation += 1
+    _catalog = None
+    # Not cache.incr, which keeps the default timeout on most backends
+    cache.set(SHARED_GENERATION_KEY, shared_generation() + 1, GENERATION_TIMEOUT)
+
+def first_age_id():
+    """Id of the first age"""
+    return get().first_age.id
+
+RULES_MODELS = (
+    models.BuildingKind, models.Resource, models.Science, models.Variant,
+    models.Age, models.Cost, models.CostLine, models.City, models.Effect,
+    models.CitySpecial, models.Building, models.BuildOption,
+)
+for model in RULES_MODELS:
+    signals.post_save.connect(invalidate, sender=model, dispatch_uid='catalog-save-%s' % model.__name__)
+    signals.post_delete.connect(invalidate, sender=model, dispatch_uid='catalog-delete-%s' % model.__name__)
+for through in (models.Effect.sciences.through, models.Effect.kinds_scored.through, models.Building.free_having.through):
+    signals.m2m_changed.connect(invalidate, sender=through, dispatch_uid='catalog-m2m-%s' % through.__name__)
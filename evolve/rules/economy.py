@@ -1,11 +1,75 @@
+import array
+import bisect
+import copy
+import threading
+
+class ResourceIndex(object):
+    """
+    Interns resource names as small integer ids, so the payment solver can
+    work on tuples of ints instead of dicts keyed by name. Ids are given in
+    order of appearance and don't change during the life of the process.
+    """
+    __slots__ = ('ids', 'names', 'lock')
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def id(self, name):
+        """Id for the given resource name"""
+        result = self.ids.get(name)
+        if result is None:
+            with self.lock:
+                result = self.ids.get(name)
+                if result is None:
+                    result = self.ids[name] = len(self.names)
+                    self.names.append(name)
+        return result
+
+    def name(self, id):
+        """Name of the resource with the given id"""
+        return self.names[id]
+
+    def requirements(self, cost):
+        """
+        Needed resources in a cost dict (like the ones from Cost.to_dict)
+        as a tuple of (id, amount) sorted by id. Money is not included.
+        """
+        return tuple(sorted((self.id(r), amount) for r, amount in cost.items() if r != '$' and amount > 0))
+
+    def production(self, alternatives):
+        """A list of (amount, resource name) alternatives, as a tuple of (amount, id)"""
+        return tuple((amount, self.id(r)) for amount, r in alternatives)
+
+    def unit_costs(self, costs):
+        """
+        A mapping of resource name -> trade cost (like the ones from
+        Player.trade_costs) as an array indexed by id. Arrays made by this
+        method, covering every id, are returned as they are
+        """
+        if isinstance(costs, array.array) and len(costs) == len(self.names):
+            return costs
+        return array.array('i', [costs[name] for name in list(self.names)])
+
+# Resource ids shared by everything in the process
+RESOURCES = ResourceIndex()
+
 class ResourceSet(object):
+    __slots__ = ('data', 'total')
+
     def __init__(self):
         self.data = {}
+        self.total = 0 # Sum of the costs in data, kept up to date by add()
 
     def add(self, resource, amount, cost=0):
         current = self.data.get(resource, (0,0))
         new = (current[0]+amount, current[1]+cost)
         self.data[resource] = new
+        self.total += cost
 
     def get(self, resource):
         return self.data.get(resource, (0,0))
@@ -14,9 +78,11 @@ class ResourceSet(object):
         return resource in self.data and self.data[resource][0] >= amount
     
     def cost(self):
-        return sum(cost for (resource,(amount, cost)) in self.data.iteritems())
+        return self.total
 
 class PaymentOption(object):
+    __slots__ = ('money', 'left_trade', 'right_trade', 'local')
+
     def __init__(self):
         self.money = 0
         self.left_trade = ResourceSet()
@@ -29,20 +95,216 @@ class PaymentOption(object):
         
         Better means that in needs no more money in any direction, and strictly less money in at least one direction
         """
-        return (self.left_trade.cost() <= other.left_trade.cost()) and (self.right_trade.cost() <= other.right_trade.cost())
+        return (self.left_trade.total <= other.left_trade.total) and (self.right_trade.total <= other.right_trade.total)
+
+    def trade_costs(self):
+        """(left cost, right cost) pair"""
+        return self.left_trade.total, self.right_trade.total
 
     def __unicode__(self):
-        left = self.left_trade.cost()
-        right = self.right_trade.cost()
+        left, right = self.trade_costs()
         return "$%d ($%d left, $%d right)" % (self.money+left+right, left, right)
 
 
+class ParetoFront(object):
+    """
+    Collection of items keyed by (left cost, right cost), where only items
+    not "worse" than another one (in the PaymentOption.better_than sense)
+    are kept. Of several items with the same costs, the first one added is
+    kept.
+
+    Items are kept sorted by left cost, so their right costs are strictly
+    decreasing. Adding an item is O(log n) plus the items it discards, so
+    building a front from n items is O(n log n).
+    """
+
+    def __init__(self, items=()):
+        # Parallel lists, sorted by left cost
+        self.lefts = []
+        self.rights = []
+        self.items = []
+        for left, right, item in items:
+            self.add(left, right, item)
+
+    def add(self, left, right, item):
+        """Add item with the given costs. Returns True if it was kept"""
+        i = bisect.bisect_left(self.lefts, left)
+        # Items before i have lower left cost; the last of them has the
+        # lowest right cost among them
+        if i > 0 and self.rights[i-1] <= right:
+            return False
+        if i < len(self.lefts) and self.lefts[i] == left and self.rights[i] <= right:
+            return False
+        # Items from i onwards have no lower left cost; discard the ones that
+        # don't have a lower right cost either
+        j = i
+        while j < len(self.rights) and self.rights[j] >= right:
+            j += 1
+        self.lefts[i:j] = [left]
+        self.rights[i:j] = [right]
+        self.items[i:j] = [item]
+        return True
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        """Iterate on (left cost, right cost, item), sorted by left cost"""
+        return iter(zip(self.lefts, self.rights, self.items))
+
+    def by_total(self):
+        """Items sorted like get_payments results: by total cost, then left cost"""
+        entries = sorted(self, key=lambda e: (e[0]+e[1], e[0]))
+        return [item for left, right, item in entries]
+
+def undominated_options(options):
+    """
+    Payment options with no other option "better" than it, sorted like
+    get_payments results
+    """
+    front = ParetoFront((o.left_trade.total, o.right_trade.total, o) for o in options)
+    return front.by_total()
+
 def empty_cost(cost):
     # cost is a dict, {resource_name: required_amount}. It also maps '$' to the needed money
     # returns True if there's something to pay
     return sum(cost.values())==0
 
-def get_payments(cost, money, local_resources, left_resources, left_costs, right_resources, right_costs):
+def get_payments(cost, money, local_resources, left_resources, left_costs, right_resources, right_costs, stats=None):
+    """
+    List of ways of paying cost, empty if it can't be payed.
+
+    Only options that are not worse (in the PaymentOption.better_than sense)
+    than another one are returned, sorted by total trade cost and then by
+    the trade cost with the left neighbor. Arguments are the same as in
+    get_payments_base; they're translated to resource ids for
+    get_payments_by_id. Trade costs can also be given already translated, as
+    made by RESOURCES.unit_costs.
+    If stats is a dict, the PaymentSolver.stats are added to it (all zeros
+    when no search was needed).
+    """
+    production = RESOURCES.production
+    return get_payments_by_id(
+        cost.get('$', 0),
+        RESOURCES.requirements(cost),
+        money,
+        [production(p) for p in local_resources],
+        [production(p) for p in left_resources],
+        RESOURCES.unit_costs(left_costs),
+        [production(p) for p in right_resources],
+        RESOURCES.unit_costs(right_costs),
+        stats=stats,
+    )
+
+# Stats of the payments found without a PaymentSolver search
+_NO_SEARCH = {'depth': 0, 'states': 0, 'dead_states': 0, 'plans': 0}
+
+def get_payments_by_id(money_cost, requirements, money, local, left, left_costs, right, right_costs, stats=None):
+    """
+    Same as get_payments, with arguments as PaymentSolver takes them, so
+    callers can translate them to resource ids once and reuse them.
+
+    Most costs need no search, because each producer can only help with
+    one of the resources needed (see _independent_payments); a
+    PaymentSolver is built only for the rest
+    """
+    solver = None
+    if money_cost > money:
+        result = [] # Not enough money
+    else:
+        result = _independent_payments(money_cost, requirements, money, local, left, left_costs, right, right_costs)
+        if result is None:
+            solver = PaymentSolver(money_cost, requirements, money, local, left, left_costs, right, right_costs)
+            result = solver.solve()
+    if stats is not None:
+        stats.update(solver.stats() if solver is not None else _NO_SEARCH, options=len(result))
+    return result
+
+def _most(needed, producers):
+    """
+    Most of each needed resource (a dict by id) that producers can make,
+    or None if some producer has alternatives for two of them
+    """
+    result = dict.fromkeys(needed, 0)
+    for alternatives in producers:
+        resource, best = None, 0
+        for amount, r in alternatives:
+            if r in needed:
+                if resource is not None and r != resource:
+                    return None
+                resource, best = r, max(best, amount)
+        if resource is not None:
+            result[resource] += best
+    return result
+
+def _independent_payments(money_cost, requirements, money, local, left, left_costs, right, right_costs):
+    """
+    Same as PaymentSolver.solve, when no producer has to choose between
+    two resources needed, so each resource can be payed on its own: local
+    producers are used as much as possible, and buying each possible amount
+    from the left (and the rest from the right) gives every way of paying
+    for it. None if some producer has that choice
+    """
+    needed = dict(requirements)
+    local_most = _most(needed, local)
+    if local_most is None:
+        return None
+    used = {}
+    missing = []
+    for r, amount in requirements:
+        used[r] = min(amount, local_most[r])
+        if amount > used[r]:
+            missing.append((r, amount - used[r]))
+    # Plans of trade, as (left cost, right cost, ((id, bought left, bought right)...))
+    plans = [(0, 0, ())]
+    if missing:
+        left_most, right_most = _most(needed, left), _most(needed, right)
+        if left_most is None or right_most is None:
+            return None
+        budget = money - money_cost
+        # Most costs can't be payed; check that first, as the solver does
+        bound = 0
+        for r, amount in missing:
+            if amount > left_most[r] + right_most[r]:
+                return []
+            bound += amount * min(left_costs[r], right_costs[r])
+        if bound > budget:
+            return []
+        for r, amount in missing:
+            left_unit, right_unit = left_costs[r], right_costs[r]
+            plans = [
+                (left_cost + bought * left_unit, right_cost + (amount - bought) * right_unit, plan + ((r, bought, amount - bought),))
+                for bought in range(max(0, amount - right_most[r]), min(amount, left_most[r]) + 1)
+                for left_cost, right_cost, plan in plans
+            ]
+            plans = [p for p in plans if p[0] + p[1] <= budget]
+    if len(plans) > 1:
+        plans = ParetoFront(plans).by_total()
+    else:
+        plans = [plan for left_cost, right_cost, plan in plans]
+    result = []
+    for plan in plans:
+        option = PaymentOption()
+        option.money = money_cost
+        for r, amount in used.items():
+            if amount:
+                option.local.add(RESOURCES.name(r), amount)
+        for r, left_bought, right_bought in plan:
+            name = RESOURCES.name(r)
+            if left_bought:
+                option.left_trade.add(name, left_bought, left_bought * left_costs[r])
+            if right_bought:
+                option.right_trade.add(name, right_bought, right_bought * right_costs[r])
+        result.append(option)
+    return result
+
+def get_payments_reference(cost, money, local_resources, left_resources, left_costs, right_resources, right_costs):
+    """
+    Exhaustive version of get_payments. It's exponential on the number of
+    producers, so it is kept only as a reference to check PaymentSolver
+    against; game code should use get_payments.
+    """
+    cost = copy.copy(cost) # get_payments_base modifies the cost
     results = get_payments_base(cost, money, local_resources, left_resources, left_costs, right_resources, right_costs)
     # This sorting order implies that, if an option is "better" than another, the "better" one is on the left
     results.sort(key=lambda o: (o.left_trade.cost()+o.right_trade.cost(), o.left_trade.cost()))
@@ -130,6 +392,245 @@ def get_payments_base(cost, money, local_resources, left_resources, left_costs,
     else:
         return [] # Can't afford
 
+# Kinds of steps in the payment plans built by PaymentSolver; each one is
+# the PaymentOption attribute where the step is recorded
+LOCAL, LEFT_TRADE, RIGHT_TRADE = 'local', 'left_trade', 'right_trade'
+
+_UNPAYABLE = object() # Marks states that have no way to be payed
+
+def _reduce(remaining, index, amount):
+    """Copy of the remaining cost tuple, with amount less of the resource at index"""
+    result = list(remaining)
+    result[index] -= amount
+    return tuple(result)
+
+class PaymentSolver(object):
+    """
+    Computes the same payment options as get_payments_reference, without
+    enumerating every possible raw payment. A few facts of the rules make
+    that possible:
+
+     - Local resources are free, so using a local producer for a needed
+       resource is never worse than not using it, and it's worth using it
+       as much as possible.
+     - Trade is payed per unit, so the cost of what is bought from the right
+       neighbor does not depend on which producers are selling it. Once the
+       trade with the left neighbor is decided, the right side only needs to
+       be feasible.
+     - The ways of paying from a given state (the producer being considered
+       and the remaining cost) don't depend on how that state was reached,
+       so they are computed once per solver, and only undominated options
+       are kept (in a ParetoFront). Money is not part of the state because all the states of a
+       solver share the same budget.
+
+    Branches that need more resources than what's left to produce, or more
+    money than the budget, are dropped without exploring them.
+
+    Payment plans are kept as linked tuples (step, rest of the plan) so they
+    can be shared between states; PaymentOptions are only built for the
+    final results.
+
+    Resources are identified by their RESOURCES ids:
+     - requirements is a tuple of (id, amount), like ResourceIndex.requirements
+     - local, left and right are lists of producers, each one a tuple of
+       (amount, id) alternatives, like ResourceIndex.production
+     - left_costs and right_costs are trade costs indexed by id, like
+       ResourceIndex.unit_costs
+    Other arguments are the same as in get_payments_base.
+    """
+
+    def __init__(self, money_cost, requirements, money, local, left, left_costs, right, right_costs):
+        self.money = money_cost
+        self.budget = money - money_cost # Money available for trading
+        # Only resources needed are considered. Remaining costs are tuples of
+        # amounts indexed like self.ids
+        self.ids = tuple(r for r, amount in requirements)
+        self.need = tuple(amount for r, amount in requirements)
+        index = dict((r, i) for i, r in enumerate(self.ids))
+        self.local = self._producers(local, index)
+        self.left = self._producers(left, index)
+        self.right = self._producers(right, index)
+        self.left_costs = tuple(left_costs[r] for r in self.ids)
+        self.right_costs = tuple(right_costs[r] for r in self.ids)
+        assert all(c > 0 for c in self.left_costs + self.right_costs)
+        self.cheapest_costs = tuple(min(l, r) for l, r in zip(self.left_costs, self.right_costs))
+        # Capacities of the producers from each position onwards
+        self.local_capacity = self._capacities(self.local)
+        self.left_capacity = self._capacities(self.left)
+        self.right_capacity = self._capacities(self.right)
+        self.nothing = self.local_capacity[-1] # All zeros
+        # Trade capacity from each left producer onwards; right producers are
+        # always available after them
+        self.left_trade_capacity = [tuple(l+r for l, r in zip(capacity, self.right_capacity[0])) for capacity in self.left_capacity]
+        self.trade_capacity = self.left_trade_capacity[0]
+        # Memoized results, per stage
+        self.local_memo = {}
+        self.left_memo = {}
+        self.right_memo = {}
+
+    @staticmethod
+    def _producers(producers, index):
+        """
+        Producers as tuples of (amount, position in the remaining costs).
+        Alternatives not needed are dropped, and so are producers without
+        alternatives left
+        """
+        result = []
+        for alternatives in producers:
+            useful = tuple((amount, index[r]) for amount, r in alternatives if r in index)
+            if useful:
+                result.append(useful)
+        return result
+
+    def _capacities(self, producers):
+        """
+        For each position in producers, maximum amount of each resource that
+        can be produced from that position onwards
+        """
+        capacity = [0] * len(self.ids)
+        result = [tuple(capacity)]
+        for alternatives in reversed(producers):
+            for amount, r in alternatives:
+                capacity[r] += amount
+            result.append(tuple(capacity))
+        result.reverse()
+        return result
+
+    def _hopeless(self, remaining, free_capacity, trade_capacity, unit_costs):
+        """
+        True if remaining can't be covered with the given capacities, or if
+        the trade it needs would cost more than the budget
+        """
+        bound = 0
+        for amount, free, trade, unit in zip(remaining, free_capacity, trade_capacity, unit_costs):
+            if amount > free:
+                if amount > free + trade:
+                    return True
+                bound += (amount - free) * unit
+        return bound > self.budget
+
+    def solve(self):
+        """List of undominated PaymentOptions, sorted like get_payments"""
+        if self.budget < 0:
+            return [] # Not enough money
+        options = self._local_options(0, self.need)
+        return [self._payment(plan) for plan in options.by_total()]
+
+    def stats(self):
+        """
+        Size of the search done by solve, for profiling: its depth (the
+        number of useful producers), the states explored, how many of them
+        were dead ends, and the undominated plans kept for all of them
+        """
+        fronts = self.local_memo.values() + self.left_memo.values()
+        return {
+            'depth': len(self.local) + len(self.left) + len(self.right),
+            'states': len(fronts) + len(self.right_memo),
+            'dead_states': sum(1 for f in fronts if not len(f)) + sum(1 for p in self.right_memo.values() if p is _UNPAYABLE),
+            'plans': sum(len(f) for f in fronts),
+        }
+
+    def _payment(self, plan):
+        """Build a PaymentOption from a payment plan"""
+        result = PaymentOption()
+        result.money = self.money
+        while plan is not None:
+            (kind, r, amount, cost), plan = plan
+            getattr(result, kind).add(RESOURCES.name(self.ids[r]), amount, cost)
+        return result
+
+    def _local_options(self, i, remaining):
+        """
+        Undominated ways of paying remaining, using local producers from
+        position i, and then trade. A ParetoFront of plans
+        """
+        key = (i, remaining)
+        if key in self.local_memo:
+            return self.local_memo[key]
+        if not any(remaining):
+            result = ParetoFront([(0, 0, None)])
+        elif self._hopeless(remaining, self.local_capacity[i], self.trade_capacity, self.cheapest_costs):
+            result = ParetoFront()
+        elif i == len(self.local):
+            result = self._left_options(0, remaining)
+        else:
+            useful = [(amount, r) for amount, r in self.local[i] if remaining[r]]
+            if not useful:
+                result = self._local_options(i+1, remaining)
+            else:
+                # Not using the producer is never better than using it
+                result = ParetoFront()
+                for amount, r in useful:
+                    used = min(amount, remaining[r])
+                    step = (LOCAL, r, used, 0)
+                    for left, right, plan in self._local_options(i+1, _reduce(remaining, r, used)):
+                        result.add(left, right, (step, plan))
+        self.local_memo[key] = result
+        return result
+
+    def _left_options(self, i, remaining):
+        """
+        Undominated ways of paying remaining by trade, buying from left
+        producers from position i. A ParetoFront of plans
+        """
+        key = (i, remaining)
+        if key in self.left_memo:
+            return self.left_memo[key]
+        if not any(remaining):
+            result = ParetoFront([(0, 0, None)])
+        elif self._hopeless(remaining, self.nothing, self.left_trade_capacity[i], self.cheapest_costs):
+            result = ParetoFront()
+        elif i == len(self.left):
+            plan = self._right_plan(0, remaining)
+            if plan is _UNPAYABLE:
+                result = ParetoFront()
+            else:
+                right_cost = sum(amount*unit for amount, unit in zip(remaining, self.right_costs))
+                result = ParetoFront([(0, right_cost, plan)])
+        else:
+            # Ways of paying without buying from this producer
+            result = ParetoFront(self._left_options(i+1, remaining))
+            # Ways of buying each possible amount of each alternative
+            for amount, r in self.left[i]:
+                unit = self.left_costs[r]
+                for bought in range(1, min(amount, remaining[r])+1):
+                    pay = bought * unit
+                    step = (LEFT_TRADE, r, bought, pay)
+                    for left, right, plan in self._left_options(i+1, _reduce(remaining, r, bought)):
+                        if left+pay+right <= self.budget:
+                            result.add(left+pay, right, (step, plan))
+        self.left_memo[key] = result
+        return result
+
+    def _right_plan(self, i, remaining):
+        """
+        Plan to buy remaining from right producers from position i, or
+        _UNPAYABLE. Every plan costs the same, so any one will do
+        """
+        key = (i, remaining)
+        if key in self.right_memo:
+            return self.right_memo[key]
+        if not any(remaining):
+            result = None
+        elif self._hopeless(remaining, self.nothing, self.right_capacity[i], self.right_costs):
+            result = _UNPAYABLE
+        else:
+            useful = [(amount, r) for amount, r in self.right[i] if remaining[r]]
+            if not useful:
+                result = self._right_plan(i+1, remaining)
+            else:
+                # Buying as much as possible from this producer is never
+                # worse than leaving part of it to the next ones
+                result = _UNPAYABLE
+                for amount, r in useful:
+                    bought = min(amount, remaining[r])
+                    plan = self._right_plan(i+1, _reduce(remaining, r, bought))
+                    if plan is not _UNPAYABLE:
+                        result = ((RIGHT_TRADE, r, bought, bought*self.right_costs[r]), plan)
+                        break
+        self.right_memo[key] = result
+        return result
+
 def can_pay(options, left, right):
     """
     Given a list of payment options, check that it can be paid in some way using the exact given amount of trade.
@@ -25,6 +25,8 @@ KINDS = (
     ('sci','Scientific'),
     (PERSONALITY,'Personality'),
 )
+# Position of each kind in KINDS, for per kind counters
+KIND_INDEX = dict((kind, i) for i, (kind, label) in enumerate(KINDS))
 
 TRADEABLE = ('bas','cpx')
 
@@ -204,7 +206,58 @@ class City(models.Model):
         verbose_name_plural = 'cities'
 
 
-class Effect(models.Model):
+class EffectRules(object):
+    """
+    Game rules for effects. Shared by Effect and the effects in
+    evolve.rules.catalog; needs the Effect fields as attributes, and a
+    scored_kinds() method returning the kinds in kinds_scored
+    """
+    __slots__ = ()
+
+    def get_score(self, local, left, right):
+        """
+        Score (as an int, not a Score() instance) produced by this effect
+        
+        local, left, right are Player-like objects, i.e., they just need to have
+        the following methods:
+           - count(kind): returning number of buildings of given kind
+           - specials(): number of specials built        
+           - defeats(): number of defeats suffered        
+        """
+        result = self.score
+        for k in self.scored_kinds():
+            result += self.score_per_local_building * local.count(k)
+            result += self.score_per_neighbor_building * left.count(k)
+            result += self.score_per_neighbor_building * right.count(k)
+        result += self.score_per_local_special * local.specials()
+        result += self.score_per_neighbor_special * (left.specials() + right.specials())
+        result += self.score_per_neighbor_defeat * (left.defeats() + right.defeats())
+        return result
+    
+    def money(self, local, left, right):
+        """
+        Money produced by this effect for local when its neighbors are left
+        and right.
+        
+        local, left, right are Player-like objects, i.e., they just need to have
+        the following methods:
+           - count(kind): returning number of buildings of given kind
+           - specials(): number of specials built
+        """
+        result = 0
+        if self.production:
+            result += self.production.money
+        if self.money_per_neighbor_building:
+            result += self.money_per_neighbor_building * (left.count(self.kind_payed)+right.count(self.kind_payed))
+        if self.money_per_local_building:
+            result += self.money_per_local_building * local.count(self.kind_payed)
+        if self.money_per_neighbor_special:
+            result += self.money_per_neighbor_special * (left.specials()+right.specials())
+        if self.money_per_local_special:
+            result += self.money_per_local_special * local.specials()
+        return result
+
+class Effect(EffectRules, models.Model):
     """
     The effect of a card or special. Note that typically only one of the
     fields will be used, but multiple can be
@@ -256,49 +309,9 @@ class Effect(models.Model):
     use_discards = models.BooleanField()
     copy_personality = models.BooleanField()
     
-    def get_score(self, local, left, right):
-        """
-        Score (as an int, not a Score() instance) produced by this effect
-        
-        local, left, right are Player-like objects, i.e., they just need to have
-        the following methods:
-           - count(kind): returning number of buildings of given kind
-           - specials(): number of specials built        
-           - defeats(): number of defeats suffered        
-        """
-        result = self.score
-        for k in self.kinds_scored.all():
-            result += self.score_per_local_building * local.count(k)
-            result += self.score_per_neighbor_building * left.count(k)
-            result += self.score_per_neighbor_building * right.count(k)
-        result += self.score_per_local_special * local.specials()
-        result += self.score_per_neighbor_special * (left.specials() + right.specials())
-        result += self.score_per_neighbor_defeat * (left.defeats() + right.defeats())
-        return result
-    
-    def money(self, local, left, right):
-        """
-        Money produced by this effect for local when its neighbors are left
-        and right.
-        
-        local, left, right are Player-like objects, i.e., they just need to have
-        the following methods:
-           - count(kind): returning number of buildings of given kind
-           - specials(): number of specials built
-        """
-        result = 0
-        if self.production:
-            result += self.production.money
-        if self.money_per_neighbor_building:
-            result += self.money_per_neighbor_building * (left.count(self.kind_payed)+right.count(self.kind_payed))
-        if self.money_per_local_building:
-            result += self.money_per_local_building * local.count(self.kind_payed)
-        if self.money_per_neighbor_special:
-            result += self.money_per_neighbor_special * (left.specials()+right.specials())
-        if self.money_per_local_special:
-            result += self.money_per_local_special * local.specials()
-        return result
-    
+    def scored_kinds(self):
+        return self.kinds_scored.all()
+
     def clean(self):
         # trade should be set iff a direction is
         has_trade_1 = self.trade is not None
@@ -381,32 +394,43 @@ class CitySpecial(models.Model):
         )
         ordering = ('city', 'variant', 'order')
 
-class Building(models.Model):
+class BuildingRules(object):
     """
-    What a player can put in cities to have its effects applied
+    Game rules for buildings. Shared by Building and the buildings in
+    evolve.rules.catalog; needs effect and a kind_name() method
     """
-    name = models.CharField(max_length=30, unique=True)
-    kind = models.ForeignKey(BuildingKind)
-    effect = models.ForeignKey(Effect)
-
-    cost = models.ForeignKey(Cost)
-    free_having = models.ManyToManyField('self', blank=True, null=True, symmetrical=False, related_name='allows_free') # This models is free when having other bulding
+    __slots__ = ()
 
     def score(self, local, left, right):
         """
         Score() object for this building
         """
         amount = self.effect.get_score(local, left, right)
-        if self.kind.name == 'eco': # FIXME: hardcoded constant
+        kind = self.kind_name()
+        if kind == 'eco': # FIXME: hardcoded constant
             return Score.new()._replace(economy=amount)
-        elif self.kind.name == 'civ': # FIXME: hardcoded constant
+        elif kind == 'civ': # FIXME: hardcoded constant
             return Score.new()._replace(civilian=amount)
-        elif self.kind.name == PERSONALITY:
+        elif kind == PERSONALITY:
             return Score.new()._replace(personality=amount)
         else:
             assert amount == 0
             return Score.new()
 
+class Building(BuildingRules, models.Model):
+    """
+    What a player can put in cities to have its effects applied
+    """
+    name = models.CharField(max_length=30, unique=True)
+    kind = models.ForeignKey(BuildingKind)
+    effect = models.ForeignKey(Effect)
+
+    cost = models.ForeignKey(Cost)
+    free_having = models.ManyToManyField('self', blank=True, null=True, symmetrical=False, related_name='allows_free') # This models is free when having other bulding
+
+    def kind_name(self):
+        return self.kind.name
+
     def __unicode__(self):        
         return self.name
 
@@ -0,0 +1,115 @@
+"""
+Science scoring.
+
+Each science effect a player has lets them pick one of its sciences. The
+score for a given pick is
+
+    min(counts)*SCIENCE_SCORE_PER_GROUP + sum(count**2 for count in counts)
+
+where counts has how many times each science was picked, and the player
+gets the best score among all possible picks.
+"""
+import collections
+
+from evolve.rules import constants
+
+def vector_score(counts):
+    """Score for a vector of science counts"""
+    return min(counts)*constants.SCIENCE_SCORE_PER_GROUP + sum(amount**2 for amount in counts)
+
+def science_score(choices, sciences):
+    """
+    Best score for a player with the given science effects.
+
+    choices is a list with the sciences available at each effect (an
+    iterable of science names); sciences is the list of every science name.
+
+    Instead of trying every pick, this works on count vectors: effects with
+    the same sciences are grouped, because only how many of them go to each
+    science matters, and vectors reached in several ways are only kept once.
+    Vectors that can't beat the best score already known to be possible,
+    even if all the effects left were added to them in the best way, are
+    dropped.
+    """
+    if not sciences:
+        return 0
+    index = dict((name, i) for i, name in enumerate(sciences))
+    base = [0] * len(sciences)
+    groups = collections.defaultdict(lambda: 0)
+    for choice in choices:
+        choice = tuple(sorted(set(index[name] for name in choice)))
+        if len(choice) == 1:
+            base[choice[0]] += 1 # No choice at all
+        elif choice:
+            groups[choice] += 1
+    groups = sorted(groups.items())
+    pending = sum(amount for choice, amount in groups)
+
+    vectors = set([tuple(base)])
+    best = vector_score(base)
+    for n, (choice, amount) in enumerate(groups):
+        if not vectors:
+            break # Nothing can beat best
+        pending -= amount
+        vectors = set(
+            _add(vector, choice, split)
+            for vector in vectors
+            for split in _splits(amount, len(choice))
+        )
+        # Any completion of a vector is a possible score
+        best = max(best, max(vector_score(_complete(v, groups[n+1:])) for v in vectors))
+        vectors = [v for v in vectors if _upper_bound(v, pending) > best]
+    if vectors:
+        best = max(best, max(vector_score(v) for v in vectors))
+    return best
+
+def _splits(amount, parts):
+    """Every way of splitting amount in the given number of parts, as tuples"""
+    if parts == 1:
+        yield (amount,)
+    else:
+        for first in range(amount+1):
+            for rest in _splits(amount-first, parts-1):
+                yield (first,) + rest
+
+def _add(vector, choice, split):
+    """vector, with split[i] added at position choice[i]"""
+    result = list(vector)
+    for i, amount in zip(choice, split):
+        result[i] += amount
+    return tuple(result)
+
+def _complete(vector, groups):
+    """A possible final vector from vector: each group goes to its most picked science"""
+    result = list(vector)
+    for choice, amount in groups:
+        best = max(choice, key=lambda i: result[i])
+        result[best] += amount
+    return result
+
+def _upper_bound(vector, pending):
+    """
+    No vector reached from vector adding pending picks scores more than this.
+    The minimum can grow at most to an even split of everything, and the
+    squares grow the most when all the picks go to the largest count
+    """
+    lowest = min(min(vector) + pending, (sum(vector) + pending) // len(vector))
+    largest = max(vector)
+    squares = sum(amount**2 for amount in vector) + 2*largest*pending + pending**2
+    return lowest*constants.SCIENCE_SCORE_PER_GROUP + squares
+
+def science_score_reference(choices, sciences):
+    """
+    Exhaustive version of science_score, trying every possible pick. It's
+    exponential on the number of effects, so it is kept only as a reference
+    to check science_score against.
+    """
+    index = dict((name, i) for i, name in enumerate(sciences))
+    combinations = set([(0,)*len(sciences)])
+    for choice in choices:
+        combinations = set(
+            _add(c, (index[name],), (1,))
+            for name in choice
+            for c in combinations
+        )
+    return max(vector_score(c) for c in combinations)
@@ -0,0 +1,162 @@
+"""
+Synthetic rule sets, for tests and benchmarks.
+
+The real rules are loaded from fixtures that are tuned by hand; these are
+random (but reproducible, given a seed) rule sets with enough cities and
+build options to play games with up to 7 players, and with every kind of
+effect in use.
+"""
+import random
+
+from evolve.rules import models, constants
+
+BASIC_RESOURCES = ('Clay', 'Ore', 'Stone', 'Wood')
+COMPLEX_RESOURCES = ('Cloth', 'Glass', 'Papyrus')
+SCIENCES = ('Compass', 'Gear', 'Tablet')
+VARIANTS = ('A', 'B')
+CITIES = ('Alexandria', 'Babylon', 'Ephesus', 'Gizah', 'Halikarnassos', 'Olympia', 'Rhodos')
+AGES = (('I', 'l', 1), ('II', 'r', 3), ('III', 'l', 5))
+MAXIMUM_PLAYERS = len(CITIES)
+
+class RulesFactory(object):
+    """Creates a random rule set in the database"""
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.count = 0 # Used to build unique names
+        self.previous_buildings = [] # Buildings of the previous age
+
+    def name(self, prefix):
+        self.count += 1
+        return '%s %d' % (prefix, self.count)
+
+    def create(self):
+        """Create the whole rule set"""
+        self.kinds = dict(
+            (name, models.BuildingKind.objects.create(name=name))
+            for name, label in models.KINDS
+        )
+        self.resources = [
+            models.Resource.objects.create(name=name, is_basic=name in BASIC_RESOURCES)
+            for name in BASIC_RESOURCES + COMPLEX_RESOURCES
+        ]
+        self.sciences = [models.Science.objects.create(name=name) for name in SCIENCES]
+        self.variants = [models.Variant.objects.create(label=label) for label in VARIANTS]
+        self.ages = [
+            models.Age.objects.create(name=name, order=order, direction=direction, victory_score=score)
+            for order, (name, direction, score) in enumerate(AGES)
+        ]
+        for name in CITIES:
+            city = models.City.objects.create(name=name, resource=self.rng.choice(self.resources[:len(BASIC_RESOURCES)]))
+            for variant in self.variants:
+                for order in range(3):
+                    models.CitySpecial.objects.create(
+                        city=city, variant=variant, order=order,
+                        cost=self.cost(order+2),
+                        effect=self.effect(self.rng.choice(['score', 'military', 'production', 'money'])),
+                    )
+        for age in self.ages:
+            self.create_age(age)
+
+    def cost(self, size):
+        """A cost with about size resources"""
+        cost = models.Cost.objects.create(money=self.rng.choice([0, 0, 0, 1, 2]))
+        for resource in self.rng.sample(self.resources, self.rng.randint(1, min(size, 3))):
+            models.CostLine.objects.create(cost=cost, resource=resource, amount=self.rng.randint(1, max(1, size//2)))
+        return cost
+
+    def production(self, resources):
+        """A production cost for one of resources, or for two alternatives"""
+        production = models.Cost.objects.create()
+        for resource in self.rng.sample(resources, self.rng.choice([1, 1, 2])):
+            models.CostLine.objects.create(cost=production, resource=resource, amount=self.rng.choice([1, 1, 2]))
+        return production
+
+    def effect(self, kind):
+        """A new effect of the given kind of building"""
+        rng = self.rng
+        if kind == 'bas':
+            return models.Effect.objects.create(production=self.production(self.resources[:len(BASIC_RESOURCES)]))
+        elif kind == 'cpx':
+            return models.Effect.objects.create(production=self.production(self.resources[len(BASIC_RESOURCES):]))
+        elif kind in ('mil', 'military'):
+            return models.Effect.objects.create(military=rng.randint(1, 3))
+        elif kind in ('civ', 'score'):
+            return models.Effect.objects.create(score=rng.randint(2, 8))
+        elif kind == 'sci':
+            effect = models.Effect.objects.create()
+            effect.sciences.add(*rng.sample(self.sciences, rng.choice([1, 1, 1, 2, 3])))
+            return effect
+        elif kind == 'production':
+            return models.Effect.objects.create(production=self.production(self.resources))
+        elif kind == 'money':
+            production = models.Cost.objects.create(money=rng.randint(2, 6))
+            return models.Effect.objects.create(production=production)
+        elif kind == 'eco':
+            choice = rng.choice(['trade', 'money', 'kind_money'])
+            if choice == 'trade':
+                left = rng.random() < 0.7
+                trade = models.Cost.objects.create(money=1)
+                for resource in rng.sample(self.resources, 2):
+                    models.CostLine.objects.create(cost=trade, resource=resource, amount=1)
+                return models.Effect.objects.create(trade=trade, left_trade=left, right_trade=not left or rng.random() < 0.5)
+            elif choice == 'money':
+                return self.effect('money')
+            else:
+                return models.Effect.objects.create(
+                    kind_payed=self.kinds[rng.choice(['bas', 'cpx', 'civ'])],
+                    money_per_local_building=1,
+                    money_per_neighbor_building=rng.choice([0, 1]),
+                )
+        elif kind == models.PERSONALITY:
+            choice = rng.choice(['kinds', 'specials', 'defeats'])
+            if choice == 'kinds':
+                effect = models.Effect.objects.create(score_per_neighbor_building=1, score_per_local_building=rng.choice([0, 1]))
+                effect.kinds_scored.add(*rng.sample([self.kinds[k] for k in ('bas', 'cpx', 'civ', 'mil', 'sci')], rng.randint(1, 2)))
+                return effect
+            elif choice == 'specials':
+                return models.Effect.objects.create(score_per_local_special=1, score_per_neighbor_special=1)
+            else:
+                return models.Effect.objects.create(score_per_neighbor_defeat=1)
+        raise ValueError(kind)
+
+    def create_age(self, age):
+        """
+        Build options for age, enough for up to MAXIMUM_PLAYERS. The last
+        age also gets personalities
+        """
+        kinds = ['bas', 'cpx', 'mil', 'civ', 'sci', 'eco']
+        # Each extra player needs INITIAL_OPTIONS more options
+        needed = [constants.MINIMUM_PLAYERS]*constants.MINIMUM_PLAYERS*constants.INITIAL_OPTIONS
+        for players in range(constants.MINIMUM_PLAYERS+1, MAXIMUM_PLAYERS+1):
+            needed.extend([players]*constants.INITIAL_OPTIONS)
+        buildings = []
+        for players in needed:
+            kind = self.rng.choice(kinds)
+            building = models.Building.objects.create(
+                name=self.name(kind),
+                kind=self.kinds[kind],
+                effect=self.effect(kind),
+                cost=self.cost(age.order+1),
+            )
+            # Some buildings are free having one from an earlier age
+            if self.previous_buildings and self.rng.random() < 0.2:
+                building.free_having.add(self.rng.choice(self.previous_buildings))
+            models.BuildOption.objects.create(building=building, age=age, players_needed=players)
+            buildings.append(building)
+        if age == self.ages[-1]:
+            for _ in range(MAXIMUM_PLAYERS+2):
+                building = models.Building.objects.create(
+                    name=self.name('per'),
+                    kind=self.kinds[models.PERSONALITY],
+                    effect=self.effect(models.PERSONALITY),
+                    cost=self.cost(age.order+1),
+                )
+                models.BuildOption.objects.create(building=building, age=age, players_needed=constants.MINIMUM_PLAYERS)
+        self.previous_buildings = buildings
+
+def create_rules(seed=0):
+    """Create a random rule set in the database; returns the RulesFactory used"""
+    factory = RulesFactory(seed)
+    factory.create()
+    return factory
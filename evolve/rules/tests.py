@@ -1,7 +1,12 @@
+import collections
+import copy
+import random
+
 import mock
 
 from django.test import TestCase
-from evolve.rules import models
+from django.core.cache import cache
+from evolve.rules import models, economy, constants, science, catalog, synthetic
 
 class ScoreTest(TestCase):
 
@@ -378,5 +383,325 @@ class BuildOptionTest(TestCase):
         bo = models.BuildOption(players_needed=3, building=b)
         self.assertNotEqual(unicode(bo), '')
 
-# TODO: test economy.py (ResourceSet, PaymentOption, empty_cost, get_payments, can_pay)
+class ResourceIndexTest(TestCase):
+
+    def setUp(self):
+        self.index = economy.ResourceIndex()
+
+    def test_ids(self):
+        self.assertEqual(self.index.id('R1'), 0)
+        self.assertEqual(self.index.id('R2'), 1)
+        self.assertEqual(self.index.id('R1'), 0)
+        self.assertEqual(self.index.name(1), 'R2')
+        self.assertEqual(len(self.index), 2)
+
+    def test_requirements(self):
+        cost = collections.defaultdict(lambda: 0, {'$': 3, 'R2': 2, 'R1': 1, 'R3': 0})
+        self.index.id('R2')
+        self.assertEqual(self.index.requirements(cost), ((0, 2), (1, 1)))
+
+    def test_production(self):
+        self.assertEqual(self.index.production([(1, 'R1'), (2, 'R2')]), ((1, 0), (2, 1)))
+
+    def test_unit_costs(self):
+        self.index.id('R1')
+        self.index.id('R2')
+        costs = collections.defaultdict(lambda: 2, {'R2': 1})
+        self.assertEqual(list(self.index.unit_costs(costs)), [2, 1])
+
+    def test_compiled_unit_costs(self):
+        self.index.id('R1')
+        table = self.index.unit_costs(collections.defaultdict(lambda: 2))
+        self.assertIs(self.index.unit_costs(table), table)
+
+def random_payment_problem(rng):
+    """Random (and small) arguments for economy.get_payments"""
+    resources = ['R1', 'R2', 'R3', 'R4']
+    def producers():
+        return [
+            [(rng.randint(1, 2), r) for r in rng.sample(resources, rng.randint(1, 2))]
+            for _ in range(rng.randint(0, 3))
+        ]
+    def trade_costs():
+        result = collections.defaultdict(lambda: constants.DEFAULT_TRADE_COST)
+        for r in rng.sample(resources, rng.randint(0, 2)):
+            result[r] = 1
+        return result
+    cost = collections.defaultdict(lambda: 0)
+    cost['$'] = rng.choice([0, 0, 0, 1, 2])
+    for r in rng.sample(resources, rng.randint(0, 3)):
+        cost[r] = rng.randint(1, 3)
+    return (cost, rng.randint(0, 8), producers(), producers(), trade_costs(), producers(), trade_costs())
+
+def summary(options):
+    """The part of a list of payment options that must match between solvers"""
+    return [(o.money, o.left_trade.cost(), o.right_trade.cost()) for o in options]
+
+class GetPaymentsTest(TestCase):
+
+    def setUp(self):
+        self.costs = collections.defaultdict(lambda: constants.DEFAULT_TRADE_COST)
+
+    def cost(self, money=0, **resources):
+        result = collections.defaultdict(lambda: 0)
+        result['$'] = money
+        result.update(resources)
+        return result
+
+    def test_empty_cost(self):
+        options = economy.get_payments(self.cost(), 0, [], [], self.costs, [], self.costs)
+        self.assertEqual(summary(options), [(0, 0, 0)])
+
+    def test_money(self):
+        options = economy.get_payments(self.cost(2), 3, [], [], self.costs, [], self.costs)
+        self.assertEqual(summary(options), [(2, 0, 0)])
+
+    def test_not_enough_money(self):
+        options = economy.get_payments(self.cost(4), 3, [], [], self.costs, [], self.costs)
+        self.assertEqual(options, [])
+
+    def test_local(self):
+        options = economy.get_payments(self.cost(R1=2), 0, [[(1, 'R1')], [(1, 'R2'), (2, 'R1')]], [], self.costs, [], self.costs)
+        self.assertEqual(summary(options), [(0, 0, 0)])
+        self.assertEqual(options[0].local.get('R1'), (2, 0))
+
+    def test_unpayable(self):
+        options = economy.get_payments(self.cost(R1=2), 10, [[(1, 'R1')]], [[(1, 'R2')]], self.costs, [], self.costs)
+        self.assertEqual(options, [])
+
+    def test_trade_not_enough_money(self):
+        options = economy.get_payments(self.cost(1, R1=1), 2, [], [[(1, 'R1')]], self.costs, [], self.costs)
+        self.assertEqual(options, [])
+
+    def test_trade_alternatives(self):
+        right_costs = collections.defaultdict(lambda: 1)
+        options = economy.get_payments(self.cost(R1=2), 4, [], [[(2, 'R1')]], self.costs, [[(1, 'R1')]], right_costs)
+        # Buying 2 on the left, or 1 on each side. Buying more on the right is not possible
+        self.assertEqual(summary(options), [(0, 2, 1), (0, 4, 0)])
+
+    def test_matches_reference(self):
+        rng = random.Random(1234)
+        for _ in range(500):
+            problem = random_payment_problem(rng)
+            expected = economy.get_payments_reference(*problem)
+            self.assertEqual(summary(economy.get_payments(*problem)), summary(expected))
+
+    def test_options_pay_cost(self):
+        rng = random.Random(4321)
+        for _ in range(200):
+            problem = random_payment_problem(rng)
+            cost = problem[0]
+            for o in economy.get_payments(*problem):
+                self.assertEqual(o.money, cost['$'])
+                for r in ('R1', 'R2', 'R3', 'R4'):
+                    payed = o.local.get(r)[0] + o.left_trade.get(r)[0] + o.right_trade.get(r)[0]
+                    self.assertEqual(payed, cost[r])
+
+    def test_solver_uses_ids(self):
+        r1 = economy.RESOURCES.id('R1')
+        unit_costs = [1] * len(economy.RESOURCES)
+        solver = economy.PaymentSolver(1, ((r1, 2),), 3, [((1, r1),)], [((1, r1),)], unit_costs, [], unit_costs)
+        options = solver.solve()
+        self.assertEqual(summary(options), [(1, 1, 0)])
+        self.assertEqual(options[0].local.get('R1'), (1, 0))
+
+    def test_matches_solver(self):
+        rng = random.Random(2468)
+        production = economy.RESOURCES.production
+        for _ in range(500):
+            cost, money, local, left, left_costs, right, right_costs = random_payment_problem(rng)
+            solver = economy.PaymentSolver(
+                cost['$'], economy.RESOURCES.requirements(cost), money,
+                [production(p) for p in local],
+                [production(p) for p in left], economy.RESOURCES.unit_costs(left_costs),
+                [production(p) for p in right], economy.RESOURCES.unit_costs(right_costs),
+            )
+            options = economy.get_payments(cost, money, local, left, left_costs, right, right_costs)
+            self.assertEqual(summary(options), summary(solver.solve()))
+
+    def test_stats(self):
+        stats = {}
+        # The local producer has a choice between needed resources, so it takes a search
+        options = economy.get_payments(self.cost(R1=2, R2=1), 10, [[(1, 'R1'), (1, 'R2')]], [[(1, 'R3')]], self.costs, [], self.costs, stats=stats)
+        self.assertEqual(options, [])
+        # The R3 producer is of no use
+        self.assertEqual(stats['depth'], 1)
+        self.assertEqual(stats['options'], 0)
+        self.assertEqual(stats['dead_states'], 1)
+
+    def test_stats_without_search(self):
+        stats = {}
+        options = economy.get_payments(self.cost(R1=2), 10, [[(1, 'R1')]], [[(1, 'R2')]], self.costs, [[(1, 'R1')]], self.costs, stats=stats)
+        self.assertEqual(summary(options), [(0, 0, 2)])
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['options'], 1)
+
+    def test_can_pay(self):
+        options = economy.get_payments(self.cost(R1=1), 4, [], [[(1, 'R1')]], self.costs, [[(1, 'R1')]], self.costs)
+        # Sorted by total, and then by left trade
+        self.assertIs(economy.can_pay(options, 0, 2), options[0])
+        self.assertIs(economy.can_pay(options, 2, 0), options[1])
+        self.assertIs(economy.can_pay(options, 1, 1), None)
+
+class ParetoFrontTest(TestCase):
+
+    def test_empty(self):
+        front = economy.ParetoFront()
+        self.assertEqual(len(front), 0)
+        self.assertEqual(front.by_total(), [])
+
+    def test_discards_dominated(self):
+        front = economy.ParetoFront()
+        self.assertTrue(front.add(2, 2, 'a'))
+        self.assertFalse(front.add(3, 2, 'b'))
+        self.assertTrue(front.add(0, 4, 'c'))
+        self.assertTrue(front.add(4, 0, 'd'))
+        self.assertTrue(front.add(1, 1, 'e')) # discards 'a'
+        self.assertEqual(list(front), [(0, 4, 'c'), (1, 1, 'e'), (4, 0, 'd')])
+
+    def test_keeps_first_of_equals(self):
+        front = economy.ParetoFront([(1, 1, 'a'), (1, 1, 'b')])
+        self.assertEqual(list(front), [(1, 1, 'a')])
+
+    def test_by_total(self):
+        front = economy.ParetoFront([(0, 4, 'a'), (3, 0, 'b'), (2, 1, 'c')])
+        self.assertEqual(front.by_total(), ['c', 'b', 'a']) # ties sorted by left cost
+
+    def test_undominated_options_matches_reference(self):
+        rng = random.Random(5678)
+        for _ in range(200):
+            problem = random_payment_problem(rng)
+            raw = economy.get_payments_base(copy.copy(problem[0]), *problem[1:])
+            expected = economy.get_payments_reference(*problem)
+            self.assertEqual(summary(economy.undominated_options(raw)), summary(expected))
+
+class ScienceScoreTest(TestCase):
+
+    def setUp(self):
+        self.sciences = ['S1', 'S2', 'S3']
+
+    def test_no_effects(self):
+        self.assertEqual(science.science_score([], self.sciences), 0)
+
+    def test_no_sciences(self):
+        self.assertEqual(science.science_score([], []), 0)
+
+    def test_fixed(self):
+        choices = [['S1'], ['S2'], ['S3'], ['S1']]
+        self.assertEqual(science.science_score(choices, self.sciences), 7 + 4+1+1)
+
+    def test_choice(self):
+        choices = [['S1'], ['S2'], ['S1', 'S2', 'S3']]
+        # Completing a group is better than 2 of a kind
+        self.assertEqual(science.science_score(choices, self.sciences), 7 + 3)
+
+    def test_many_wildcards(self):
+        choices = [self.sciences] * 60
+        # 60 of a kind beats 20 groups
+        self.assertEqual(science.science_score(choices, self.sciences), 3600)
+
+    def test_matches_reference(self):
+        rng = random.Random(2468)
+        for _ in range(500):
+            sciences = self.sciences + ['S4'] * rng.randint(0, 1)
+            choices = [
+                rng.sample(sciences, rng.choice([1, 1, 2, 3]))
+                for _ in range(rng.randint(0, 8))
+            ]
+            expected = science.science_score_reference(choices, sciences)
+            self.assertEqual(science.science_score(choices, sciences), expected)
+
+class CatalogTest(TestCase):
+
+    def setUp(self):
+        synthetic.create_rules()
+        self.catalog = catalog.get()
+
+    def test_load_queries(self):
+        catalog.invalidate()
+        with self.assertNumQueries(20):
+            catalog.get()
+
+    def test_cached(self):
+        self.assertIs(catalog.get(), self.catalog)
+
+    def test_read_only(self):
+        age = self.catalog.first_age
+        with self.assertRaises(AttributeError):
+            age.name = 'Changed'
+
+    def test_invalidated_on_save(self):
+        age = models.Age.objects.get(pk=self.catalog.first_age.id)
+        age.name = 'Changed'
+        age.save()
+        self.assertEqual(catalog.get().first_age.name, 'Changed')
+
+    def test_invalidated_by_other_process(self):
+        # Another process changing the rules only changes the shared generation
+        cache.incr(catalog.SHARED_GENERATION_KEY)
+        with mock.patch.object(catalog, 'CHECK_INTERVAL', 0):
+            self.assertFalse(catalog.get() is self.catalog)
+            self.assertIs(catalog.get(), catalog.get())
+
+    def test_invalidated_on_m2m_change(self):
+        effect = models.Effect.objects.filter(sciences__isnull=True)[0]
+        effect.sciences.add(models.Science.objects.all()[0])
+        self.assertEqual(len(catalog.get().effects[effect.id].sciences), 1)
+
+    def test_effects(self):
+        for e in models.Effect.objects.all():
+            info = self.catalog.effects[e.id]
+            self.assertEqual(unicode(info), unicode(e))
+            self.assertEqual(info.sciences, tuple(s.name for s in e.sciences.all()))
+            self.assertEqual(info.kinds_scored, tuple(k.name for k in e.kinds_scored.all()))
+            if e.production:
+                self.assertEqual(info.production.to_dict(), e.production.to_dict())
+            # The catalog counts kinds by name, models with BuildingKinds
+            p = mock_player(2, 1, {})
+            p.count.side_effect = lambda kind: {'bas': 1, 'civ': 2}.get(getattr(kind, 'name', kind), 0)
+            self.assertEqual(info.get_score(p, p, p), e.get_score(p, p, p))
+            self.assertEqual(info.money(p, p, p), e.money(p, p, p))
+
+    def test_buildings(self):
+        for b in models.Building.objects.all():
+            info = self.catalog.building(b.id)
+            self.assertEqual(info.name, b.name)
+            self.assertEqual(info.kind, b.kind.name)
+            self.assertEqual(info.cost.to_dict(), b.cost.to_dict())
+            self.assertEqual(info.free_having, frozenset(x.id for x in b.free_having.all()))
+            self.assertEqual(set(info.allows_free), set(x.id for x in b.allows_free.all()))
+
+    def test_ages(self):
+        ages = list(models.Age.objects.all())
+        self.assertEqual(self.catalog.first_age.id, models.Age.first().id)
+        for age in ages:
+            next = models.Age.objects.get(pk=age.id).next()
+            info = self.catalog.age(age.id).next
+            self.assertEqual(info and info.id, next and next.id)
+
+    def test_specials(self):
+        special = models.CitySpecial.objects.all()[0]
+        specials = self.catalog.specials(special.city_id, special.variant_id)
+        self.assertEqual([s.order for s in specials], [0, 1, 2])
+        self.assertEqual(self.catalog.special(special.city_id, special.variant_id, 1).order, 1)
+        self.assertEqual(self.catalog.next_special(special.city_id, special.variant_id, 2).order, 2)
+        self.assertIs(self.catalog.next_special(special.city_id, special.variant_id, 3), None)
+        self.assertEqual(len(self.catalog.built_specials(special.city_id, special.variant_id, 2)), 2)
+
+    def test_deck(self):
+        age = self.catalog.first_age
+        deck = self.catalog.deck(age.id, 4)
+        expected = models.BuildOption.objects.filter(age=age.id, players_needed__lte=4)
+        self.assertEqual(set(o.id for o in deck), set(o.id for o in expected))
+
+    def test_deal(self):
+        age = self.catalog.first_age
+        others, personalities = self.catalog.deal(age.id, 4)
+        expected = models.BuildOption.objects.filter(age=age.id, players_needed__lte=4)
+        self.assertEqual(set(others), set(o.id for o in expected.exclude(building__kind__name=models.PERSONALITY)))
+        self.assertEqual(set(personalities), set(o.id for o in expected.filter(building__kind__name=models.PERSONALITY)))
+        # More players than any option needs get the whole deck
+        everything = self.catalog.deal(age.id, self.catalog.max_players_needed)
+        self.assertEqual(self.catalog.deal(age.id, self.catalog.max_players_needed+5), everything)
+
 # TODO: test forms.py (EffectForm.clean)
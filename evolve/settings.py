@@ -17,6 +17,18 @@ DATABASES = {
         'PASSWORD': '',                  # Not used with sqlite3.
         'HOST': '',                      # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',                      # Set to empty string for default. Not used with sqlite3.
+        # A file, not the in-memory default, so tests can use it from several threads
+        'TEST_NAME': 'test-game.db',
+    }
+}
+
+# Shared by every server process, so they all see the rules generation (see
+# evolve.rules.catalog) and the cached play pages. Create the table once with
+# "manage.py createcachetable evolve_cache"; tests create their own
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'evolve_cache',
     }
 }
 
@@ -94,6 +106,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'evolve.base.metrics.MetricsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -104,6 +117,13 @@ MIDDLEWARE_CLASSES = (
 
 INTERNAL_IPS = ('127.0.0.1',)
 
+# Seconds between logs of the request metrics (see evolve.base.metrics)
+METRICS_LOG_INTERVAL = 300
+
+# Threads resolving turns in the background, in each server process (see
+# evolve.game.turns). With 0, the request of the last player resolves it
+TURN_WORKERS = 2
+
 ROOT_URLCONF = 'evolve.urls'
 
 TEMPLATE_DIRS = (
@@ -142,7 +162,11 @@ LOGGING = {
         'mail_admins': {
             'level': 'ERROR',
             'class': 'django.utils.log.AdminEmailHandler'
-        }
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django.request': {
@@ -150,6 +174,18 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'evolve.metrics': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'evolve.profile': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+        'evolve.turns': {
+            'handlers': ['console', 'mail_admins'],
+            'level': 'ERROR',
+        },
     }
 }
 